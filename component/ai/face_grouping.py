@@ -4,6 +4,7 @@
 import numpy as np
 from PIL import Image
 from component.duplicate_finder import get_features_with_cache
+from component.face_index import group_face_encodings
 from component.utils.file_util import normalize_path
 
 def get_face_encoding(filepath):
@@ -17,7 +18,7 @@ def get_face_encoding(filepath):
         arr = np.array(img)
         faces = face_recognition.face_encodings(arr)
         return faces[0] if faces else np.zeros(128)
-    return get_features_with_cache(filepath, calc_func)
+    return get_features_with_cache(filepath, calc_func, feature="face")
 
 def get_video_face_encoding(filepath, sample_frames=7):
     filepath = normalize_path(filepath)
@@ -48,23 +49,9 @@ def get_video_face_encoding(filepath, sample_frames=7):
             return np.mean(encodings, axis=0)
         else:
             return None
-    return get_features_with_cache(filepath, calc_func)
+    return get_features_with_cache(filepath, calc_func, feature="video_face")
 
 def group_by_face(encodings, paths, threshold=0.6):
-    from sklearn.metrics.pairwise import cosine_distances
-    groups = []
-    used = set()
-    for i, (f1, e1) in enumerate(zip(paths, encodings)):
-        if f1 in used or e1 is None:
-            continue
-        group = [f1]
-        for j, (f2, e2) in enumerate(zip(paths, encodings)):
-            if i != j and f2 not in used and e2 is not None:
-                dist = cosine_distances([e1], [e2])[0][0]
-                if dist < threshold:
-                    group.append(f2)
-                    used.add(f2)
-        used.add(f1)
-        if len(group) > 1:
-            groups.append(group)
-    return groups
+    # コサイン距離がthreshold未満の顔をまとめる（顔特徴量のインデックスで近傍ペアを一括で求める）
+    groups = group_face_encodings(list(encodings), threshold, metric="cosine")
+    return [[paths[i] for i in group] for group in groups]
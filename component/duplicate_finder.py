@@ -3,12 +3,20 @@ duplicate_finder.py
 ファイル/動画/画像の重複判定・グループ化ユーティリティ。
 
 主な機能:
-- 画像/動画のpHash計算
-- キャッシュ利用による高速化
-- 重複グループの検出
+- 画像/動画のpHash計算（画像は縮小デコードによる高速モードあり）
+- NumPy/SciPyによるpHashのバッチ計算（imagehash.phashとビット一致）
+- 1回のデコードから複数ハッシュ(pHash/dHash/aHash/wHash/colorhash)を計算する署名
+- プロセスプールによるpHash並列抽出
+- 特徴量ストア（SQLite）のキャッシュ利用による高速化
+- 計算に失敗したファイルの記録（理由コード付き。ファイルが変わるまで開き直さない）
+- バイト単位の完全一致の事前検出（サイズ→先頭/末尾→全体BLAKE2。ハッシュは特徴量ストアにキャッシュ）
+- メタデータ（解像度比・再生時間）による比較対象の事前絞り込み
+- pHashをpaths + np.uint64配列(PackedHashes)で保持するコンパクトなパイプライン
+- 重複グループの検出（近傍ペアの列挙とUnion-Findによるクラスタリング）
+- 共有メモリ上のハッシュ配列を使ったプロセス並列の近傍計算
 
 依存:
-- imagehash, OpenCV, numpy, Pillow, os, pickle
+- imagehash, OpenCV, numpy, scipy, Pillow, os, pickle, component.utils.feature_store
 """
 
 # 重複検査: ファイル/動画/画像の重複判定・グループ化
@@ -20,212 +28,1012 @@ from PIL import Image
 import hashlib
 import pickle
 import concurrent.futures
-from component.utils.cache_util import save_cache, load_cache
-from component.utils.file_util import normalize_path
+from multiprocessing import shared_memory
+import scipy.fftpack
+from component.utils.cache_util import cache_lock, delete_cache, load_cache
+from component.utils.feature_store import DEFAULT_FEATURE, FeatureFailure, get_feature_store
+from component.utils.file_util import content_fingerprint, content_fingerprints, normalize_path, stat_signature, stat_signatures
+from component.utils.hash_util import PackedHashes, hash_to_int, hashes_to_uint64, int_to_hash, pack_file_hashes, popcount64, hamming_distance
+from component.media_metadata import MetadataFilter, get_media_metadata, metadata_blocks, metadata_compatible
+from component.hash_index import IncrementalGrouper, blocked_near_pairs, cluster_pairs, cross_near_pairs, filter_pairs, index_near_pairs, mih_near_pairs
 
-def get_image_phash(filepath, folder=None, cache=None):
-    filepath = normalize_path(filepath)
-    def calc_func(path):
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff")
+VIDEO_EXTS = (".mp4", ".avi", ".mov", ".mkv", ".wmv", ".flv", ".webm", ".mpg", ".mpeg", ".3gp")
+
+# 特徴量を計算できなかった理由コード（FeatureFailureとして署名付きで記録する）
+FAILURE_DECODE = "decode"  # 画像をデコードできない
+FAILURE_NO_FRAMES = "no_frames"  # 動画を開けない・フレームを読めない
+FAILURE_NO_RESULT = "no_result"  # 計算関数がNoneを返した（顔が無いなど）
+
+# メタデータ（MediaMeta）を特徴量ストアに保存する種類名
+METADATA_FEATURE = "meta"
+
+# 高速デコード時に残す短辺の最小ピクセル数（pHashの32x32縮小に対して十分な余裕を持たせる）
+FAST_DECODE_MIN_SIZE = 128
+
+def open_image_reduced(path, mode="RGB", min_size=FAST_DECODE_MIN_SIZE):
+    """
+    画像を縮小デコードして開く。
+    JPEGはdraft()でDCTスケーリング(1/2,1/4,1/8)を使い、デコード時点で縮小する。
+    それ以外の形式もreduce()で短辺がmin_size以上を保つ範囲まで整数倍縮小する。
+    """
+    img = Image.open(path)
+    if img.format == "JPEG":
+        img.draft(mode, (min_size, min_size))
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    factor = min(img.size) // min_size
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img.convert(mode)
+
+# pHashの入力サイズ(32x32)と、抽出時に1タスクでまとめて計算する画像数
+PHASH_INPUT_SIZE = 32
+PHASH_BATCH_SIZE = 64
+
+def phash_input_array(img):
+    """
+    imagehash.phashと同じ手順(グレースケール化→32x32 ANTIALIAS縮小)でバッチ計算用の配列を作る。
+    """
+    return np.asarray(img.convert("L").resize((PHASH_INPUT_SIZE, PHASH_INPUT_SIZE), imagehash.ANTIALIAS))
+
+def phash_batch(pixels):
+    """
+    32x32グレースケール配列の束(N x 32 x 32)のpHashをまとめて計算する。
+    imagehash.phashと同じDCT・中央値しきい値を全画像に一括適用し、
+    64bitに詰めたnp.uint64配列(N)を返す（ビット列はimagehash.phashと一致する）。
+    """
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        pixels = pixels[None]
+    if len(pixels) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    lowfreq = dct[:, :8, :8].reshape(len(pixels), 64)
+    med = np.median(lowfreq, axis=1)
+    bits = lowfreq > med[:, None]
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+def calc_image_phash_batch(paths, fast_decode=False):
+    """
+    複数画像をデコードして32x32配列に揃え、phash_batchでまとめてpHashを計算する。
+    戻り値: [64bit整数 or None, ...]（pathsと同じ順序）
+    """
+    arrays = []
+    ok = []
+    for path in paths:
         try:
+            if fast_decode:
+                img = open_image_reduced(path, "L")
+            else:
+                img = Image.open(path).convert("RGB")
+            arrays.append(phash_input_array(img))
+            ok.append(True)
+        except Exception:
+            ok.append(False)
+    hashes = iter(phash_batch(np.stack(arrays)) if arrays else [])
+    return [int(next(hashes)) if flag else None for flag in ok]
+
+def calc_image_phash(path, fast_decode=False):
+    try:
+        if fast_decode:
+            img = open_image_reduced(path, "L")
+        else:
             img = Image.open(path).convert("RGB")
-            return imagehash.phash(img)
+        return imagehash.phash(img)
+    except Exception:
+        return None
+
+def compare_decode_modes(files):
+    """
+    フルデコードと高速デコード(fast_decode=True)のpHashを比較する（キャッシュは使わない）。
+    戻り値: [(file, フルデコードのhash, 高速デコードのhash, ハミング距離 or None), ...]
+    """
+    results = []
+    for f in files:
+        full = calc_image_phash(f, fast_decode=False)
+        fast = calc_image_phash(f, fast_decode=True)
+        dist = full - fast if full is not None and fast is not None else None
+        results.append((f, full, fast, dist))
+    return results
+
+# 動画フレームの読み出し方式: "seek"=フレームごとにシーク, "sequential"=先頭から1回だけ順次デコード,
+# "auto"=SEQUENTIAL_SAMPLER_MAX_FRAMES以下の短い動画のみsequential
+# キーフレーム間隔が短い一般的な動画ではシークの方が速い。シークが先頭からのデコードに
+# フォールバックするコンテナではsequentialを指定する（tools/bench_video_sampler.pyで比較可能）
+VIDEO_SAMPLER = "auto"
+SEQUENTIAL_SAMPLER_MAX_FRAMES = 200
+
+def sample_frame_indices(length, frame_count=7):
+    """
+    動画の総フレーム数からpHash計算に使うフレーム番号(昇順)を決める。
+    """
+    if length <= 0 or frame_count <= 0:
+        return []
+    indices = set([0, length-1, length//2])
+    if frame_count > 3:
+        for i in range(frame_count-3):
+            idx = int(length * (i+1)/(frame_count-2))
+            indices.add(min(max(0, idx), length-1))
+    return sorted(indices)
+
+def read_frames_seek(cap, indices):
+    """
+    フレームごとにCAP_PROP_POS_FRAMESでシークして読む。戻り値: [(フレーム番号, frame), ...]
+    """
+    frames = []
+    for frame_no in indices:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+        ret, frame = cap.read()
+        if ret:
+            frames.append((frame_no, frame))
+    return frames
+
+def read_frames_sequential(cap, indices):
+    """
+    先頭から1回だけ順にgrab()し、必要なフレームだけretrieve()する（シークしない）。
+    戻り値: [(フレーム番号, frame), ...]
+    """
+    frames = []
+    targets = set(indices)
+    last = max(indices) if indices else -1
+    pos = 0
+    while pos <= last:
+        if not cap.grab():
+            break
+        if pos in targets:
+            ret, frame = cap.retrieve()
+            if ret:
+                frames.append((pos, frame))
+        pos += 1
+    return frames
+
+def read_sampled_frames(path, frame_count=7, sampler=None):
+    """
+    動画からframe_count枚程度のフレームを読み出す。
+    sampler: "seek" / "sequential" / "auto"（None=VIDEO_SAMPLER）
+    """
+    if sampler is None:
+        sampler = VIDEO_SAMPLER
+    cap = cv2.VideoCapture(path)
+    try:
+        length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        indices = sample_frame_indices(length, frame_count)
+        if not indices:
+            return []
+        if sampler == "auto":
+            sampler = "sequential" if length <= SEQUENTIAL_SAMPLER_MAX_FRAMES else "seek"
+        if sampler == "sequential":
+            return read_frames_sequential(cap, indices)
+        return read_frames_seek(cap, indices)
+    finally:
+        cap.release()
+
+def calc_video_phash(path, frame_count=7, sampler=None):
+    arrays = []
+    for _, frame in read_sampled_frames(path, frame_count, sampler):
+        try:
+            pil_img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            arrays.append(phash_input_array(pil_img))
         except Exception:
-            return None
+            continue
+    if not arrays:
+        return None
+    # 動画pHashはフレームごとのpHashの平均値（フレーム分をphash_batchで一括計算）
+    hashes = phash_batch(np.stack(arrays))
+    arr = np.unpackbits(hashes.astype(">u8").view(np.uint8).reshape(len(hashes), 8), axis=1)
+    avg_hash = (arr.mean(axis=0) > 0.5).astype(np.uint8).reshape(8, 8)
+    return imagehash.ImageHash(avg_hash)
+
+# 複数ハッシュ署名で使えるハッシュ種別
+HASH_FUNCS = {
+    "phash": imagehash.phash,
+    "dhash": imagehash.dhash,
+    "ahash": imagehash.average_hash,
+    "whash": imagehash.whash,
+    "colorhash": imagehash.colorhash,
+}
+DEFAULT_HASH_TYPES = ("phash", "dhash", "ahash", "whash", "colorhash")
+# ハッシュ種別ごとの重複判定しきい値（ハミング距離がこれ未満なら一致）
+DEFAULT_HASH_THRESHOLDS = {"phash": 8, "dhash": 10, "ahash": 8, "whash": 8, "colorhash": 4}
+# 動画フレームを共通バッファに縮小する際の短辺サイズ
+MULTIHASH_FRAME_SIZE = FAST_DECODE_MIN_SIZE
+
+def calc_hashes_from_image(img, hash_types=DEFAULT_HASH_TYPES):
+    """
+    1枚のデコード済み画像から複数種類のハッシュを計算する。
+    グレースケール変換は1回だけ行い、colorhash以外はそのバッファを共有する。
+    戻り値: {ハッシュ種別: ImageHash}
+    """
+    gray = img.convert("L")
+    result = {}
+    for name in hash_types:
+        src = img if name == "colorhash" else gray
+        result[name] = HASH_FUNCS[name](src)
+    return result
+
+def calc_image_multihash(path, hash_types=DEFAULT_HASH_TYPES, fast_decode=True):
+    """
+    画像を1回だけデコードし、縮小したバッファから複数ハッシュを計算する。
+    """
+    try:
+        if fast_decode:
+            img = open_image_reduced(path, "RGB")
+        else:
+            img = Image.open(path).convert("RGB")
+        return calc_hashes_from_image(img, hash_types)
+    except Exception:
+        return None
+
+def calc_video_multihash(path, hash_types=DEFAULT_HASH_TYPES, frame_count=7, sampler=None):
+    """
+    動画のサンプルフレームごとに複数ハッシュを計算し、種別ごとにビット多数決でまとめる。
+    """
+    per_type = {name: [] for name in hash_types}
+    for _, frame in read_sampled_frames(path, frame_count, sampler):
+        try:
+            h, w = frame.shape[:2]
+            scale = MULTIHASH_FRAME_SIZE / min(h, w)
+            if scale < 1:
+                frame = cv2.resize(frame, (max(1, int(w*scale)), max(1, int(h*scale))), interpolation=cv2.INTER_AREA)
+            pil_img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            for name, val in calc_hashes_from_image(pil_img, hash_types).items():
+                per_type[name].append(val)
+        except Exception:
+            continue
+    if not any(per_type.values()):
+        return None
+    result = {}
+    for name, hashes in per_type.items():
+        arr = np.array([h.hash for h in hashes])
+        result[name] = imagehash.ImageHash((arr.mean(axis=0) > 0.5).astype(np.uint8))
+    return result
+
+def hash_feature(path, hash_types=None, fast_decode=False, image_exts=IMAGE_EXTS):
+    """
+    pHash・複数ハッシュ署名を特徴量ストアに保存する種類名。
+    縮小デコード(fast_decode)した画像のハッシュはフルデコードと少し異なるため、別の種類（"phash_fast"/"multihash_fast"）にする。
+    動画はデコード方法に依らないので共通。
+    """
+    name = "multihash" if hash_types else DEFAULT_FEATURE
+    if fast_decode and os.path.splitext(path)[1].lower() in image_exts:
+        name = (name or "phash") + "_fast"
+    return name
+
+def get_image_phash(filepath, folder=None, cache=None, fast_decode=False):
+    # キャッシュには64bit整数で保存し、呼び出し側にはImageHashで返す
+    filepath = normalize_path(filepath)
+    def calc_func(path):
+        return hash_to_int(calc_image_phash(path, fast_decode))
     if cache is not None:
         if filepath in cache:
             print(f"[pHash cache HIT] {filepath}")
-            return cache[filepath]
+            return int_to_hash(cache[filepath])
         val = calc_func(filepath)
         print(f"[pHash cache MISS] {filepath}")
         cache[filepath] = val
-        return val
-    val = get_features_with_cache(filepath, calc_func, folder)
+        return int_to_hash(val)
+    val = int_to_hash(get_features_with_cache(filepath, calc_func, folder, feature=hash_feature(filepath, fast_decode=fast_decode), failure_reason=_failure_reason(filepath)))
     # print(f"[pHash cache (get_features_with_cache)] {filepath} -> HIT" if val is not None else f"[pHash cache (get_features_with_cache)] {filepath} -> MISS")
     return val
 
-def get_video_phash(filepath, frame_count=7, folder=None, cache=None):
+def get_video_phash(filepath, frame_count=7, folder=None, cache=None, sampler=None):
     filepath = normalize_path(filepath)
     def calc_func(path):
-        cap = cv2.VideoCapture(path)
-        length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        hashes = []
-        if length == 0 or frame_count == 0:
-            cap.release()
-            return None
-        indices = set([0, length-1, length//2])
-        if frame_count > 3:
-            for i in range(frame_count-3):
-                idx = int(length * (i+1)/(frame_count-2))
-                indices.add(min(max(0, idx), length-1))
-        indices = sorted(indices)
-        for frame_no in indices:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-            ret, frame = cap.read()
-            if not ret:
-                continue
-            try:
-                pil_img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-                hash_val = imagehash.phash(pil_img)
-                hashes.append(hash_val)
-            except Exception:
-                continue
-        cap.release()
-        if not hashes:
-            return None
-        # 動画pHashはフレームごとのpHashの平均値
-        arr = np.array([h.hash for h in hashes])
-        avg_hash = (arr.mean(axis=0) > 0.5).astype(np.uint8)
-        return imagehash.ImageHash(avg_hash)
+        return hash_to_int(calc_video_phash(path, frame_count, sampler))
     if cache is not None:
         if filepath in cache:
             print(f"[pHash cache HIT] {filepath}")
-            return cache[filepath]
+            return int_to_hash(cache[filepath])
         val = calc_func(filepath)
         print(f"[pHash cache MISS] {filepath}")
         cache[filepath] = val
-        return val
-    val = get_features_with_cache(filepath, calc_func, folder)
+        return int_to_hash(val)
+    val = int_to_hash(get_features_with_cache(filepath, calc_func, folder, failure_reason=_failure_reason(filepath)))
     # print(f"[pHash cache (get_features_with_cache)] {filepath} -> HIT" if val is not None else f"[pHash cache (get_features_with_cache)] {filepath} -> MISS")
     return val
 
 def get_cache_files(folder):
+    """
+    旧形式のフォルダ単位キャッシュ（作業ディレクトリのpickle）のファイル名。特徴量ストアへの移行にだけ使う。
+    """
     folder = os.path.abspath(folder)
     h = hashlib.sha1(folder.encode('utf-8')).hexdigest()[:12]
     cache_file = f".video_cache_{h}.enc"
     key_file = f".video_cache_{h}.key"
     return cache_file, key_file
 
-def get_features_with_cache(filepath, calc_func, folder=None):
+# 旧形式キャッシュの移行を確認済みのフォルダ（プロセス内で1回だけ確認する）
+_legacy_checked = set()
+
+def import_legacy_feature_cache(folder):
+    """
+    旧形式のフォルダ単位キャッシュがあれば特徴量ストアへまとめて登録し、旧ファイルを削除する。
+    キーがパスのものはDEFAULT_FEATURE、(種類, パス)のものはその種類として登録する。
+    旧キャッシュには署名が無いため移行時点のファイルの署名で登録する（存在しないファイルは移行しない）。
+    戻り値: 登録した件数
+    """
+    folder = os.path.abspath(folder)
+    if folder in _legacy_checked:
+        return 0
+    _legacy_checked.add(folder)
+    cache_file, _ = get_cache_files(folder)
+    if not os.path.exists(cache_file):
+        return 0
+    # 同時に起動した別のプロセスと重ねて移行しない（先に移行したプロセスが旧ファイルを削除する）
+    with cache_lock(cache_file):
+        return _import_legacy_cache_file(cache_file)
+
+def _import_legacy_cache_file(cache_file):
+    cache_bytes = load_cache(cache_file)
+    if cache_bytes is None:
+        return 0
+    try:
+        cache = pickle.loads(cache_bytes)
+    except Exception:
+        return 0
+    entries = [(key if isinstance(key, tuple) else (DEFAULT_FEATURE, key), val) for key, val in cache.items() if val is not None]
+    signatures = stat_signatures(set(path for (_, path), _ in entries))
+    per_feature = {}
+    for (feature, path), val in entries:
+        if signatures.get(path) is not None:
+            per_feature.setdefault(feature, []).append((path, val))
+    store = get_feature_store()
+    for feature, items in per_feature.items():
+        store.put_many(items, feature, signatures)
+    # 旧ファイルを消す前に書き込む
+    store.flush()
+    delete_cache(cache_file)
+    return sum(len(items) for items in per_feature.values())
+
+def get_features_with_cache(filepath, calc_func, folder=None, feature=None, failure_reason=FAILURE_NO_RESULT):
+    """
+    特徴量を特徴量ストア経由で取得する（1件の主キー検索。未登録なら計算して1件だけ登録する）。
+    feature: 特徴量の種類名。指定時はpHash(種類=DEFAULT_FEATURE)など他の特徴量と区別する。
+    folder: 旧形式のフォルダ単位キャッシュの移行に使う
+    failure_reason: calc_funcがNoneを返したときに記録する理由コード（extract_phashesなどと同じ種類には同じコードを使う）
+    """
     filepath = normalize_path(filepath)
+    if folder is not None:
+        import_legacy_feature_cache(folder)
+    feature = DEFAULT_FEATURE if feature is None else feature
+    store = get_feature_store()
+    # 計算前の署名で登録する（計算中にファイルが変わっても次回は再計算される）
+    signature = stat_signature(filepath)
+    result = store.get(filepath, feature, signature)
+    if result is None:
+        # 移動・名前変更されたファイルは内容の指紋で以前の特徴量を探す
+        fingerprint = content_fingerprint(filepath)
+        result = store.get_moved([filepath], feature, {filepath: signature}, {filepath: fingerprint}).get(filepath)
+    if isinstance(result, FeatureFailure):
+        # 前回計算できなかったファイル（変更されるまで計算し直さない）
+        return None
+    if result is not None:
+        return result
+    result = calc_func(filepath)
+    if result is not None:
+        store.put(filepath, result, feature, signature, fingerprint)
+    elif signature is not None:
+        store.put(filepath, FeatureFailure(failure_reason), feature, signature, fingerprint)
+    return result
+
+def _failure_reason(path):
+    return FAILURE_NO_FRAMES if os.path.splitext(path)[1].lower() in VIDEO_EXTS else FAILURE_DECODE
+
+def get_feature_failures(files, hash_types=None, fast_decode=False):
+    """
+    pHash（hash_types指定時は複数ハッシュ署名）の計算に失敗したと記録されているファイルの理由コード
+    （記録後に変更されたファイルは含まない）。hash_types/fast_decodeはextract_phashesと同じ指定にする。
+    戻り値: {file: 理由コード}
+    """
+    keys = {normalize_path(f): f for f in files}
+    store = get_feature_store()
+    failures = {}
+    for feature, group in _group_by_feature(keys, hash_types, fast_decode).items():
+        found = store.get_many(group, feature)
+        failures.update((keys[k], v.reason) for k, v in found.items() if isinstance(v, FeatureFailure))
+    return failures
+
+def _group_by_feature(keys, hash_types, fast_decode, image_exts=IMAGE_EXTS):
+    # {種類名: [key, ...]}（hash_feature参照）
+    groups = {}
+    for key in keys:
+        groups.setdefault(hash_feature(key, hash_types, fast_decode, image_exts), []).append(key)
+    return groups
+
+def _calc_phash_task(args):
+    # ProcessPoolExecutor用（pickle可能なトップレベル関数である必要がある）
+    # 画像のpHashはphash_batchでまとめて計算するため、1タスクで複数ファイルを受け取りリストを返す
+    filepaths, is_video, fast_decode, hash_types = args
+    if hash_types:
+        if is_video:
+            return [calc_video_multihash(f, hash_types) for f in filepaths]
+        return [calc_image_multihash(f, hash_types, fast_decode) for f in filepaths]
+    if is_video:
+        return [hash_to_int(calc_video_phash(f, 7)) for f in filepaths]
+    return calc_image_phash_batch(filepaths, fast_decode)
+
+def _cached_metadata(store, files, keys, signatures, fingerprints):
+    # メタデータを特徴量ストアからまとめて取得し、無いものだけヘッダを読んで登録する
+    # 取得できなかったファイルもFeatureFailureとして記録し、変更されるまで開き直さない
+    found = store.get_many(keys, METADATA_FEATURE, signatures)
+    result = {}
+    new = []
+    for f, key in zip(files, keys):
+        if key in found:
+            meta = found[key]
+            result[f] = None if isinstance(meta, FeatureFailure) else meta
+            continue
+        meta = get_media_metadata(key)
+        result[f] = meta
+        if signatures.get(key) is not None:
+            new.append((key, meta if meta is not None else FeatureFailure(_failure_reason(key))))
+    store.put_many(new, METADATA_FEATURE, signatures, fingerprints)
+    return result
+
+def extract_phashes(files, folder=None, image_exts=IMAGE_EXTS, progress_callback=None, progress_bar=None, max_workers=None, chunksize=1, fast_decode=False, hash_types=None, batch_size=PHASH_BATCH_SIZE, as_int=False, metadata=None):
+    """
+    ファイルリストのpHashをプロセスプールで並列計算する。
+    戻り値: [(file, hash), ...]（filesと同じ順序。計算失敗はhash=None）
+    pHashはキャッシュに64bit整数で保存する。as_int=Trueなら整数のまま、Falseなら ImageHash で返す。
+    キャッシュ済みのファイルはプールに投げず、未キャッシュ分のみ計算してまとめて保存する。
+    計算に失敗したファイルも理由コードと署名を記録し、変更されるまでは開かずにhash=Noneを返す。
+    progress_callback(完了数, 総数) はファイル1件ごとに呼ばれる。
+    max_workers: ワーカープロセス数（None=CPU数, 1=プールを使わず逐次計算）
+    fast_decode: Trueなら画像を縮小デコードしてからpHashを計算する（open_image_reduced参照）
+    hash_types: 指定時はpHashの代わりに複数ハッシュ署名({種別: ImageHash})を計算する
+    batch_size: 画像pHashを1タスクでまとめて計算する件数（phash_batch参照）
+    metadata: dictを渡すと {file: MediaMeta or None} を追加する（ハッシュと同じ署名で特徴量ストアにキャッシュする）
+    """
+    total = len(files)
+    if total == 0 and folder is None:
+        return []
     if folder is None:
-        folder = os.path.dirname(filepath)
-    cache_file, key_file = get_cache_files(folder)
-    cache = None
-    for i in range(5):
+        folder = os.path.commonpath([os.path.abspath(f) for f in files])
+        if not os.path.isdir(folder):
+            folder = os.path.dirname(folder)
+    import_legacy_feature_cache(folder)
+    store = get_feature_store()
+    keys = [normalize_path(f) for f in files]
+    # 署名は1回のscandirでまとめて取得し、一致したキャッシュはファイルを開かずに使う
+    signatures = stat_signatures(keys)
+    # 縮小デコードの画像は別の種類で保存する（hash_feature参照）
+    cached = {}
+    for feature, group in _group_by_feature(keys, hash_types, fast_decode, image_exts).items():
+        cached.update(store.get_many(group, feature, signatures))
+    # パスで見つからないものは内容の指紋で探す（移動・名前変更されたファイルを計算し直さない）
+    missing = [key for key in keys if key not in cached]
+    fingerprints = content_fingerprints(missing)
+    for feature, group in _group_by_feature(missing, hash_types, fast_decode, image_exts).items():
+        cached.update(store.get_moved(group, feature, signatures, fingerprints))
+    if metadata is not None:
+        metadata.update(_cached_metadata(store, files, keys, signatures, fingerprints))
+    results = [None] * total
+    done = 0
+    def report():
+        if progress_callback is not None:
+            progress_callback(done, total)
+        elif progress_bar is not None:
+            progress_bar.setValue(int(done/total*100))
+    pending = []
+    for idx, (f, key) in enumerate(zip(files, keys)):
+        val = cached.get(key)
+        if isinstance(val, FeatureFailure):
+            # 前回計算できなかったファイルは、変更されるまで開き直さない（結果はNoneのままエラー扱い）
+            done += 1
+            report()
+            continue
+        if hash_types and val is not None and not all(name in val for name in hash_types):
+            val = None
+        if val is not None:
+            results[idx] = val if hash_types else hash_to_int(val)
+            done += 1
+            report()
+        else:
+            is_video = os.path.splitext(f)[1].lower() not in image_exts
+            pending.append((idx, key, is_video))
+    if not pending:
+        # すべてキャッシュにあっても（削除だけのスキャンなど）消えたファイルの項目は整理する
+        store.auto_compact([folder])
+        return _extract_result(files, results, hash_types, as_int)
+    # 連続する画像はbatch_size件ずつ1タスクにまとめる（動画・複数ハッシュ署名は1件ずつ）
+    batches = []
+    for item in pending:
+        is_video = item[2]
+        if batches and not is_video and not hash_types and not batches[-1][-1][2] and len(batches[-1]) < batch_size:
+            batches[-1].append(item)
+        else:
+            batches.append([item])
+    tasks = [([key for _, key, _ in batch], batch[0][2], fast_decode, hash_types) for batch in batches]
+    if max_workers == 1 or len(tasks) == 1:
+        hash_lists = map(_calc_phash_task, tasks)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        hash_lists = executor.map(_calc_phash_task, tasks, chunksize=chunksize)
+    try:
+        for batch, hashes in zip(batches, hash_lists):
+            for (idx, key, _), h in zip(batch, hashes):
+                results[idx] = h
+                done += 1
+                report()
+            # 特徴量ストアが件数・時間ごとにまとめて書き込む
+            # 計算できなかったファイルも理由コードと署名を記録し、次回は開かない
+            store.put_many(
+                [(key, h if h is not None else FeatureFailure(FAILURE_NO_FRAMES if is_video else FAILURE_DECODE))
+                 for (_, key, is_video), h in zip(batch, hashes) if h is not None or signatures.get(key) is not None],
+                hash_feature(batch[0][1], hash_types, fast_decode, image_exts), signatures, fingerprints,
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        store.flush()
+    # 移動されたファイルを登録し直した後で、スキャンしたフォルダの消えたファイルの項目を整理する（一定間隔ごと）
+    store.auto_compact([folder])
+    return _extract_result(files, results, hash_types, as_int)
+
+def _extract_result(files, results, hash_types, as_int):
+    if hash_types or as_int:
+        return list(zip(files, results))
+    return [(f, int_to_hash(h)) for f, h in zip(files, results)]
+
+def extract_packed_phashes(files, folder=None, **kwargs):
+    """
+    extract_phashesのPackedHashes版。
+    戻り値: (PackedHashes(paths, np.uint64配列), pHash計算に失敗したファイルのリスト)
+    """
+    file_hashes = extract_phashes(files, folder, as_int=True, **kwargs)
+    error_files = [f for f, h in file_hashes if h is None]
+    return pack_file_hashes(file_hashes), error_files
+
+def _align_metadata(file_hashes, metadata):
+    # {file: MediaMeta} をfile_hashesと同じ並びのリストにする
+    if metadata is None:
+        return None
+    if isinstance(metadata, dict):
+        paths = file_hashes.paths if isinstance(file_hashes, PackedHashes) else [f for f, _ in file_hashes]
+        return [metadata.get(f) for f in paths]
+    # インデックスで引けるもの（hash_store.MetaTableなど）はそのまま使う
+    return metadata if hasattr(metadata, "__getitem__") else list(metadata)
+
+def _scan_near_pairs(hashes, threshold, meta_filter=None, start=0, end=None):
+    # start〜end行目について、uint64配列のXOR+popcountで1行ずつ後ろの行と比較する
+    n = len(hashes)
+    ii = []
+    jj = []
+    for i in range(start, n if end is None else end):
+        if meta_filter is not None:
+            cand = np.array(meta_filter.candidates(i), dtype=np.int64)
+            cand = cand[cand > i]
+        else:
+            cand = np.arange(i + 1, n)
+        near = cand[popcount64(hashes[cand] ^ hashes[i]) < threshold]
+        ii.append(np.full(len(near), i, dtype=np.int64))
+        jj.append(near.astype(np.int64))
+    if not ii:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    return np.concatenate(ii), np.concatenate(jj)
+
+def _pack_if_64bit(file_hashes, metas=None):
+    """
+    [(file, hash), ...] のhashがすべて64bit（整数または8x8のImageHash）ならPackedHashesにする。
+    戻り値: (PackedHashes, 並びを揃えたmetas) または (None, None)（フレームごとのリストなど）
+    """
+    keep = []
+    for i, (_, h) in enumerate(file_hashes):
+        if h is None:
+            continue
+        if not isinstance(h, (int, np.integer)) and getattr(getattr(h, "hash", None), "size", None) != 64:
+            return None, None
+        keep.append(i)
+    packed = PackedHashes([file_hashes[i][0] for i in keep], hashes_to_uint64([file_hashes[i][1] for i in keep]))
+    return packed, [metas[i] for i in keep] if metas is not None else None
+
+def _metadata_compatible_func(metas, tolerances):
+    # インデックス同士のメタデータ互換判定関数（metasがNoneならNone）
+    if metas is None:
+        return None
+    def compatible(i, j):
+        return metadata_compatible(metas[i], metas[j], tolerances)
+    return compatible
+
+# PackedHashesのグループ化エンジン: "scan"=1行ずつ全件XOR走査, "bktree"=BK木の範囲検索,
+# "mih"=バンド分割（multi-index hashing）の候補ペアだけを検証, "blocked"=タイル分割した距離行列
+# 2万件・閾値8でscan 約4〜9秒 / blocked 約3秒 / mih 約1秒 / bktree 約107秒（すべて同じ近傍ペア）。
+# mihは件数が増えるとバンドのバケットが大きくなり候補ペア数（メモリ）が件数の2乗で増えるため、
+# 作業メモリが件数に依らないblockedを既定にする。BK木は64bit pHashでは枝刈りが効きにくく、
+# 追加・類似検索用のインデックス（find_duplicates_in_folder(return_index=True)）として使う。
+DEFAULT_GROUP_ENGINE = "blocked"
+# pHashのハミング距離の閾値（group_by_phash / group_by_phash_parallelの既定値）
+PHASH_THRESHOLD = 8
+PARALLEL_PHASH_THRESHOLD = 12
+# 近傍ペアからのグループの作り方（hash_index.CLUSTER_MODES参照）。
+# "star"は従来の貪欲法と同じく中心からthreshold未満の要素だけをまとめる
+DEFAULT_CLUSTER_MODE = "star"
+
+def _engine_near_pairs(packed, threshold, engine, bands=None):
+    if engine == "mih":
+        return mih_near_pairs(packed.hashes, threshold, bands)
+    if engine == "bktree":
+        return index_near_pairs(packed, threshold)
+    return blocked_near_pairs(packed.hashes, threshold)
+
+def near_pairs(packed, threshold=8, engine=None, metas=None, tolerances=None, bands=None):
+    """
+    PackedHashesからハミング距離threshold未満（かつメタデータ互換）のペアを列挙する。
+    engine: "blocked" / "mih" / "bktree" / "scan"（None=DEFAULT_GROUP_ENGINE）。どれも同じペアを返す
+    bands: mihのバンド数（None=件数とthresholdから選ぶ）
+    metas指定時は、メタデータが互換になりうるブロックの組（media_metadata.metadata_blocks）の中だけで
+    近傍ペアを求める（互換でない組み合わせのハミング距離は計算しない）。
+    戻り値: (ii, jj) のint64配列（ii < jj）
+    """
+    engine = engine or DEFAULT_GROUP_ENGINE
+    if engine == "scan":
+        meta_filter = MetadataFilter(metas, tolerances) if metas is not None else None
+        return _scan_near_pairs(packed.hashes, threshold, meta_filter)
+    if metas is None:
+        return _engine_near_pairs(packed, threshold, engine, bands)
+    ii = [np.zeros(0, dtype=np.int64)]
+    jj = [np.zeros(0, dtype=np.int64)]
+    for a, b in metadata_blocks(metas, tolerances):
+        if a is b:
+            lo, hi = _engine_near_pairs(PackedHashes([packed.paths[k] for k in a], packed.hashes[a]), threshold, engine, bands)
+            ii.append(a[lo])
+            jj.append(a[hi])
+        else:
+            ia, jb = cross_near_pairs(packed.hashes[a], packed.hashes[b], threshold)
+            ii.append(np.minimum(a[ia], b[jb]))
+            jj.append(np.maximum(a[ia], b[jb]))
+    # ブロックの組は互換になりうるだけなので、最後にペアごとに厳密に判定する
+    return filter_pairs(np.concatenate(ii), np.concatenate(jj), _metadata_compatible_func(metas, tolerances))
+
+def _cluster_paths(paths, ii, jj, mode):
+    # パス順をキーにクラスタリングし、入力順やワーカーの処理順に依らない結果にする
+    return [[paths[i] for i in g] for g in cluster_pairs(len(paths), ii, jj, mode or DEFAULT_CLUSTER_MODE, keys=paths)]
+
+def _legacy_hash_near(h1, h2, threshold):
+    # ImageHash/整数/フレームごとのハッシュリスト同士の近さ判定（比較できない組はFalse）
+    if isinstance(h1, list) and isinstance(h2, list):
+        minlen = min(len(h1), len(h2))
         try:
-            cache_bytes = load_cache(cache_file, key_file)
-            if cache_bytes is not None:
-                try:
-                    cache = pickle.loads(cache_bytes)
-                    break
-                except Exception as e:
-                    if i == 4:
-                        try:
-                            os.remove(cache_file)
-                        except Exception:
-                            pass
-                        cache = {}
-                        break
-                    import time
-                    time.sleep(0.3)
-                    continue
+            dist = sum(h1[k] - h2[k] if hasattr(h1[k], '__sub__') else abs(int(h1[k]) - int(h2[k])) for k in range(minlen))
+            dist = abs(dist)
+        except Exception:
+            return False
+        return dist < threshold * minlen
+    if not isinstance(h1, list) and not isinstance(h2, list):
+        try:
+            if isinstance(h1, (int, np.integer)) and isinstance(h2, (int, np.integer)):
+                diff = hamming_distance(h1, h2)
+            elif hasattr(h1, '__sub__') and hasattr(h2, '__sub__'):
+                diff = abs(h1 - h2)
             else:
-                cache = {}
-                break
-        except FileNotFoundError:
-            cache = {}
-            break
+                diff = abs(int(h1) - int(h2))
         except Exception:
-            cache = {}
-            break
-    if cache is None:
-        cache = {}
-    if filepath in cache:
-        return cache[filepath]
-    result = calc_func(filepath)
-    if result is not None:
-        cache[filepath] = result
-        for _ in range(5):
-            try:
-                save_cache(cache_file, pickle.dumps(cache))
+            return False
+        return diff < threshold
+    return False
+
+def group_by_phash(file_hashes, threshold=PHASH_THRESHOLD, metadata=None, tolerances=None, engine=None, mode=None):
+    """
+    pHashでグループ化する。近傍ペアを列挙し、Union-Findでグループにまとめる（hash_index.cluster_pairs）。
+    metadata: {file: MediaMeta}（またはfile_hashesと同じ並びのリスト）。
+              指定時はメタデータが互換なファイル同士だけ比較する（media_metadata.MetadataFilter）
+    tolerances: メタデータ比較の許容誤差（media_metadata.DEFAULT_TOLERANCES参照）
+    file_hashesは [(file, hash), ...] または PackedHashes(paths, np.uint64配列)。
+    engine: PackedHashesの近傍ペアの計算方式（None=DEFAULT_GROUP_ENGINE）
+    mode: "star"（中心型）/ "connected"（連結成分）（None=DEFAULT_CLUSTER_MODE）
+    グループはパス順に並び、入力順やengineに依らず同じ結果になる。
+    """
+    metas = _align_metadata(file_hashes, metadata)
+    if not isinstance(file_hashes, PackedHashes):
+        packed, packed_metas = _pack_if_64bit(file_hashes, metas)
+        if packed is not None:
+            # 1ペアずつのPythonループを避け、uint64配列のエンジンで計算する
+            file_hashes, metas = packed, packed_metas
+    if isinstance(file_hashes, PackedHashes):
+        ii, jj = near_pairs(file_hashes, threshold, engine, metas, tolerances)
+        return _cluster_paths(file_hashes.paths, ii, jj, mode)
+    meta_filter = MetadataFilter(metas, tolerances) if metas is not None else None
+    ii = []
+    jj = []
+    for i, (_, h1) in enumerate(file_hashes):
+        if h1 is None:
+            continue
+        candidates = meta_filter.candidates(i) if meta_filter is not None else range(i + 1, len(file_hashes))
+        for j in candidates:
+            h2 = file_hashes[j][1]
+            if j > i and h2 is not None and _legacy_hash_near(h1, h2, threshold):
+                ii.append(i)
+                jj.append(j)
+    return _cluster_paths([f for f, _ in file_hashes], ii, jj, mode)
+
+# 並列ワーカーのプロセスごとの状態（_init_pair_workerで1回だけ受け取る）
+_PAIR_WORKER = {}
+
+def _attach_shared_memory(name):
+    # 既存の共有メモリに接続する。unlinkは作成したプロセスが行う
+    # （プールのワーカーは親とresource_trackerを共有するので、接続による登録は重複しない）
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _init_pair_worker(shm_name, n, metas, tolerances, file_hashes=None):
+    # ProcessPoolExecutorのinitializer: ハッシュ配列は共有メモリを参照し、メタデータ等はワーカーごとに1回だけ受け取る
+    _PAIR_WORKER.clear()
+    if shm_name is not None:
+        shm = _attach_shared_memory(shm_name)
+        _PAIR_WORKER["shm"] = shm
+        _PAIR_WORKER["hashes"] = np.ndarray((n,), dtype=np.uint64, buffer=shm.buf)
+    _PAIR_WORKER["file_hashes"] = file_hashes
+    _PAIR_WORKER["compatible"] = _metadata_compatible_func(metas, tolerances)
+
+def _packed_rows_task(args):
+    # start〜end行目それぞれについて、後ろの行でthreshold未満のペアを返す（送るのは行範囲のみ）
+    start, end, threshold = args
+    ii, jj = _scan_near_pairs(_PAIR_WORKER["hashes"], threshold, None, start, end)
+    return filter_pairs(ii, jj, _PAIR_WORKER["compatible"])
+
+def _legacy_rows_task(args):
+    # フレームごとのハッシュリストなど、uint64にできない入力の行範囲をPythonで比較する
+    start, end, threshold = args
+    file_hashes = _PAIR_WORKER["file_hashes"]
+    compatible = _PAIR_WORKER["compatible"]
+    ii = []
+    jj = []
+    for i in range(start, end):
+        h1 = file_hashes[i][1]
+        if h1 is None:
+            continue
+        for j in range(i + 1, len(file_hashes)):
+            h2 = file_hashes[j][1]
+            if h2 is not None and (compatible is None or compatible(i, j)) and _legacy_hash_near(h1, h2, threshold):
+                ii.append(i)
+                jj.append(j)
+    return np.array(ii, dtype=np.int64), np.array(jj, dtype=np.int64)
+
+def _row_blocks(n, max_workers):
+    # 行を(ワーカー数 x 4)個程度の範囲に分ける（後ろの行ほど比較相手が少ないので細かめに分ける）
+    workers = max_workers or os.cpu_count() or 1
+    block = max(1, -(-n // (workers * 4)))
+    return [(s, min(n, s + block)) for s in range(0, n, block)]
+
+def _run_pair_workers(task, n, threshold, max_workers, initargs):
+    ii = [np.zeros(0, dtype=np.int64)]
+    jj = [np.zeros(0, dtype=np.int64)]
+    args_list = [(s, e, threshold) for s, e in _row_blocks(n, max_workers)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_pair_worker, initargs=initargs) as executor:
+        for rows_ii, rows_jj in executor.map(task, args_list):
+            ii.append(rows_ii)
+            jj.append(rows_jj)
+    return np.concatenate(ii), np.concatenate(jj)
+
+def _packed_pairs_parallel(packed, threshold, max_workers, metas, tolerances):
+    # ハッシュ配列は共有メモリに1回だけ置き、各タスクには行範囲だけを送る
+    n = len(packed.paths)
+    shm = shared_memory.SharedMemory(create=True, size=max(8, n * 8))
+    try:
+        np.ndarray((n,), dtype=np.uint64, buffer=shm.buf)[:] = packed.hashes
+        return _run_pair_workers(_packed_rows_task, n, threshold, max_workers, (shm.name, n, metas, tolerances))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def group_by_phash_parallel(file_hashes, threshold=PARALLEL_PHASH_THRESHOLD, max_workers=None, metadata=None, tolerances=None, engine="scan", bands=None, mode=None):
+    """
+    pHashでグループ化する（近傍ペアの計算を並列化する）。
+    engine: PackedHashesの近傍ペアの計算方式。"scan"=行ブロックをプロセス並列で総当たり,
+            "mih"=バンドごとの半径検索の候補ペアのみ検証（bands: バンド数。None=自動。どれも総当たりと同じ結果）,
+            "blocked"=タイル分割した距離行列を1プロセスで計算
+    mode: group_by_phashと同じ。同じthreshold・modeならgroup_by_phashと同じグループを返す。
+    64bitハッシュの [(file, hash), ...] はPackedHashesに変換して同じエンジンで計算する。
+    """
+    metas = _align_metadata(file_hashes, metadata)
+    if not isinstance(file_hashes, PackedHashes):
+        packed, packed_metas = _pack_if_64bit(file_hashes, metas)
+        if packed is not None:
+            file_hashes, metas = packed, packed_metas
+    if isinstance(file_hashes, PackedHashes):
+        if engine == "scan":
+            ii, jj = _packed_pairs_parallel(file_hashes, threshold, max_workers, metas, tolerances)
+        else:
+            ii, jj = near_pairs(file_hashes, threshold, engine, metas, tolerances, bands)
+        return _cluster_paths(file_hashes.paths, ii, jj, mode)
+    # ハッシュリストは共有メモリに載せられないため、ワーカーごとに1回だけ渡して行範囲を送る
+    ii, jj = _run_pair_workers(_legacy_rows_task, len(file_hashes), threshold, max_workers, (None, 0, metas, tolerances, file_hashes))
+    paths = [f for f, _ in file_hashes]
+    return _cluster_paths(paths, ii, jj, mode)
+
+def build_incremental_grouper(packed, copies=None, threshold=PHASH_THRESHOLD, metadata=None, tolerances=None, mode=None):
+    """
+    PackedHashesからIncrementalGrouperを作る。
+    copies: {代表ファイル: [完全一致のコピー, ...]}。コピーは代表と同じハッシュで登録する
+    metadata: {file: MediaMeta}。コピーは代表ファイルのメタデータで比較する
+    """
+    copies = copies or {}
+    hash_of = dict(zip(packed.paths, packed.hashes))
+    paths = list(packed.paths) + [c for f, cs in copies.items() if f in hash_of for c in cs]
+    rep_of = {c: f for f, cs in copies.items() for c in cs}
+    hashes = np.array([hash_of[rep_of.get(p, p)] for p in paths], dtype=np.uint64)
+    compatible = None
+    if metadata is not None:
+        def compatible(a, b):
+            return metadata_compatible(metadata.get(rep_of.get(a, a)), metadata.get(rep_of.get(b, b)), tolerances)
+    return IncrementalGrouper(paths, hashes, threshold, mode or DEFAULT_CLUSTER_MODE, compatible)
+
+def multihash_match(sig1, sig2, thresholds=None, mode="all"):
+    """
+    2つの複数ハッシュ署名が一致するか判定する。両方に存在する種別のみ比較する。
+    mode: "all"=全種別がしきい値未満, "any"=いずれか, "majority"=過半数
+    """
+    if thresholds is None:
+        thresholds = DEFAULT_HASH_THRESHOLDS
+    hits = 0
+    total = 0
+    for name, h1 in sig1.items():
+        h2 = sig2.get(name)
+        if h2 is None or name not in thresholds:
+            continue
+        total += 1
+        if h1 - h2 < thresholds[name]:
+            hits += 1
+    if total == 0:
+        return False
+    if mode == "any":
+        return hits > 0
+    if mode == "majority":
+        return hits * 2 > total
+    return hits == total
+
+def _multihash_candidate_pairs(file_sigs, thresholds, mode):
+    """
+    multihash_matchが一致しうるペアの候補 (ii, jj)（ii < jj）。
+    一致にはいずれかの種別がしきい値未満である必要があるため、種別ごとの近傍ペアの和集合で足りる。
+    "all"では全署名に共通する種別が1つあれば、その種別の近傍ペアだけで足りる。
+    64bitの種別はuint64配列のエンジン(blocked_near_pairs)で求め、それ以外（colorhashなど）は全ペアを候補にする。
+    """
+    n = len(file_sigs)
+    names = [name for name in thresholds if any(name in s for _, s in file_sigs)]
+    packed = {}
+    for name in names:
+        idx = [i for i, (_, s) in enumerate(file_sigs) if name in s]
+        packed[name] = (np.array(idx, dtype=np.int64), _pack_if_64bit([(i, file_sigs[i][1][name]) for i in idx])[0])
+    if mode == "all":
+        common = [name for name in names if len(packed[name][0]) == n]
+        if common:
+            # 64bitの種別を優先する
+            names = [next((name for name in common if packed[name][1] is not None), common[0])]
+    pairs = [np.zeros(0, dtype=np.int64)]
+    for name in names:
+        idx, hashes = packed[name]
+        if hashes is not None:
+            ii, jj = blocked_near_pairs(hashes.hashes, thresholds[name])
+        else:
+            ii, jj = np.triu_indices(len(idx), 1)
+        pairs.append(idx[ii] * n + idx[jj])
+    codes = np.unique(np.concatenate(pairs))
+    return codes // max(n, 1), codes % max(n, 1)
+
+def group_by_multihash(file_sigs, thresholds=None, mode="all", cluster_mode=None):
+    """
+    複数ハッシュ署名でグループ化する。
+    種別ごとの近傍ペア（pHashなどはuint64配列のエンジン）を候補にし、候補だけmultihash_matchで判定して
+    Union-Findでグループにまとめる（hash_index.cluster_pairs）。グループはパス順に並び、入力順に依らない。
+    file_sigs: [(file, {種別: ImageHash}), ...]
+    cluster_mode: "star"（中心型）/ "connected"（連結成分）（None=DEFAULT_CLUSTER_MODE）
+    """
+    if thresholds is None:
+        thresholds = DEFAULT_HASH_THRESHOLDS
+    file_sigs = [(f, s) for f, s in file_sigs if s]
+    ii, jj = _multihash_candidate_pairs(file_sigs, thresholds, mode)
+    keep = np.array([multihash_match(file_sigs[i][1], file_sigs[j][1], thresholds, mode)
+                     for i, j in zip(ii.tolist(), jj.tolist())], dtype=bool)
+    return _cluster_paths([f for f, _ in file_sigs], ii[keep], jj[keep], cluster_mode)
+
+# 完全一致判定で先頭・末尾から読むブロックサイズと、全体ハッシュの読み込み単位
+PARTIAL_HASH_BLOCK = 64 * 1024
+FULL_HASH_CHUNK = 1024 * 1024
+
+def partial_file_hash(path, block=PARTIAL_HASH_BLOCK):
+    """
+    ファイル先頭・末尾blockバイトのBLAKE2ハッシュ（ファイルサイズも含める）。
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+    with open(path, "rb") as f:
+        h.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            h.update(f.read(block))
+    return h.hexdigest()
+
+def full_file_hash(path, chunk=FULL_HASH_CHUNK):
+    """
+    ファイル全体のBLAKE2ハッシュ。
+    """
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
                 break
-            except Exception:
-                import time
-                time.sleep(0.2)
-    return result
+            h.update(data)
+    return h.hexdigest()
 
-def group_by_phash(file_hashes, threshold=8):
-    groups = []
-    used = set()
-    for i, (f1, h1) in enumerate(file_hashes):
-        if f1 in used or h1 is None:
+def _split_by(files, key_func):
+    # key_funcの値ごとにまとめ、2件以上のグループのみ返す（読めないファイルは除外）
+    buckets = {}
+    for f in files:
+        try:
+            key = key_func(f)
+        except Exception:
             continue
-        group = [f1]
-        for j, (f2, h2) in enumerate(file_hashes):
-            if i != j and f2 not in used and h2 is not None:
-                if isinstance(h1, list) and isinstance(h2, list):
-                    minlen = min(len(h1), len(h2))
-                    try:
-                        dist = sum(h1[k] - h2[k] if hasattr(h1[k], '__sub__') else abs(int(h1[k]) - int(h2[k])) for k in range(minlen))
-                        dist = abs(dist)
-                    except Exception:
-                        continue
-                    if dist < threshold * minlen:
-                        group.append(f2)
-                        used.add(f2)
-                elif not isinstance(h1, list) and not isinstance(h2, list):
-                    try:
-                        if hasattr(h1, '__sub__') and hasattr(h2, '__sub__'):
-                            diff = abs(h1 - h2)
-                        else:
-                            diff = abs(int(h1) - int(h2))
-                        if diff < threshold:
-                            group.append(f2)
-                            used.add(f2)
-                    except Exception:
-                        continue
-        used.add(f1)
-        if len(group) > 1:
-            groups.append(group)
+        buckets.setdefault(key, []).append(f)
+    return [g for g in buckets.values() if len(g) > 1]
+
+# 完全一致判定のダイジェストを特徴量ストアに保存する種類名（先頭・末尾のブロックサイズが既定以外なら名前に含める）
+PARTIAL_HASH_FEATURE = "partial_hash"
+FULL_HASH_FEATURE = "full_hash"
+
+def _cached_digests(store, files, keys, signatures, feature, calc):
+    """
+    ファイルのダイジェストを特徴量ストア経由で求める（署名が変わらないファイルは読み直さない）。
+    戻り値: {file: ダイジェスト}（読めないファイルは含まない）
+    """
+    found = store.get_many([keys[f] for f in files], feature, signatures)
+    digests = {}
+    computed = []
+    for f in files:
+        key = keys[f]
+        if key in found:
+            digests[f] = found[key]
+            continue
+        try:
+            digests[f] = calc(f)
+        except Exception:
+            continue
+        if signatures.get(key) is not None:
+            computed.append((key, digests[f]))
+    # ダイジェスト自体が内容で決まるので、内容の指紋は記録しない
+    store.put_many(computed, feature, signatures, {})
+    return digests
+
+def find_exact_duplicates(files, block=PARTIAL_HASH_BLOCK):
+    """
+    バイト単位で同一のファイルグループを検出する。
+    サイズ → 先頭・末尾ブロックのハッシュ → 全体ハッシュの順に絞り込み、
+    全体ハッシュはそれまでの段階で衝突したファイルだけ計算する。
+    ハッシュは署名と一緒に特徴量ストアに保存し、変更されていないファイルは次回から読まない。
+    戻り値: [[file, ...], ...]（各グループ内はfilesと同じ順序）
+    """
+    store = get_feature_store()
+    keys = {f: normalize_path(f) for f in files}
+    signatures = stat_signatures(list(keys.values()))
+    def size_of(f):
+        sig = signatures.get(keys[f])
+        return sig[0] if sig is not None else os.path.getsize(f)
+    partial_feature = PARTIAL_HASH_FEATURE if block == PARTIAL_HASH_BLOCK else f"{PARTIAL_HASH_FEATURE}_{block}"
+    groups = []
+    try:
+        for same_size in _split_by(files, size_of):
+            size = size_of(same_size[0])
+            if size == 0:
+                continue
+            partial = _cached_digests(store, same_size, keys, signatures, partial_feature, lambda f: partial_file_hash(f, block))
+            for same_partial in _split_by(same_size, partial.__getitem__):
+                if size <= block * 2:
+                    # 先頭・末尾ブロックでファイル全体を読み終えている
+                    groups.append(same_partial)
+                else:
+                    full = _cached_digests(store, same_partial, keys, signatures, FULL_HASH_FEATURE, full_file_hash)
+                    groups.extend(_split_by(same_partial, full.__getitem__))
+    finally:
+        store.flush()
     return groups
 
-def find_group_for_index(args):
-    i, (f1, h1), file_hashes, threshold = args
-    if h1 is None:
-        return None
-    group = [f1]
-    for j, (f2, h2) in enumerate(file_hashes):
-        if i != j and h2 is not None:
-            if isinstance(h1, list) and isinstance(h2, list):
-                minlen = min(len(h1), len(h2))
-                try:
-                    dist = sum(h1[k] - h2[k] if hasattr(h1[k], '__sub__') else abs(int(h1[k]) - int(h2[k])) for k in range(minlen))
-                    dist = abs(dist)
-                except Exception:
-                    continue
-                if dist < threshold * minlen:
-                    group.append(f2)
-            elif not isinstance(h1, list) and not isinstance(h2, list):
-                try:
-                    if hasattr(h1, '__sub__') and hasattr(h2, '__sub__'):
-                        diff = abs(h1 - h2)
-                    else:
-                        diff = abs(int(h1) - int(h2))
-                    if diff < threshold:
-                        group.append(f2)
-                except Exception:
-                    continue
-    if len(group) > 1:
-        return set(group)
-    return None
-
-def group_by_phash_parallel(file_hashes, threshold=12, max_workers=None):
-    args_list = [(i, fh, file_hashes, threshold) for i, fh in enumerate(file_hashes)]
-    group_candidates = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=12) as executor:
-        for res in executor.map(find_group_for_index, args_list, chunksize=128):
-            if res:
-                group_candidates.append(res)
-    final_groups = []
-    used = set()
-    for group in group_candidates:
-        group = group - used
-        if len(group) > 1:
-            final_groups.append(list(group))
-            used.update(group)
-    return final_groups
-
-def get_image_and_video_files(folder, image_exts=(".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"), video_exts=(".mp4", ".avi", ".mov", ".mkv", ".wmv", ".flv", ".webm", ".mpg", ".mpeg", ".3gp")):
+def get_image_and_video_files(folder, image_exts=IMAGE_EXTS, video_exts=VIDEO_EXTS):
     files = []
     for root, dirs, fs in os.walk(folder):
         for f in fs:
@@ -234,32 +1042,82 @@ def get_image_and_video_files(folder, image_exts=(".jpg", ".jpeg", ".png", ".bmp
                 files.append(os.path.join(root, f))
     return files
 
-def find_duplicates_in_folder(folder, progress_bar=None, progress_callback=None, parallel=True):
-    image_exts = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff")
-    video_exts = (".mp4", ".avi", ".mov", ".mkv", ".wmv", ".flv", ".webm", ".mpg", ".mpeg", ".3gp")
+def find_duplicates_in_folder(folder, progress_bar=None, progress_callback=None, parallel=True, max_workers=None, fast_decode=False, hash_types=None, hash_thresholds=None, hash_mode="all", exact_first=True, exact_callback=None, metadata_filter=True, metadata_tolerances=None, return_index=False):
+    """
+    フォルダ内の画像・動画の重複グループを検出する。
+    max_workers: pHash抽出・グループ化に使うプロセス数（None=CPU数）
+    fast_decode: 画像を縮小デコードしてpHashを計算する（compare_decode_modesで差を確認できる）
+    hash_types: 指定時は複数ハッシュ署名（例: ("phash", "dhash")）で判定する。
+                hash_thresholds/hash_modeはgroup_by_multihashに渡される
+    exact_first: 先にバイト単位の完全一致を検出し、各グループの先頭1件だけpHashを計算する
+    exact_callback: 完全一致グループ検出直後に exact_callback(groups) で通知する
+    metadata_filter: 解像度比・再生時間などのメタデータが互換なファイル同士だけ比較する
+    metadata_tolerances: メタデータ比較の許容誤差（media_metadata.DEFAULT_TOLERANCES参照）
+    return_index: Trueなら戻り値の2番目にhash_index.IncrementalGrouperを返す（ファイル削除・追加時の
+                  再グループ化と類似検索用）。このときグループはIncrementalGrouperから作り、
+                  完全一致のコピーは代表ファイルと同じハッシュ（距離0）のファイルとして扱う
+    戻り値: (グループのリスト, None or IncrementalGrouper)。pHash計算に失敗したファイルは最後のグループにまとめる。
+    """
+    image_exts = IMAGE_EXTS
+    video_exts = VIDEO_EXTS
     files = get_image_and_video_files(folder, image_exts, video_exts)
-    file_hashes = []
-    total = len(files)
-    for idx, f in enumerate(files):
-        ext = os.path.splitext(f)[1].lower()
-        if ext in image_exts:
-            h = get_image_phash(f, folder)
-        else:
-            h = get_video_phash(f, 7, folder)
-        file_hashes.append((f, h))
-        if progress_callback is not None:
-            progress_callback(idx+1, total)
-        elif progress_bar is not None:
-            progress_bar.setValue(int((idx+1)/total*100))
-    # pHashがNoneのファイルを抽出
-    error_files = [f for f, h in file_hashes if h is None]
+    # 完全一致グループ: 代表ファイル -> 残りのコピー
+    copies = {}
+    if exact_first:
+        # パス順に並べ、代表ファイル（先頭）がフォルダの列挙順に依らないようにする
+        exact_groups = sorted(sorted(g) for g in find_exact_duplicates(files))
+        if exact_callback is not None and exact_groups:
+            exact_callback(exact_groups)
+        for g in exact_groups:
+            copies[g[0]] = g[1:]
+        skip = set(f for g in exact_groups for f in g[1:])
+        files = [f for f in files if f not in skip]
+    extract_kwargs = dict(
+        image_exts=image_exts,
+        progress_callback=progress_callback,
+        progress_bar=progress_bar,
+        max_workers=max_workers if parallel else 1,
+        fast_decode=fast_decode,
+        # メタデータはハッシュと同じ署名の一括取得でキャッシュから読む（キャッシュ済みのファイルは開かない）
+        metadata={} if metadata_filter else None,
+    )
+    metadata = extract_kwargs["metadata"]
+    if hash_types:
+        file_hashes = extract_phashes(files, folder, hash_types=hash_types, **extract_kwargs)
+        # 署名がNoneのファイルを抽出
+        error_files = [f for f, h in file_hashes if h is None]
+        valid_file_hashes = [(f, h) for f, h in file_hashes if h is not None]
+        valid_files = [f for f, _ in valid_file_hashes]
+    else:
+        # pHashはpaths + np.uint64配列(PackedHashes)のまま扱う
+        valid_file_hashes, error_files = extract_packed_phashes(files, folder, **extract_kwargs)
+        valid_files = valid_file_hashes.paths
     # グループ化
-    valid_file_hashes = [(f, h) for f, h in file_hashes if h is not None]
-    if parallel and len(valid_file_hashes) > 100:
-        groups = group_by_phash_parallel(valid_file_hashes)
+    threshold = PARALLEL_PHASH_THRESHOLD if parallel and len(valid_files) > 100 else PHASH_THRESHOLD
+    index = None
+    if return_index and not hash_types:
+        # 削除・追加時に再計算できるよう、同じ閾値・メタデータ条件でインクリメンタルなグループを作る
+        index = build_incremental_grouper(valid_file_hashes, copies, threshold, metadata, metadata_tolerances)
+        groups = index.groups()
+        error_files = [x for f in error_files for x in [f] + copies.get(f, [])]
+        if error_files:
+            groups.append(error_files)
+        return groups, index
+    if hash_types:
+        groups = group_by_multihash(valid_file_hashes, hash_thresholds, hash_mode)
+    elif threshold == PARALLEL_PHASH_THRESHOLD:
+        groups = group_by_phash_parallel(valid_file_hashes, threshold, max_workers=max_workers, metadata=metadata, tolerances=metadata_tolerances)
     else:
-        groups = group_by_phash(valid_file_hashes)
+        groups = group_by_phash(valid_file_hashes, threshold, metadata=metadata, tolerances=metadata_tolerances)
+    if copies:
+        # 代表ファイルのコピーをグループに戻す。類似グループに入らなかった完全一致は単独グループにする
+        grouped = set(f for g in groups for f in g)
+        groups = [[x for f in g for x in [f] + copies.get(f, [])] for g in groups]
+        exact_only = [[f] + c for f, c in copies.items() if f not in grouped and f not in error_files]
+        # pHashのグループと同じくグループ内・グループ間ともパス順にする（return_index=Trueの結果と同じ並び）
+        groups = sorted(sorted(g) for g in exact_only + groups)
+        error_files = [x for f in error_files for x in [f] + copies.get(f, [])]
     # エラー（未分類）ファイルを一番下に追加
     if error_files:
         groups.append(error_files)
-    return groups, None
+    return groups, index
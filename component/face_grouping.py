@@ -7,7 +7,7 @@ face_grouping.py
 - 類似顔グループごとのディレクトリ移動
 
 依存:
-- face_recognition, os, shutil
+- face_recognition, os, shutil, component.face_index
 """
 
 import os
@@ -16,14 +16,17 @@ try:
     import face_recognition
 except ImportError:
     face_recognition = None
+from component.face_index import group_face_encodings
 from component.thumbnail.thumbnail_util import get_thumbnail_for_file, pil_image_to_qpixmap
 from PyQt5.QtWidgets import QGroupBox, QVBoxLayout, QGridLayout, QLabel, QPushButton, QWidget, QDialog, QDialogButtonBox
 from PyQt5.QtCore import Qt
 
+# 同じ人物とみなす顔特徴量のユークリッド距離（face_recognition.face_distance）
+FACE_DISTANCE_THRESHOLD = 0.5
+
 def get_face_groups(file_list):
     if face_recognition is None:
         raise ImportError("face_recognitionライブラリが必要です")
-    groups = []
     encodings = []
     for f in file_list:
         try:
@@ -33,20 +36,9 @@ def get_face_groups(file_list):
                 encodings.append((f, faces[0]))
         except Exception:
             continue
-    used = set()
-    for i, (f1, enc1) in enumerate(encodings):
-        if f1 in used:
-            continue
-        group = [f1]
-        used.add(f1)
-        for j, (f2, enc2) in enumerate(encodings):
-            if i != j and f2 not in used:
-                dist = face_recognition.face_distance([enc1], enc2)[0]
-                if dist < 0.5:
-                    group.append(f2)
-                    used.add(f2)
-        groups.append(group)
-    return groups
+    # 顔特徴量のインデックスで近傍ペアを一括で求め、従来と同じ貪欲法でまとめる（近い顔の無い画像も1件のグループ）
+    groups = group_face_encodings([enc for _, enc in encodings], FACE_DISTANCE_THRESHOLD, singletons=True)
+    return [[encodings[i][0] for i in group] for group in groups]
 
 def group_by_face_and_move(file_list, out_dir):
     groups = get_face_groups(file_list)
@@ -0,0 +1,217 @@
+"""
+face_index.py
+顔特徴量（128次元の顔エンコーディング）の近似最近傍インデックスと顔グループ化。
+
+主な機能:
+- k-meansの粗い量子化による転置リスト（IVF）インデックス
+- 近いnprobe個のリストだけを比較する一括半径検索（候補の距離は行列積で一括計算）
+- ユークリッド距離（face_recognition.face_distance）/ コサイン距離の両対応
+- 近傍ペアからの顔グループ化（従来の貪欲法と同じ規則）
+
+依存:
+- numpy, component.hash_index
+"""
+
+import numpy as np
+from component.hash_index import cluster_pairs
+
+FACE_METRICS = ("euclidean", "cosine")
+# 各エンコーディングと比較するリスト数（自分のリストを含む）。大きいほど取りこぼしが減り遅くなる
+FACE_INDEX_NPROBE = 8
+# k-meansの学習に使う件数（リスト1つあたり）と反復回数
+FACE_INDEX_TRAIN_PER_LIST = 32
+FACE_INDEX_KMEANS_ITER = 8
+# 距離行列を一度に計算する行数
+FACE_INDEX_BLOCK = 1024
+# float32での候補判定の余裕（境界付近のペアはfloat64で判定し直す）
+_CANDIDATE_SLACK = 1e-3
+
+def _sq_norms(x):
+    return np.einsum("ij,ij->i", x, x)
+
+def _sq_dist(a, b, a_sq, b_sq):
+    # ||a - b||^2 = |a|^2 + |b|^2 - 2a・b を行列積で一括計算する
+    d = a @ b.T
+    d *= -2.0
+    d += a_sq[:, None]
+    d += b_sq[None, :]
+    return d
+
+def _nearest_lists(x, centroids, count):
+    """
+    各行に近いセントロイドをcount個（近い順）返す。
+    """
+    c_sq = _sq_norms(centroids)
+    out = np.empty((len(x), count), dtype=np.int64)
+    for s in range(0, len(x), FACE_INDEX_BLOCK):
+        block = x[s:s + FACE_INDEX_BLOCK]
+        d = _sq_dist(block, centroids, _sq_norms(block), c_sq)
+        if count == 1:
+            out[s:s + len(block), 0] = np.argmin(d, axis=1)
+            continue
+        part = np.argpartition(d, count - 1, axis=1)[:, :count]
+        order = np.argsort(np.take_along_axis(d, part, axis=1), axis=1)
+        out[s:s + len(block)] = np.take_along_axis(part, order, axis=1)
+    return out
+
+def _train_centroids(x, nlist, rng):
+    # 標本に対するk-means（割り当てを行列積で計算する）
+    sample = x[rng.choice(len(x), min(len(x), nlist * FACE_INDEX_TRAIN_PER_LIST), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(FACE_INDEX_KMEANS_ITER):
+        labels = _nearest_lists(sample, centroids, 1)[:, 0]
+        counts = np.bincount(labels, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        used = counts > 0
+        centroids[used] = sums[used] / counts[used, None]
+    return centroids
+
+class FaceIndex:
+    """
+    顔エンコーディングのIVFインデックス。
+    各エンコーディングを最寄りのセントロイドのリストに入れ、セントロイドが近いnprobe個のリストの
+    要素とだけ距離を計算する（近似。nprobe >= リスト数なら総当たりと同じ結果）。
+    候補の距離はfloat32の行列積で求め、閾値付近はfloat64で元の距離の式により判定し直す。
+    metric: "euclidean"（face_recognition.face_distanceと同じ）または "cosine"（1 - コサイン類似度）。
+    """
+    def __init__(self, encodings, metric="euclidean", nlist=None, nprobe=FACE_INDEX_NPROBE, seed=0):
+        if metric not in FACE_METRICS:
+            raise ValueError(f"unknown metric: {metric}")
+        self.metric = metric
+        self.vectors = self._prepare(encodings)
+        self.vectors32 = self.vectors.astype(np.float32)
+        self.sq_norms32 = _sq_norms(self.vectors32)
+        n = len(self.vectors)
+        # リスト数は2√n（10万件・nprobe=8で、総当たりの近傍ペアの約98%を見つける）
+        nlist = min(nlist or max(1, int(2 * np.sqrt(n))), max(n, 1))
+        self.nprobe = max(1, min(nprobe, nlist))
+        if n == 0:
+            self.centroids = np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+            self.lists = []
+            return
+        rng = np.random.default_rng(seed)
+        self.centroids = _train_centroids(self.vectors32, nlist, rng) if nlist > 1 else self.vectors32.mean(axis=0, keepdims=True)
+        labels = _nearest_lists(self.vectors32, self.centroids, 1)[:, 0]
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(nlist + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(nlist)]
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _prepare(self, encodings):
+        x = np.asarray(encodings, dtype=np.float64).reshape(len(encodings), -1)
+        if self.metric == "cosine":
+            # 単位ベクトルにすると cos距離 = ユークリッド距離^2 / 2 になり、同じ検索で扱える
+            norms = np.linalg.norm(x, axis=1, keepdims=True)
+            x = x / np.where(norms > 0, norms, 1.0)
+        return x
+
+    def _sq_radius(self, threshold):
+        # 閾値を単位ベクトル間のユークリッド距離^2に変換する
+        r2 = 2.0 * threshold if self.metric == "cosine" else threshold * threshold
+        return r2 * (1 + _CANDIDATE_SLACK) + _CANDIDATE_SLACK
+
+    def distances(self, a, b, queries=None):
+        """
+        インデックスa（またはqueries[a]）とインデックスbの組ごとの距離（float64, 元の距離の式）。
+        """
+        left = self.vectors[a] if queries is None else queries[a]
+        right = self.vectors[b]
+        if self.metric == "cosine":
+            return np.clip(1.0 - np.einsum("ij,ij->i", left, right), 0.0, 2.0)
+        return np.linalg.norm(left - right, axis=1)
+
+    def _probe_pairs(self):
+        # 比較するリストの組 (a, b)（a <= b）。どちらかのnprobe近傍に相手が入っていれば比較する
+        near = _nearest_lists(self.centroids, self.centroids, self.nprobe)
+        a = np.repeat(np.arange(len(self.centroids)), self.nprobe)
+        b = near.ravel()
+        pairs = np.unique(np.stack([np.minimum(a, b), np.maximum(a, b)], axis=1), axis=0)
+        return pairs
+
+    def radius_pairs(self, threshold):
+        """
+        距離がthreshold未満のペアを返す。
+        戻り値: (ii, jj) のint64配列（ii < jj, 辞書順）
+        """
+        ii = [np.zeros(0, dtype=np.int64)]
+        jj = [np.zeros(0, dtype=np.int64)]
+        r2 = self._sq_radius(threshold)
+        pairs = self._probe_pairs() if self.lists else np.zeros((0, 2), dtype=np.int64)
+        # リストaごとに、組になる全リストの要素をまとめて1回の行列積で比較する
+        starts = np.searchsorted(pairs[:, 0], np.arange(len(self.lists) + 1))
+        for a, members_a in enumerate(self.lists):
+            partners = pairs[starts[a]:starts[a + 1], 1]
+            members_b = np.concatenate([self.lists[b] for b in partners]) if len(partners) else members_a[:0]
+            if len(members_a) == 0 or len(members_b) == 0:
+                continue
+            for s in range(0, len(members_a), FACE_INDEX_BLOCK):
+                rows = members_a[s:s + FACE_INDEX_BLOCK]
+                d = _sq_dist(self.vectors32[rows], self.vectors32[members_b], self.sq_norms32[rows], self.sq_norms32[members_b])
+                ri, ci = np.nonzero(d < r2)
+                gi, gj = rows[ri], members_b[ci]
+                keep = gi != gj
+                ii.append(np.minimum(gi[keep], gj[keep]))
+                jj.append(np.maximum(gi[keep], gj[keep]))
+        ii = np.concatenate(ii)
+        jj = np.concatenate(jj)
+        if len(ii):
+            # 同じリスト内のペアは両方向に現れるので重複を除く
+            pairs = np.unique(np.stack([ii, jj], axis=1), axis=0)
+            ii, jj = pairs[:, 0], pairs[:, 1]
+        keep = self.distances(ii, jj) < threshold
+        return ii[keep], jj[keep]
+
+    def query_radius(self, queries, threshold):
+        """
+        クエリ（複数）それぞれについて、距離がthreshold未満のエンコーディングを一括で検索する。
+        戻り値: [np.int64配列（インデックス昇順）, ...]（クエリと同じ並び）
+        """
+        q = self._prepare(queries)
+        if len(q) == 0 or not self.lists:
+            return [np.zeros(0, dtype=np.int64) for _ in range(len(q))]
+        q32 = q.astype(np.float32)
+        q_sq = _sq_norms(q32)
+        r2 = self._sq_radius(threshold)
+        probe = _nearest_lists(q32, self.centroids, self.nprobe)
+        qi = [np.zeros(0, dtype=np.int64)]
+        hj = [np.zeros(0, dtype=np.int64)]
+        # 同じリストを調べるクエリをまとめて比較する
+        for c in np.unique(probe):
+            rows = np.flatnonzero((probe == c).any(axis=1))
+            members = self.lists[c]
+            if len(members) == 0:
+                continue
+            d = _sq_dist(q32[rows], self.vectors32[members], q_sq[rows], self.sq_norms32[members])
+            ri, ci = np.nonzero(d < r2)
+            qi.append(rows[ri])
+            hj.append(members[ci])
+        qi = np.concatenate(qi)
+        hj = np.concatenate(hj)
+        keep = self.distances(qi, hj, q) < threshold
+        qi, hj = qi[keep], hj[keep]
+        order = np.lexsort((hj, qi))
+        qi, hj = qi[order], hj[order]
+        bounds = np.searchsorted(qi, np.arange(len(q) + 1))
+        return [hj[bounds[k]:bounds[k + 1]] for k in range(len(q))]
+
+def group_face_encodings(encodings, threshold=0.5, metric="euclidean", singletons=False, mode="star", nprobe=FACE_INDEX_NPROBE):
+    """
+    顔エンコーディングを距離threshold未満でグループ化する。Noneのエンコーディングは除く。
+    mode="star"（既定）は従来の貪欲法（並び順で先頭を中心に、未所属の近い顔を取り込む）と同じ規則。
+    singletons: Trueなら近い顔の無いエンコーディングも1件のグループとして返す
+    戻り値: [[index, ...], ...]（先頭要素の並び順）
+    """
+    valid = [i for i, e in enumerate(encodings) if e is not None]
+    if not valid:
+        return []
+    index = FaceIndex([encodings[i] for i in valid], metric, nprobe=nprobe)
+    ii, jj = index.radius_pairs(threshold)
+    groups = [[valid[k] for k in g] for g in cluster_pairs(len(valid), ii, jj, mode)]
+    if singletons:
+        grouped = set(i for g in groups for i in g)
+        groups += [[i] for i in valid if i not in grouped]
+        groups.sort(key=lambda g: g[0])
+    return groups
@@ -5,7 +5,7 @@ PyQt5ベースの重複動画・画像検出/管理アプリのメインGUIク
 主な機能:
 - メインウィンドウ・UI部品の構築
 - サムネイルキャッシュ管理・手動クリア
-- 重複検出・AI修復・壊れ動画チェック等の機能呼び出し
+- 重複検出・類似ファイル検索・AI修復・壊れ動画チェック等の機能呼び出し
 - 進捗・エラー通知・ユーザー操作全般
 
 依存:
@@ -39,7 +39,7 @@ from PyQt5.QtGui import QPixmap, QImage, QIcon
 from PyQt5.QtCore import Qt, QSize, QTimer, QAbstractListModel, QModelIndex, QVariant, pyqtSignal
 from queue import Queue
 
-from component.duplicate_finder import find_duplicates_in_folder, get_image_and_video_files
+from component.duplicate_finder import find_duplicates_in_folder, get_image_and_video_files, get_image_phash, get_video_phash, IMAGE_EXTS, VIDEO_EXTS
 from component.thumbnail.thumbnail_util import (
     start_thumbnail_workers, pil_image_to_qpixmap, load_thumb_cache, save_thumb_cache
 )
@@ -50,7 +50,8 @@ from component.ffmpeg_util import show_mp4_tool_dialog, repair_mp4, convert_mp4
 from component.ai.ai_tools import digital_repair
 from component.ui_util import show_detail_dialog, show_compare_dialog, add_thumbnail_widget, update_progress, drag_enter_event, drop_event, delete_selected_dialog, get_save_file_path, show_info_dialog, show_warning_dialog, show_question_dialog
 from component.group_ui import create_duplicate_group_ui, show_face_grouping_dialog, move_selected_files_to_folder, show_broken_video_dialog
-from component.thumbnail.thumbnail_util import ThumbnailCache, get_thumbnail_for_file
+from component.thumbnail.thumbnail_util import ThumbnailCache, get_thumbnail_for_file, compact_thumbnail_cache
+from component.utils.feature_store import get_feature_store
 
 from .gui_thumbnail import ThumbnailListModel
 from .gui_dialogs import show_progress_dialog
@@ -69,6 +70,7 @@ class DuplicateFinderGUI(QWidget):
         self.current_page = 0
         self.groups_per_page = 50  # ← ここをinit_ui()より前に移動
         self.duplicate_groups = []
+        self.hash_index = None  # 直近の重複チェックで作ったIncrementalGrouper（削除時の再グループ化・類似検索用）
         self.thumb_queue = Queue()
         self.thumb_cache = None
         self.thumb_widget_map = {}
@@ -158,11 +160,21 @@ class DuplicateFinderGUI(QWidget):
         self.mp4_tool_btn.setStyleSheet("font-size:16px;color:#ffb300;border:2px solid #ffb300;border-radius:8px;padding:8px;")
         self.mp4_tool_btn.clicked.connect(lambda: self.show_mp4_tool_dialog())
         btn_hbox.addWidget(self.mp4_tool_btn)
+        # --- 類似ファイル検索ボタン（直近の重複チェックのpHashインデックスを使う） ---
+        self.similar_btn = QPushButton("類似ファイル検索")
+        self.similar_btn.setStyleSheet("font-size:16px;color:#00ffe7;border:2px solid #00ffe7;border-radius:8px;padding:8px;")
+        self.similar_btn.clicked.connect(lambda: self.show_similar_files())
+        btn_hbox.addWidget(self.similar_btn)
         # --- サムネイルキャッシュ削除ボタン ---
         self.clear_thumb_cache_btn = QPushButton("サムネイルキャッシュ削除")
         self.clear_thumb_cache_btn.setStyleSheet("font-size:14px;color:#fff;background:#444;border:1px solid #00ffe7;border-radius:6px;padding:4px 8px;")
         self.clear_thumb_cache_btn.clicked.connect(lambda: self.clear_thumb_cache())
         btn_hbox.addWidget(self.clear_thumb_cache_btn)
+        # --- キャッシュ整理ボタン（消えたファイルの項目を削除して縮める） ---
+        self.compact_cache_btn = QPushButton("キャッシュ整理")
+        self.compact_cache_btn.setStyleSheet("font-size:14px;color:#fff;background:#444;border:1px solid #00ffe7;border-radius:6px;padding:4px 8px;")
+        self.compact_cache_btn.clicked.connect(lambda: self.compact_caches())
+        btn_hbox.addWidget(self.compact_cache_btn)
         layout.addLayout(btn_hbox)
         # --- フォルダラベル・選択ボタン ---
         self.folder_label = QLabel("フォルダ未選択")
@@ -419,7 +431,7 @@ class DuplicateFinderGUI(QWidget):
         folder = self.folder_label.text()
         def worker():
             print(f"[DEBUG] find_duplicates.worker: folder={folder}")
-            duplicates, _ = find_duplicates_in_folder(folder, parallel=True)
+            duplicates, self.hash_index = find_duplicates_in_folder(folder, parallel=True, return_index=True)
             print(f"[DEBUG] find_duplicates.worker: duplicates found={len(duplicates)}")
             total = len(duplicates)
             last_update = time.time()
@@ -442,6 +454,80 @@ class DuplicateFinderGUI(QWidget):
             print("[DEBUG] find_duplicates.worker: signal emitted after update_ui")
         threading.Thread(target=worker).start()
 
+    def find_similar_files(self, file_path, threshold=8):
+        # 直近の重複チェックで作ったpHashインデックスから類似ファイルを検索する
+        # 戻り値: [(path, 距離), ...]（距離の小さい順）
+        if self.hash_index is None:
+            return []
+        folder = self.folder_label.text()
+        if os.path.splitext(file_path)[1].lower() in IMAGE_EXTS:
+            h = get_image_phash(file_path, folder)
+        else:
+            h = get_video_phash(file_path, 7, folder)
+        if h is None:
+            return []
+        return [(p, d) for p, d in self.hash_index.search(h, threshold) if os.path.normcase(p) != os.path.normcase(file_path)]
+
+    def show_similar_files(self):
+        # 選択中のファイル（1件でなければファイル選択ダイアログで選んだファイル）の類似ファイルを表示する
+        if self.hash_index is None:
+            QMessageBox.warning(self, "類似ファイル検索", "先に重複チェックを実行してください。")
+            return
+        if len(self.selected_paths) == 1:
+            file_path = next(iter(self.selected_paths))
+        else:
+            folder = self.folder_label.text()
+            exts = " ".join("*" + e for e in IMAGE_EXTS + VIDEO_EXTS)
+            file_path, _ = QFileDialog.getOpenFileName(self, "類似ファイルを検索するファイルを選択", folder if os.path.isdir(folder) else "", f"画像・動画ファイル ({exts})")
+            if not file_path:
+                return
+        try:
+            similar = self.find_similar_files(file_path)
+        except Exception as e:
+            print(f"[DEBUG] show_similar_files: Exception {e}")
+            QMessageBox.critical(self, "エラー", f"類似ファイルの検索中にエラーが発生しました:\n{str(e)}")
+            return
+        if not similar:
+            QMessageBox.information(self, "類似ファイル検索", f"{os.path.basename(file_path)} に類似するファイルは見つかりませんでした。")
+            return
+        lines = [f"{d:2d}  {p}" for p, d in similar[:30]]
+        if len(similar) > 30:
+            lines.append(f"... 他{len(similar) - 30}件")
+        QMessageBox.information(self, "類似ファイル検索", f"{os.path.basename(file_path)} に類似するファイル（距離の小さい順）:\n" + "\n".join(lines))
+
+    def update_duplicate_groups(self, added=(), removed=()):
+        # ファイルの追加・削除を直近の重複チェック結果に反映する（影響するグループだけ再計算）
+        # 重複チェック前などインデックスが無い場合はフォルダ全体を再チェックする
+        if self.hash_index is None:
+            self.find_duplicates()
+            return
+        folder = self.folder_label.text()
+        groups = list(self.duplicate_groups)
+        # 最後のグループがpHash計算に失敗したファイル（インデックスに無いファイル）ならそのまま引き継ぐ
+        error_files = []
+        if groups and not any(f in self.hash_index for f in groups[-1]):
+            error_files = groups[-1]
+        removed_set = set(removed)
+        error_files = [f for f in error_files if f not in removed_set]
+        for path in removed:
+            self.hash_index.remove(path)
+        for path in added:
+            if os.path.splitext(path)[1].lower() in IMAGE_EXTS:
+                h = get_image_phash(path, folder)
+            else:
+                h = get_video_phash(path, 7, folder)
+            if h is None:
+                error_files.append(path)
+            else:
+                self.hash_index.add(path, h)
+        groups = self.hash_index.groups()
+        if error_files:
+            groups.append(error_files)
+        self.duplicate_groups = groups
+        total_pages = max(1, (len(groups) + self.groups_per_page - 1) // self.groups_per_page)
+        self.current_page = min(self.current_page, total_pages - 1)
+        self.show_current_page()
+
     def update_ui(self, duplicates, folder, elapsed_time=None, eta_time=None, remain_count=None):
         print("[DEBUG] update_ui: called (first line)")
         # --- 統合ステータスラベルの更新 ---
@@ -618,6 +704,20 @@ class DuplicateFinderGUI(QWidget):
                 print(f"[DEBUG] clear_thumb_cache: Exception {e}")
                 QMessageBox.critical(self, "エラー", f"サムネイルキャッシュの削除中にエラーが発生しました:\n{str(e)}")
 
+    def compact_caches(self):
+        # 特徴量ストアと選択中フォルダのサムネイルキャッシュから、消えた・変更されたファイルの項目を削除する
+        folder = self.folder_label.text()
+        try:
+            results = [get_feature_store().compact()]
+            if folder and folder != "フォルダ未選択":
+                results.append(compact_thumbnail_cache(getattr(self, "thumb_cache", None) or folder))
+            removed = sum(r.removed for r in results)
+            reclaimed = sum(r.bytes_reclaimed for r in results)
+            QMessageBox.information(self, "完了", f"{removed}件の項目を削除し、{reclaimed / (1024 * 1024):.1f}MB を解放しました。")
+        except Exception as e:
+            print(f"[DEBUG] compact_caches: Exception {e}")
+            QMessageBox.critical(self, "エラー", f"キャッシュの整理中にエラーが発生しました:\n{str(e)}")
+
     def delete_selected(self):
         # 選択ファイルをゴミ箱に移動
         if not self.selected_paths or len(self.selected_paths) == 0:
@@ -633,15 +733,16 @@ class DuplicateFinderGUI(QWidget):
                     failed_files.append(path)
             if failed_files:
                 QMessageBox.warning(self, "一部失敗", f"以下のファイルの移動に失敗しました:\n" + "\n".join(failed_files))
+            removed = [p for p in self.selected_paths if p not in failed_files]
             self.selected_paths.clear()
-            self.find_duplicates()  # 削除後に重複チェックでUIを再構築
+            self.update_duplicate_groups(removed=removed)  # 削除したファイルの属するグループだけ再計算
             QMessageBox.information(self, "完了", "選択ファイルをゴミ箱に移動しました。")
 
     def delete_single_file(self, file_path):
         # 単一ファイルをゴミ箱に移動
         try:
             move_to_trash(file_path)
-            self.find_duplicates()  # 削除後に重複チェックでUIを再構築
+            self.update_duplicate_groups(removed=[file_path])  # 削除したファイルの属するグループだけ再計算
             QMessageBox.information(self, "完了", f"ファイルをゴミ箱に移動しました:\n{file_path}")
         except Exception as e:
             QMessageBox.critical(self, "エラー", f"ファイルの削除中にエラーが発生しました:\n{str(e)}")
@@ -0,0 +1,499 @@
+"""
+hash_index.py
+64bitハッシュ(pHash)のハミング距離インデックス。
+
+主な機能:
+- BK木によるハミング距離の範囲検索・GUIなどからの類似ファイル検索
+- 近傍ペア(i < j)の列挙: BK木 / Multi-index hashing（バンドごとの半径検索） / ブロック分割した距離行列
+- 2つのハッシュ集合の間の近傍ペアの列挙（新規ファイル x 登録済みファイル）
+- Union-Findによる近傍ペアのクラスタリング（中心型 / 連結成分、入力順に依らない結果）
+- ファイルの追加・削除時に影響する連結成分だけを再計算するインクリメンタルなグループ化
+
+依存:
+- numpy, component.utils.hash_util
+"""
+
+import itertools
+import math
+import numpy as np
+from component.utils.hash_util import PackedHashes, hash_to_int, hashes_to_uint64, popcount32, popcount64
+
+# ハミング距離行列を計算するタイルの大きさ（行 x 列）。256 x 4096のuint64で8MB程度
+HAMMING_BLOCK_ROWS = 256
+HAMMING_BLOCK_COLS = 4096
+
+# Multi-index hashingで1バンドあたりに試すXORマスク数の上限（bandsが少なすぎる指定を弾く）
+MIH_MAX_MASKS = 1 << 16
+# Multi-index hashingで一度に二分探索する件数（件数 x マスク数）
+MIH_QUERY_BLOCK = 1 << 20
+
+# 葉ノードに直接持つハッシュ数の上限（これ以下はnumpyで一括走査した方が速い）
+BKTREE_LEAF_SIZE = 64
+
+class BKTree:
+    """
+    ハミング距離のBK木。
+    内部ノードはピボットハッシュと {ピボットからの距離: 子ノード} を持ち、
+    BKTREE_LEAF_SIZE件以下の葉ノードはidの配列を持ってXOR+popcountで一括走査する
+    （Pythonのノード巡回を減らすためのバケット付きBK木）。
+    """
+    def __init__(self, hashes=None, paths=None, leaf_size=BKTREE_LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self._hashes = np.zeros(max(16, len(hashes) if hashes is not None else 0), dtype=np.uint64)
+        self._count = 0
+        self.paths = []
+        self.root = {"leaf": []}
+        if hashes is not None and len(hashes):
+            hashes = hashes_to_uint64(hashes) if not isinstance(hashes, np.ndarray) else hashes.astype(np.uint64)
+            self._hashes[:len(hashes)] = hashes
+            self._count = len(hashes)
+            self.paths = list(paths) if paths is not None else [None] * len(hashes)
+            self.root = self._build(np.arange(len(hashes)))
+
+    @classmethod
+    def from_packed(cls, packed):
+        return cls(packed.hashes, packed.paths)
+
+    @property
+    def hashes(self):
+        return self._hashes[:self._count]
+
+    def __len__(self):
+        return self._count
+
+    def _build(self, ids):
+        if len(ids) <= self.leaf_size:
+            return {"leaf": list(ids)}
+        pivot = self._hashes[ids[0]]
+        dist = popcount64(self._hashes[ids] ^ pivot)
+        if np.all(dist == dist[0]):
+            # すべて同じ距離（同一ハッシュの大量重複など）はこれ以上分割できない
+            return {"leaf": list(ids)}
+        children = {}
+        for d in np.unique(dist):
+            children[int(d)] = self._build(ids[dist == d])
+        return {"pivot": pivot, "children": children}
+
+    def add(self, h, path=None):
+        """
+        ハッシュを追加し、割り当てたidを返す。
+        """
+        h = np.uint64(hash_to_int(h))
+        if self._count == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.zeros(len(self._hashes), dtype=np.uint64)])
+        item_id = self._count
+        self._hashes[item_id] = h
+        self._count += 1
+        self.paths.append(path)
+        node = self.root
+        while "leaf" not in node:
+            d = int(popcount64(np.array([h ^ node["pivot"]]))[0])
+            child = node["children"].get(d)
+            if child is None:
+                child = node["children"][d] = {"leaf": []}
+            node = child
+        node["leaf"].append(item_id)
+        if len(node["leaf"]) > self.leaf_size * 2:
+            rebuilt = self._build(np.array(node["leaf"]))
+            node.clear()
+            node.update(rebuilt)
+        return item_id
+
+    def query(self, h, radius):
+        """
+        hからハミング距離radius以下のidを返す。戻り値: [(id, 距離), ...]（id昇順）
+        """
+        h = np.uint64(hash_to_int(h))
+        found_ids = []
+        found_dist = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if "leaf" in node:
+                if node["leaf"]:
+                    ids = np.asarray(node["leaf"])
+                    dist = popcount64(self._hashes[ids] ^ h)
+                    hit = dist <= radius
+                    found_ids.append(ids[hit])
+                    found_dist.append(dist[hit])
+                continue
+            d = int(popcount64(np.array([h ^ node["pivot"]]))[0])
+            # 三角不等式より、子の距離kが|k - d| <= radiusの枝だけ探索すればよい
+            for k, child in node["children"].items():
+                if d - radius <= k <= d + radius:
+                    stack.append(child)
+        if not found_ids:
+            return []
+        ids = np.concatenate(found_ids)
+        dist = np.concatenate(found_dist)
+        order = np.argsort(ids, kind="stable")
+        return [(int(i), int(d)) for i, d in zip(ids[order], dist[order])]
+
+    def search(self, h, threshold=8):
+        """
+        類似ファイル検索: ハミング距離がthreshold未満のファイルを返す。
+        戻り値: [(path, 距離), ...]（距離の小さい順）
+        """
+        hits = [(self.paths[i], d) for i, d in self.query(h, threshold - 1)]
+        hits.sort(key=lambda x: x[1])
+        return hits
+
+def index_near_pairs(packed, threshold=8, index=None):
+    """
+    BK木の範囲検索でハミング距離threshold未満のペアを列挙する。
+    戻り値: (ii, jj) のint64配列（ii < jj）
+    """
+    if index is None:
+        index = BKTree.from_packed(packed)
+    ii = []
+    jj = []
+    for i in range(len(packed.paths)):
+        for j, _ in index.query(packed.hashes[i], threshold - 1):
+            if j > i:
+                ii.append(i)
+                jj.append(j)
+    return np.array(ii, dtype=np.int64), np.array(jj, dtype=np.int64)
+
+def _band_bounds(bands):
+    # 64bitをbands個のほぼ等幅のビット区間に分割する: [(shift, width), ...]
+    widths = [64 // bands + (1 if b < 64 % bands else 0) for b in range(bands)]
+    shifts = np.cumsum([0] + widths[:-1])
+    return [(int(s), w) for s, w in zip(shifts, widths)]
+
+def _band_masks(width, radius):
+    # widthビットのバンドでradius個以下のビットを反転するXORマスク（uint64配列、先頭は0）
+    count = sum(math.comb(width, r) for r in range(radius + 1))
+    if count > MIH_MAX_MASKS:
+        raise ValueError(f"too few bands for the threshold: {count} masks per band")
+    masks = [0]
+    for r in range(1, radius + 1):
+        masks += [sum(1 << b for b in bits) for bits in itertools.combinations(range(width), r)]
+    return np.array(masks, dtype=np.uint64)
+
+def _mih_cost(n, bands, threshold):
+    # バンドごとの検索回数（マスク数 x 件数）と候補数の見積もり（バケットは一様と仮定）
+    width = 64 // bands
+    masks = sum(math.comb(width + 1, r) for r in range((threshold - 1) // bands + 1))
+    return bands * masks * (n + n * n / 2.0 ** width)
+
+def default_mih_bands(n, threshold):
+    """
+    n件・距離threshold未満の検索で、見積もりの比較回数が最小になるバンド数。
+    件数が多いほどバンドを長く（バケットを小さく）し、その分各バンドを広い半径で検索する。
+    """
+    threshold = max(1, threshold)
+    return min(range(1, min(64, threshold) + 1), key=lambda m: _mih_cost(n, m, threshold))
+
+def band_candidate_pairs(hashes, bands, radius=0, threshold=None):
+    """
+    バンド（64/bands bit区間）のどれか1つがハミング距離radius以内で一致するペアを列挙する。
+    各バンドはソート済みの値にXORマスク（radius個以下のビット反転）ごとの二分探索で検索する。
+    threshold: 指定時は、候補をバンド・マスク・バケット内の位置ごとの塊のままハミング距離threshold未満に
+               絞ってから貯める（作業メモリは候補数ではなく結果のペア数に比例する）
+    戻り値: (ii, jj) のint64配列（ii < jj、重複なし）
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    keys = []
+    for shift, width in _band_bounds(bands):
+        band = (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+        order = np.argsort(band, kind="stable")
+        sorted_band = band[order]
+        masks = _band_masks(width, radius)
+        # 複数のマスクの検索をまとめて行う（1回あたりMIH_QUERY_BLOCK件程度）
+        step = max(1, MIH_QUERY_BLOCK // max(n, 1))
+        for m0 in range(0, len(masks), step):
+            query = (band[None, :] ^ masks[m0:m0 + step, None]).ravel()
+            lo = np.searchsorted(sorted_band, query, "left")
+            counts = np.searchsorted(sorted_band, query, "right") - lo
+            pos = np.flatnonzero(counts > 0)
+            k = 0
+            # 各要素をバケット内のk番目の要素と組にする。件数がk以下の位置を順に外すので総計算量は候補数に比例する
+            while len(pos):
+                a = pos % n
+                b = order[lo[pos] + k]
+                # 各ペアは両側の検索で見つかるので a < b の向きだけ残す
+                keep = a < b
+                if threshold is not None:
+                    keep &= popcount64(hashes[a] ^ hashes[b]) < threshold
+                if keep.any():
+                    keys.append(a[keep].astype(np.int64) * n + b[keep])
+                k += 1
+                pos = pos[counts[pos] > k]
+    if not keys:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    keys = np.unique(np.concatenate(keys))
+    return keys // n, keys % n
+
+def mih_near_pairs(hashes, threshold=8, bands=None):
+    """
+    Multi-index hashingでハミング距離threshold未満のペアを列挙する（総当たりと同じ結果）。
+    距離がthreshold-1以下なら、鳩の巣原理でどれかのバンドの距離は⌊(threshold-1)/bands⌋以下になるので、
+    各バンドをその半径で検索する。
+    bands: バンド数。None（既定）は件数とthresholdから比較回数が最小になる数を選ぶ（default_mih_bands）
+    戻り値: (ii, jj) のint64配列（ii < jj）
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if threshold <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    bands = min(64, max(1, bands or default_mih_bands(len(hashes), threshold)))
+    return band_candidate_pairs(hashes, bands, (threshold - 1) // bands, threshold)
+
+def _low32(hashes):
+    return (hashes & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+def _tile_pairs(a, a_low, r0, r1, b, b_low, c0, c1, threshold):
+    # a[r0:r1] x b[c0:c1] のタイルで距離threshold未満のペアを返す（下位32bitで絞ってから64bitで検証）
+    ii, jj = np.nonzero(popcount32(a_low[r0:r1, None] ^ b_low[None, c0:c1]) < threshold)
+    ii = ii + r0
+    jj = jj + c0
+    keep = popcount64(a[ii] ^ b[jj]) < threshold
+    return ii[keep], jj[keep]
+
+def iter_near_pairs(hashes, threshold=8, block_rows=HAMMING_BLOCK_ROWS, block_cols=HAMMING_BLOCK_COLS):
+    """
+    ハミング距離threshold未満のペアを、距離行列の上三角をタイルに分けて計算しながら順に返す。
+    1タイル分（block_rows x block_cols）しか展開しないので、作業メモリはnに依らない。
+    タイル全体では下位32bitの距離だけを計算し（64bit距離の下限なので取りこぼしはない）、
+    それがthreshold未満の少数のペアだけ64bit全体で検証する。
+    戻り値: (ii, jj) のint64配列（ii < jj）のジェネレータ（タイルごと）
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    low = _low32(hashes)
+    n = len(hashes)
+    for r0 in range(0, n, block_rows):
+        r1 = min(n, r0 + block_rows)
+        for c0 in range(r0, n, block_cols):
+            ii, jj = _tile_pairs(hashes, low, r0, r1, hashes, low, c0, min(n, c0 + block_cols), threshold)
+            keep = ii < jj
+            if keep.any():
+                yield ii[keep], jj[keep]
+
+def cross_near_pairs(a, b, threshold=8, block_rows=HAMMING_BLOCK_ROWS, block_cols=HAMMING_BLOCK_COLS):
+    """
+    2つのハッシュ配列a, bの間でハミング距離threshold未満のペアを列挙する（タイル分割、メモリ一定）。
+    新規ファイル(a)と登録済みの全ファイル(b)の比較など、a x b だけを計算したい場合に使う。
+    戻り値: (ia, jb) のint64配列（aのインデックス, bのインデックス）
+    """
+    a = np.asarray(a, dtype=np.uint64)
+    b = np.asarray(b, dtype=np.uint64)
+    a_low, b_low = _low32(a), _low32(b)
+    ia = [np.zeros(0, dtype=np.int64)]
+    jb = [np.zeros(0, dtype=np.int64)]
+    for r0 in range(0, len(a), block_rows):
+        r1 = min(len(a), r0 + block_rows)
+        for c0 in range(0, len(b), block_cols):
+            ii, jj = _tile_pairs(a, a_low, r0, r1, b, b_low, c0, min(len(b), c0 + block_cols), threshold)
+            ia.append(ii.astype(np.int64))
+            jb.append(jj.astype(np.int64))
+    return np.concatenate(ia), np.concatenate(jb)
+
+def blocked_near_pairs(hashes, threshold=8, block_rows=HAMMING_BLOCK_ROWS, block_cols=HAMMING_BLOCK_COLS):
+    """
+    iter_near_pairsの結果をまとめて返す（総当たりと同じ結果）。
+    戻り値: (ii, jj) のint64配列（ii < jj）
+    """
+    pairs = list(iter_near_pairs(hashes, threshold, block_rows, block_cols))
+    if not pairs:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    return np.concatenate([p[0] for p in pairs]), np.concatenate([p[1] for p in pairs])
+
+def filter_pairs(ii, jj, compatible=None):
+    """
+    compatible(i, j) がFalseのペアを除く（メタデータフィルタ用）。
+    """
+    if compatible is None or len(ii) == 0:
+        return ii, jj
+    keep = np.array([compatible(int(i), int(j)) for i, j in zip(ii, jj)], dtype=bool)
+    return ii[keep], jj[keep]
+
+class UnionFind:
+    """
+    要素0〜n-1のUnion-Find。根は常に集合内で最小の要素にする（結果を決定的にするため）。
+    """
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            if rb < ra:
+                ra, rb = rb, ra
+            self.parent[rb] = ra
+        return ra
+
+# cluster_pairsのクラスタリング方式
+# "star": 中心型。並び順で最初の要素を中心とし、まだどの中心にも属さない近傍を取り込む
+#         （従来の貪欲法と同じ考え方。グループ内の全要素が中心からthreshold未満）
+# "connected": 連結成分。近傍ペアを推移的にたどってつながる要素をすべて1グループにする
+CLUSTER_MODES = ("star", "connected")
+
+def cluster_pairs(n, ii, jj, mode="star", keys=None):
+    """
+    近傍ペアの列をUnion-Findでグループにまとめる（ペア数に対して線形時間、ソートを除く）。
+    keys: 並び順を決めるキー（パスなど）のリスト。指定時は入力順に依らず同じ結果になる。
+          Noneならインデックス順。
+    戻り値: [[index, ...], ...]（グループ内・グループ間ともキー順。要素2以上のグループのみ）
+    """
+    if mode not in CLUSTER_MODES:
+        raise ValueError(f"unknown cluster mode: {mode}")
+    ii = np.asarray(ii, dtype=np.int64)
+    jj = np.asarray(jj, dtype=np.int64)
+    # ペアに現れる要素だけを並べる（他の要素は単独なので、キーの読み出し・ソートは不要）
+    nodes = np.unique(np.concatenate([ii, jj]))
+    if keys is None:
+        order = np.arange(len(nodes))
+    else:
+        order = np.array(sorted(range(len(nodes)), key=lambda k: keys[nodes[k]]), dtype=np.int64)
+    # 以降はキー順の順位(rank)で扱う: rank[局所番号] -> 順位, nodes[order[順位]] -> index
+    rank = np.empty(len(nodes), dtype=np.int64)
+    rank[order] = np.arange(len(nodes))
+    a, b = rank[np.searchsorted(nodes, ii)], rank[np.searchsorted(nodes, jj)]
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    uf = UnionFind(len(nodes))
+    if mode == "connected":
+        for x, y in zip(lo.tolist(), hi.tolist()):
+            uf.union(x, y)
+    else:
+        # hiの昇順に処理すると、hiより小さい要素が中心かどうかは処理済みで確定している。
+        # hiは近傍の中心のうち最小のものに属し、どの中心にも属さなければ自分が中心になる
+        centre = np.ones(len(nodes), dtype=bool)
+        pair_order = np.lexsort((lo, hi))
+        for x, y in zip(lo[pair_order].tolist(), hi[pair_order].tolist()):
+            if centre[y] and centre[x]:
+                centre[y] = False
+                uf.union(x, y)
+    members = {}
+    for r in range(len(nodes)):
+        members.setdefault(uf.find(r), []).append(r)
+    index_of = nodes[order]
+    return [[int(index_of[r]) for r in g] for _, g in sorted(members.items()) if len(g) > 1]
+
+class IncrementalGrouper:
+    """
+    ハッシュインデックス（BK木）と近傍グラフ・グループをメモリに保持し、
+    ファイルの追加・削除時に影響を受ける連結成分だけをクラスタリングし直す。
+    グループは連結成分の中だけで決まるため、結果は同じファイル集合でgroup_by_phashを
+    やり直した場合（同じthreshold・mode）と一致する。
+    compatible: compatible(path_a, path_b) がFalseのペアは近傍にしない（メタデータフィルタ用）
+    """
+    def __init__(self, paths=(), hashes=(), threshold=8, mode="star", compatible=None):
+        if mode not in CLUSTER_MODES:
+            raise ValueError(f"unknown cluster mode: {mode}")
+        self.threshold = threshold
+        self.mode = mode
+        self.compatible = compatible
+        paths = list(paths)
+        self.index = BKTree(hashes if len(paths) else None, paths)
+        self.ids = {path: i for i, path in enumerate(paths)}
+        self.neighbors = {i: set() for i in range(len(paths))}
+        ii, jj = blocked_near_pairs(self.index.hashes, threshold)
+        for i, j in zip(ii.tolist(), jj.tolist()):
+            if self._compatible(i, j):
+                self.neighbors[i].add(j)
+                self.neighbors[j].add(i)
+        self.component = {}
+        self.component_groups = {}
+        self._next_component = 0
+        self._recluster(list(self.neighbors))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, path):
+        return path in self.ids
+
+    def _compatible(self, i, j):
+        return self.compatible is None or self.compatible(self.index.paths[i], self.index.paths[j])
+
+    def _recluster(self, seeds, stale=()):
+        # seedsを含む連結成分を作り直す。staleは削除済み要素が属していた成分
+        old = set(stale) | {self.component[x] for x in seeds if x in self.component}
+        for c in old:
+            self.component_groups.pop(c, None)
+        visited = set()
+        for seed in seeds:
+            if seed in visited or seed not in self.neighbors:
+                continue
+            members = [seed]
+            visited.add(seed)
+            k = 0
+            while k < len(members):
+                for y in self.neighbors[members[k]]:
+                    if y not in visited:
+                        visited.add(y)
+                        members.append(y)
+                k += 1
+            c = self._next_component
+            self._next_component += 1
+            for x in members:
+                self.component[x] = c
+            if len(members) > 1:
+                local = {x: k for k, x in enumerate(members)}
+                ii = []
+                jj = []
+                for x in members:
+                    for y in self.neighbors[x]:
+                        if local[x] < local[y]:
+                            ii.append(local[x])
+                            jj.append(local[y])
+                keys = [self.index.paths[x] for x in members]
+                groups = [[keys[k] for k in g] for g in cluster_pairs(len(members), ii, jj, self.mode, keys=keys)]
+                if groups:
+                    self.component_groups[c] = groups
+
+    def add(self, path, h):
+        """
+        ファイルを追加し、近傍を含む連結成分だけグループを作り直す（同じパスは置き換える）。
+        """
+        if path in self.ids:
+            self.remove(path)
+        i = self.index.add(h, path)
+        self.ids[path] = i
+        near = {j for j, _ in self.index.query(h, self.threshold - 1)
+                if j != i and j in self.neighbors and self._compatible(i, j)}
+        self.neighbors[i] = near
+        for j in near:
+            self.neighbors[j].add(i)
+        self._recluster([i], {self.component[j] for j in near})
+
+    def remove(self, path):
+        """
+        ファイルを削除し、属していた連結成分だけグループを作り直す。戻り値: 削除したか
+        """
+        i = self.ids.pop(path, None)
+        if i is None:
+            return False
+        near = self.neighbors.pop(i)
+        for j in near:
+            self.neighbors[j].discard(i)
+        stale = self.component.pop(i, None)
+        self._recluster(sorted(near), () if stale is None else (stale,))
+        return True
+
+    def groups(self):
+        """
+        現在の重複グループを返す（グループ内・グループ間ともパス順）。
+        """
+        groups = [g for gs in self.component_groups.values() for g in gs]
+        groups.sort(key=lambda g: g[0])
+        return groups
+
+    def search(self, h, threshold=8):
+        """
+        削除済みを除いて類似ファイルを検索する。戻り値: [(path, 距離), ...]（距離の小さい順）
+        """
+        hits = [(self.index.paths[i], d) for i, d in self.index.query(h, threshold - 1)
+                if self.ids.get(self.index.paths[i]) == i]
+        hits.sort(key=lambda x: x[1])
+        return hits
@@ -0,0 +1,192 @@
+"""
+hash_store.py
+重複検出インデックス（pHash・メタデータ・パス）の列指向ファイル形式と、そのメモリマップ読み込み。
+
+主な機能:
+- pHash(uint64)・メタデータ（幅・高さ・再生時間・fps）の列と、パスの文字列表を1ファイルに書き出す
+- np.memmapで開く（開くのはヘッダの読み込みだけで、列のページはアクセス時に読まれる）
+- PackedHashes互換の形で返し、重複検出エンジン（group_by_phashなど）がそのまま使える
+
+依存:
+- numpy, json, os, tempfile, component.media_metadata, component.utils.hash_util
+
+ファイル形式:
+  _MAGIC(8バイト) + ヘッダ長(uint64 little endian) + ヘッダ(JSON) + 列（各列は_ALIGNバイト境界から）
+  ヘッダ: {"count": 件数, "columns": {名前: {"dtype": dtype, "offset": 先頭からのバイト位置, "length": 要素数}}}
+"""
+
+import json
+import os
+import tempfile
+import numpy as np
+from component.media_metadata import MediaMeta
+from component.utils.hash_util import PackedHashes
+
+_MAGIC = b"PHCOLS01"
+_ALIGN = 64
+# ヘッダ(JSON)の領域。列の数で大きさが決まり、件数には依らない（数百バイト）
+_HEADER_SPACE = 4096
+
+# 列名とdtype（メタデータの欠損は has_meta=0、再生時間・fpsの欠損はNaN）
+_COLUMNS = (
+    ("hashes", "<u8"),
+    ("has_meta", "u1"),
+    ("width", "<i4"),
+    ("height", "<i4"),
+    ("duration", "<f8"),
+    ("fps", "<f8"),
+    ("path_offsets", "<i8"),
+    ("path_bytes", "u1"),
+)
+
+def _metadata_columns(metas, n):
+    has_meta = np.zeros(n, dtype=np.uint8)
+    width = np.zeros(n, dtype=np.int32)
+    height = np.zeros(n, dtype=np.int32)
+    duration = np.full(n, np.nan)
+    fps = np.full(n, np.nan)
+    for i, m in enumerate(metas or ()):
+        if m is None:
+            continue
+        has_meta[i] = 1
+        width[i] = m.width or 0
+        height[i] = m.height or 0
+        if m.duration is not None:
+            duration[i] = m.duration
+        if m.fps is not None:
+            fps[i] = m.fps
+    return has_meta, width, height, duration, fps
+
+def write_hash_store(path, packed, metas=None):
+    """
+    PackedHashesとメタデータ（packedと同じ並びのリスト）を列指向ファイルに書き出す。
+    パス順に並べ替えて保存する（グループのキー順とインデックス順が一致する）。
+    一時ファイルに書いてからos.replaceで置き換える。
+    """
+    paths = list(packed.paths)
+    order = sorted(range(len(paths)), key=paths.__getitem__)
+    paths = [paths[i] for i in order]
+    metas = [metas[i] for i in order] if metas is not None else None
+    encoded = [p.encode("utf-8") for p in paths]
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    columns = dict(zip(("has_meta", "width", "height", "duration", "fps"), _metadata_columns(metas, len(paths))))
+    columns["hashes"] = np.asarray(packed.hashes, dtype=np.uint64)[order]
+    columns["path_offsets"] = offsets
+    columns["path_bytes"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    offset = len(_MAGIC) + 8 + _HEADER_SPACE
+    layout = {}
+    for name, dtype in _COLUMNS:
+        offset = -(-offset // _ALIGN) * _ALIGN
+        arr = np.ascontiguousarray(columns[name], dtype=dtype)
+        layout[name] = {"dtype": dtype, "offset": offset, "length": len(arr)}
+        offset += arr.nbytes
+    header = json.dumps({"count": len(paths), "columns": layout}).encode("utf-8")
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_MAGIC + len(header).to_bytes(8, "little") + header)
+            for name, dtype in _COLUMNS:
+                f.seek(layout[name]["offset"])
+                f.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+class PathTable:
+    """
+    列指向ファイルのパス表。インデックスで引いた要素だけをデコードする（シーケンスとして使える）。
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class MetaTable:
+    """
+    列指向ファイルのメタデータ。インデックスで引くとMediaMeta（メタデータが無ければNone）を返す。
+    """
+    def __init__(self, has_meta, width, height, duration, fps):
+        self.has_meta = has_meta
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.fps = fps
+
+    def __len__(self):
+        return len(self.has_meta)
+
+    def __getitem__(self, i):
+        if not self.has_meta[i]:
+            return None
+        d = float(self.duration[i])
+        fps = float(self.fps[i])
+        return MediaMeta(int(self.width[i]), int(self.height[i]), None if d != d else d, None if fps != fps else fps)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class HashStore:
+    """
+    列指向ファイルをメモリマップで開く（読み取り専用）。
+    packed: PackedHashes(PathTable, np.memmap(uint64)), metas: MetaTable
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic = f.read(len(_MAGIC))
+            if magic != _MAGIC:
+                raise ValueError(f"not a hash store: {path}")
+            header_len = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        self.count = header["count"]
+        # ファイル全体を1つのmemmapにし、各列はその範囲のビューにする（列の先頭は_ALIGN境界）
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        self.columns = {}
+        for name, info in header["columns"].items():
+            dtype = np.dtype(info["dtype"])
+            start = info["offset"]
+            self.columns[name] = self.buffer[start:start + info["length"] * dtype.itemsize].view(dtype)
+        self.hashes = self.columns["hashes"]
+        self.paths = PathTable(self.columns["path_offsets"], self.columns["path_bytes"])
+        self.metas = MetaTable(*(self.columns[name] for name in ("has_meta", "width", "height", "duration", "fps")))
+        self.packed = PackedHashes(self.paths, self.hashes)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        # memmapは参照が無くなった時点で閉じられる（Windowsでは閉じるまでファイルを置き換えられない）
+        self.buffer = None
+        self.columns = {}
+        self.hashes = self.paths = self.metas = self.packed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
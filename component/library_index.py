@@ -0,0 +1,232 @@
+"""
+library_index.py
+複数のルートフォルダをまたぐ、画像・動画のライブラリ全体インデックス（SQLite）。
+
+主な機能:
+- スキャン済みファイルのpHash・メタデータを1つのDB（constants.CACHE_DIR）に永続化
+- フォルダのスキャンでは未登録・変更されたファイルだけpHashを計算し（特徴量ストアの署名で判定）、消えたファイルは登録を削除
+- 対象ファイルと登録済みの全ファイルだけを比較する、ルートをまたいだ重複検出
+- 列指向ファイル（メモリマップで開ける）への書き出し
+
+依存:
+- sqlite3, numpy, component.duplicate_finder, component.hash_index, component.hash_store, component.media_metadata
+"""
+
+import os
+import sqlite3
+from collections import namedtuple
+import numpy as np
+from component.duplicate_finder import (
+    DEFAULT_CLUSTER_MODE, PHASH_THRESHOLD, extract_packed_phashes, get_image_and_video_files, group_by_phash,
+)
+from component.hash_store import write_hash_store
+from component.hash_index import blocked_near_pairs, cluster_pairs, cross_near_pairs, filter_pairs
+from component.media_metadata import MediaMeta, metadata_compatible
+from component.utils import constants
+from component.utils.file_util import normalize_path
+from component.utils.hash_util import PackedHashes
+
+# added: 新しく登録したファイル, removed: 存在しなくなった（またはpHashを計算できなくなった）ため登録を削除したファイル,
+# errors: pHash計算に失敗したファイル,
+# changed: 登録済みでpHashが変わった（上書き・置き換えられた）ファイル
+LibraryScan = namedtuple("LibraryScan", ["added", "removed", "errors", "changed"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    phash INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    duration REAL,
+    fps REAL
+);
+CREATE INDEX IF NOT EXISTS media_root ON media(root);
+"""
+
+def get_library_index_path():
+    return os.path.join(constants.CACHE_DIR, constants.LIBRARY_INDEX_FILE)
+
+def get_hash_store_path():
+    return os.path.join(constants.CACHE_DIR, constants.HASH_STORE_FILE)
+
+# SQLiteの1文で使えるパラメータ数の上限（古いSQLiteの既定値）
+_SQL_PARAMS_MAX = 999
+
+def _library_path(path):
+    # ルートをまたいで同じファイルを同じキーにするため絶対パスで正規化する
+    return normalize_path(os.path.abspath(path))
+
+def _under(folder):
+    # folder配下のパスの範囲（主キーの範囲検索に使う）
+    prefix = os.path.join(_library_path(folder), "")
+    return prefix, prefix + "\U0010ffff"
+
+class LibraryIndex:
+    """
+    ライブラリ全体のpHash・メタデータのインデックス。
+    pHash(np.uint64)はSQLiteの符号付き64bit整数としてビットをそのまま保存する。
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path or get_library_index_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def roots(self):
+        return [r for (r,) in self.conn.execute("SELECT DISTINCT root FROM media ORDER BY root")]
+
+    def paths(self, folder=None):
+        """
+        登録済みのパスの集合（folder指定時はその配下のみ。別のルートとして登録したサブフォルダも含む）。
+        """
+        if folder is None:
+            rows = self.conn.execute("SELECT path FROM media")
+        else:
+            rows = self.conn.execute("SELECT path FROM media WHERE path >= ? AND path < ?", _under(folder))
+        return set(p for (p,) in rows)
+
+    def registered(self, files):
+        """
+        filesのうち登録済みのパスの集合。
+        """
+        return set(self.registered_hashes(files))
+
+    def registered_hashes(self, files):
+        """
+        filesのうち登録済みのパスのpHash。戻り値: {path: np.uint64}
+        """
+        files = [_library_path(f) for f in files]
+        found = {}
+        for i in range(0, len(files), _SQL_PARAMS_MAX):
+            chunk = files[i:i + _SQL_PARAMS_MAX]
+            rows = self.conn.execute("SELECT path, phash FROM media WHERE path IN (%s)" % ",".join("?" * len(chunk)), chunk)
+            found.update((p, np.int64(h).view(np.uint64)) for p, h in rows)
+        return found
+
+    def add(self, root, packed, metadata=None):
+        """
+        PackedHashesとメタデータ({file: MediaMeta})を1トランザクションで登録する（同じパスは置き換える）。
+        """
+        root = _library_path(root)
+        metadata = metadata or {}
+        rows = []
+        for path, h in zip(packed.paths, packed.hashes.view(np.int64).tolist()):
+            m = metadata.get(path)
+            rows.append((_library_path(path), root, h) + (tuple(m) if m is not None else (None, None, None, None)))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, paths):
+        with self.conn:
+            self.conn.executemany("DELETE FROM media WHERE path = ?", [(_library_path(p),) for p in paths])
+
+    def load(self, roots=None):
+        """
+        登録済みのエントリを読み込む。戻り値: (PackedHashes, [MediaMeta or None, ...])（パス順）
+        """
+        query = "SELECT path, phash, width, height, duration, fps FROM media"
+        params = ()
+        if roots is not None:
+            roots = [_library_path(r) for r in roots]
+            query += " WHERE root IN (%s)" % ",".join("?" * len(roots))
+            params = tuple(roots)
+        rows = self.conn.execute(query + " ORDER BY path", params).fetchall()
+        paths = [r[0] for r in rows]
+        hashes = np.array([r[1] for r in rows], dtype=np.int64).view(np.uint64)
+        metas = [MediaMeta(*r[2:]) if r[2] is not None else None for r in rows]
+        return PackedHashes(paths, hashes), metas
+
+    def export_hash_store(self, path=None):
+        """
+        登録済みの全エントリを列指向ファイル（component.hash_store）に書き出す。
+        HashStoreで開けば、起動時にSQLiteから全件を読み込まずにgroup_by_phashなどを実行できる。
+        戻り値: 書き出したファイルのパス
+        """
+        path = path or get_hash_store_path()
+        packed, metas = self.load()
+        write_hash_store(path, packed, metas)
+        return path
+
+    def scan_folder(self, folder, progress_callback=None, max_workers=None, fast_decode=False, metadata_filter=True):
+        """
+        フォルダを登録する。存在しなくなったファイルは削除する。
+        登録済みのファイルも含めて特徴量ストア経由でpHash（とメタデータ）を取得するので、
+        署名が変わらないファイルはキャッシュから読むだけで開かず、上書き・置き換えられたファイルは計算し直す。
+        戻り値: LibraryScan
+        """
+        files = [_library_path(f) for f in get_image_and_video_files(folder)]
+        known = self.registered_hashes(files)
+        gone = sorted(self.paths(folder) - set(files))
+        errors = []
+        added = []
+        changed = []
+        if files:
+            # メタデータは特徴量ストアにキャッシュされ、ハッシュと一緒に取得する
+            metadata = {} if metadata_filter else None
+            packed, errors = extract_packed_phashes(files, folder, progress_callback=progress_callback, max_workers=max_workers, fast_decode=fast_decode, metadata=metadata)
+            fresh = [i for i, (p, h) in enumerate(zip(packed.paths, packed.hashes)) if known.get(p) != h]
+            if fresh:
+                self.add(folder, PackedHashes([packed.paths[i] for i in fresh], packed.hashes[fresh]), metadata)
+            added = [packed.paths[i] for i in fresh if packed.paths[i] not in known]
+            changed = [packed.paths[i] for i in fresh if packed.paths[i] in known]
+            # 登録後に壊れたファイルの古いpHashは残さない
+            gone += [f for f in errors if f in known]
+        if gone:
+            self.remove(gone)
+        return LibraryScan(added, gone, errors, changed)
+
+    def find_duplicates(self, files=None, threshold=PHASH_THRESHOLD, metadata_filter=True, tolerances=None, mode=None):
+        """
+        登録済みファイルの重複グループを返す（ルートをまたいで比較する）。
+        files: 指定時はこれらのファイルを含むグループだけを求める。対象 x 登録済み全件だけを比較するので、
+               新しく追加したフォルダと既存ライブラリの照合でライブラリ全体の総当たりをしない。
+        """
+        packed, metas = self.load()
+        if not metadata_filter:
+            metas = None
+        if files is None:
+            return group_by_phash(packed, threshold, metas, tolerances, mode=mode)
+        pos = {p: i for i, p in enumerate(packed.paths)}
+        query = np.array(sorted(set(pos[p] for p in map(_library_path, files) if p in pos)), dtype=np.int64)
+        if len(query) == 0:
+            return []
+        # 対象ファイルから近傍をたどり、連結成分全体（involved）を集める。その中で近傍ペアを求め直して
+        # グループを作る（近傍の近傍もグループの形に影響するため。全件でのグループ化と同じ結果になる）
+        involved = query
+        frontier = query
+        while len(frontier):
+            _, jb = cross_near_pairs(packed.hashes[frontier], packed.hashes, threshold)
+            frontier = np.setdiff1d(jb, involved)
+            involved = np.union1d(involved, frontier)
+        lo, hi = blocked_near_pairs(packed.hashes[involved], threshold)
+        if metas is not None:
+            local_metas = [metas[g] for g in involved]
+            def compatible(i, j):
+                return metadata_compatible(local_metas[i], local_metas[j], tolerances)
+            lo, hi = filter_pairs(lo, hi, compatible)
+        keys = [packed.paths[g] for g in involved]
+        targets = set(np.searchsorted(involved, query).tolist())
+        groups = cluster_pairs(len(involved), lo, hi, mode or DEFAULT_CLUSTER_MODE, keys=keys)
+        return [[keys[k] for k in g] for g in groups if targets.intersection(g)]
+
+    def scan_and_find(self, folder, threshold=PHASH_THRESHOLD, progress_callback=None, max_workers=None, metadata_filter=True, tolerances=None):
+        """
+        フォルダを登録し、そのフォルダのファイルを含む重複グループ（他のルートのファイルも含む）を返す。
+        戻り値: (LibraryScan, グループのリスト)
+        """
+        scan = self.scan_folder(folder, progress_callback, max_workers, metadata_filter=metadata_filter)
+        groups = self.find_duplicates(sorted(self.paths(folder)), threshold, metadata_filter, tolerances)
+        return scan, groups
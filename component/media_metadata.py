@@ -0,0 +1,190 @@
+"""
+media_metadata.py
+画像・動画のヘッダ情報（解像度・アスペクト比・再生時間・フレームレート）の取得と、
+重複判定前の組み合わせ絞り込み（プレフィルタ）。
+
+主な機能:
+- デコードせずにヘッダ/CAP_PROP_*からメタデータを取得
+- 許容誤差つきのメタデータ互換判定
+- 再生時間でソートした窓による比較候補の列挙
+- アスペクト比・再生時間のバケットによる比較ブロックの組の列挙（近傍ペアの計算前の絞り込み）
+
+依存:
+- OpenCV, Pillow, numpy, bisect, itertools
+"""
+
+import bisect
+import itertools
+import os
+from collections import namedtuple
+import cv2
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff")
+
+# width/height: ピクセル数, duration: 秒(画像はNone), fps: フレームレート(画像はNone)
+MediaMeta = namedtuple("MediaMeta", ["width", "height", "duration", "fps"])
+
+# 許容誤差（すべて相対値。Noneの項目は比較しない）
+# fpsは再エンコードで変わることが多いため既定では比較しない
+DEFAULT_TOLERANCES = {
+    "aspect": 0.05,
+    "duration": 0.1,
+    "fps": None,
+}
+# 再生時間の絶対許容誤差（秒）。短い動画で相対誤差が厳しくなりすぎないようにする
+DURATION_SLACK = 1.0
+
+def get_image_metadata(path):
+    # Image.openはヘッダのみ読む（画素はload()まで読まない）
+    with Image.open(path) as img:
+        w, h = img.size
+    return MediaMeta(w, h, None, None)
+
+def get_video_metadata(path):
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            return None
+        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    finally:
+        cap.release()
+    if not fps or fps <= 0 or fps != fps:
+        fps = None
+    duration = count / fps if fps and count and count > 0 else None
+    return MediaMeta(w, h, duration, fps)
+
+def get_media_metadata(path):
+    """
+    拡張子に応じて画像/動画のメタデータを返す。取得できない場合はNone。
+    """
+    try:
+        if os.path.splitext(path)[1].lower() in IMAGE_EXTS:
+            return get_image_metadata(path)
+        return get_video_metadata(path)
+    except Exception:
+        return None
+
+def _rel_close(a, b, tol):
+    return abs(a - b) <= tol * max(abs(a), abs(b))
+
+def metadata_compatible(m1, m2, tolerances=None):
+    """
+    2つのメタデータが同一コンテンツとしてあり得るか判定する。
+    片方しか持たない項目（画像と動画の再生時間など）や取得できなかった項目は比較しない。
+    """
+    if m1 is None or m2 is None:
+        return True
+    if tolerances is None:
+        tolerances = DEFAULT_TOLERANCES
+    tol = tolerances.get("aspect")
+    if tol is not None and m1.width and m1.height and m2.width and m2.height:
+        # 回転の有無までは判定できないため縦横を揃えて比較する
+        a1 = max(m1.width, m1.height) / min(m1.width, m1.height)
+        a2 = max(m2.width, m2.height) / min(m2.width, m2.height)
+        if not _rel_close(a1, a2, tol):
+            return False
+    tol = tolerances.get("duration")
+    if tol is not None and m1.duration is not None and m2.duration is not None:
+        if abs(m1.duration - m2.duration) > max(DURATION_SLACK, tol * max(m1.duration, m2.duration)):
+            return False
+    tol = tolerances.get("fps")
+    if tol is not None and m1.fps and m2.fps:
+        if not _rel_close(m1.fps, m2.fps, tol):
+            return False
+    return True
+
+class MetadataFilter:
+    """
+    インデックスのリストに対し、メタデータ互換な比較相手だけを列挙する。
+    再生時間を持つ動画は再生時間でソートし、許容範囲の窓だけを二分探索で取り出す。
+    """
+    def __init__(self, metas, tolerances=None):
+        self.metas = list(metas)
+        self.tolerances = tolerances if tolerances is not None else DEFAULT_TOLERANCES
+        timed = [(m.duration, i) for i, m in enumerate(self.metas) if m is not None and m.duration is not None]
+        timed.sort()
+        self.durations = [d for d, _ in timed]
+        self.timed_indices = [i for _, i in timed]
+        timed_set = set(self.timed_indices)
+        self.untimed_indices = [i for i in range(len(self.metas)) if i not in timed_set]
+
+    def candidates(self, i):
+        """
+        iと比較すべきインデックスを昇順で返す（i自身は含まない）。
+        """
+        m = self.metas[i]
+        tol = self.tolerances.get("duration")
+        if m is None or m.duration is None or tol is None:
+            pool = range(len(self.metas))
+        else:
+            # |d - m.duration| <= max(slack, tol*max(d, m.duration)) を満たしうる範囲
+            lo = min(m.duration - DURATION_SLACK, m.duration * (1 - tol))
+            hi = max(m.duration + DURATION_SLACK, m.duration / (1 - tol) if tol < 1 else float("inf"))
+            start = bisect.bisect_left(self.durations, lo)
+            end = bisect.bisect_right(self.durations, hi)
+            pool = sorted(self.timed_indices[start:end] + self.untimed_indices)
+        return [j for j in pool if j != i and metadata_compatible(m, self.metas[j], self.tolerances)]
+
+def _aspect(m):
+    if m is None or not m.width or not m.height:
+        return None
+    return max(m.width, m.height) / min(m.width, m.height)
+
+def _duration(m):
+    return None if m is None else m.duration
+
+def _sweep_buckets(values, reach):
+    """
+    値の昇順に、バケット先頭の値xから届く範囲（reach(x)以下）ごとにバケットを切る。
+    reachが単調なら、値xと互換な大きい側の値はreach(x)以下なので同じか次のバケットに入る。
+    values: {index: 値}  戻り値: {index: バケット番号}
+    """
+    buckets = {}
+    bucket = -1
+    limit = None
+    for i in sorted(values, key=values.get):
+        if limit is None or values[i] > limit:
+            bucket += 1
+            limit = reach(values[i])
+        buckets[i] = bucket
+    return buckets
+
+def metadata_blocks(metas, tolerances=None):
+    """
+    メタデータが互換になりうるペアだけを比較するための、インデックスのブロックの組を列挙する。
+    アスペクト比・再生時間それぞれで許容範囲の幅のバケットに分け、どちらでも隣り合う（または値を持たない）
+    バケット同士だけを組にする。互換なペアは必ずどれかの組に入る（組の中の厳密な判定はmetadata_compatible）。
+    戻り値: [(a, b), ...]（インデックスのnp.int64配列。a is bならブロック内のペア、それ以外はa x b）
+    """
+    if tolerances is None:
+        tolerances = DEFAULT_TOLERANCES
+    dims = []
+    tol = tolerances.get("aspect")
+    if tol is not None:
+        dims.append((_aspect, lambda x: x / (1 - tol) if tol < 1 else float("inf")))
+    tol_d = tolerances.get("duration")
+    if tol_d is not None:
+        dims.append((_duration, lambda d: max(d + DURATION_SLACK, d / (1 - tol_d) if tol_d < 1 else float("inf"))))
+    ids = []
+    for value, reach in dims:
+        values = {i: v for i, v in enumerate(value(m) for m in metas) if v is not None}
+        ids.append(_sweep_buckets(values, reach))
+    groups = {}
+    for i in range(len(metas)):
+        groups.setdefault(tuple(d.get(i) for d in ids), []).append(i)
+    all_ids = [set(d.values()) for d in ids]
+    order = {key: k for k, key in enumerate(sorted(groups, key=lambda key: tuple(-1 if x is None else x for x in key)))}
+    blocks = {key: np.array(members, dtype=np.int64) for key, members in groups.items()}
+    pairs = []
+    for key in sorted(groups, key=order.get):
+        # 各次元で組になりうるバケット（値を持たないバケットは全バケットと組になる）
+        allowed = [([None] + sorted(all_ids[d]) if x is None else [None, x - 1, x, x + 1]) for d, x in enumerate(key)]
+        for other in itertools.product(*allowed):
+            if other in blocks and order[other] >= order[key]:
+                pairs.append((blocks[key], blocks[key] if other == key else blocks[other]))
+    return pairs
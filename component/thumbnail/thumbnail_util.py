@@ -9,6 +9,9 @@ import cv2
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import QThread, QCoreApplication
 import time
+from component.utils import constants
+from component.utils.cache_util import CompactResult, cache_lock, file_bytes, load_cache, save_cache
+from component.utils.file_util import content_fingerprint, stat_signature, stat_signatures
 
 # サムネイルキャッシュファイル名生成
 def get_thumb_cache_file(folder):
@@ -19,12 +22,32 @@ def get_thumb_cache_file(folder):
     h = hashlib.sha1(folder.encode('utf-8')).hexdigest()[:12]
     return f".thumb_cache_{h}.pkl"
 
+def _unpack_thumb_cache(raw):
+    # 保存形式 (cache, signatures, fingerprints) に揃える
+    # 旧形式（署名の無いdictのみ・指紋の無い2要素）も読める。署名の無い項目は検証で破棄される
+    data = pickle.loads(raw)
+    if not isinstance(data, tuple):
+        data = (data,)
+    return data + ({},) * (3 - len(data))
+
 class ThumbnailCache:
+    """
+    サムネイル(PIL.Image)のキャッシュ。ファイルの署名で検証し、内容の指紋で移動・名前変更を追う。
+    保存はプロセス間ロックの中で行い、読み込み後に他のプロセスが保存した項目を取り込んでから書く
+    （同じフォルダを複数のプロセスで開いても、互いのサムネイルを上書きで失わない）。
+    """
     def __init__(self, folder=None, max_items=25000, max_bytes=3*1024*1024*1024):
         self.folder = folder
         self.cache_file = get_thumb_cache_file(folder)
         self.cache = {}  # key: (filepath, size), value: PIL.Image
+        self.signatures = {}  # key: filepath, value: サムネイル作成時の (size, mtime_ns, inode, dev)
+        self.checked = set()  # このセッションで署名が現在のファイルと一致すると確認済みのfilepath
+        self.fingerprints = {}  # key: filepath, value: 内容の指紋（移動・名前変更の検出用）
+        self.by_fingerprint = {}  # key: 内容の指紋, value: filepath
+        self.dropped = set()  # 読み込み後に破棄したfilepath（保存時に他のプロセスの古い項目を取り込まない）
+        self.cleared = False  # 読み込み後にclear()したか（保存時に何も取り込まない）
         self.lock = threading.Lock()
+        self.file_lock = cache_lock(self.cache_file)
         self.access_times = {}  # key: (filepath, size), value: last access timestamp
         self.max_items = max_items  # 最大エントリ数
         self.max_bytes = max_bytes  # 最大バイト数
@@ -33,33 +56,177 @@ class ThumbnailCache:
 
     def load(self):
         try:
-            with open(self.cache_file, "rb") as f:
-                self.cache = pickle.load(f)
+            self.cache, self.signatures, self.fingerprints = _unpack_thumb_cache(load_cache(self.cache_file))
+            self.by_fingerprint = {fp: p for p, fp in self.fingerprints.items() if fp is not None}
             # アクセスタイム初期化
             self.access_times = {k: time.time() for k in self.cache.keys()}
             self.total_bytes = sum(self._estimate_size(v) for v in self.cache.values())
         except Exception:
             self.cache = {}
+            self.signatures = {}
+            self.fingerprints = {}
+            self.by_fingerprint = {}
             self.access_times = {}
             self.total_bytes = 0
+        self.checked = set()
+        self.dropped = set()
+        self.cleared = False
+        self.validate()
 
-    def save(self):
+    def save(self, compact_ratio=None):
+        """
+        キャッシュをファイルに保存する。
+        存在しない・変更されたファイルの項目がcompact_ratio（既定: constants.CACHE_GC_DEAD_RATIO）を超えていれば先に削除する。
+        移動されたファイルはこのセッションで指紋により引き継いだ後なので、移動先の項目は残る。
+        """
+        self.compact(constants.CACHE_GC_DEAD_RATIO if compact_ratio is None else compact_ratio, save=False)
+        self._write()
+
+    def _write(self):
         with self.lock:
             try:
-                with open(self.cache_file, "wb") as f:
-                    pickle.dump(self.cache, f)
+                with self.file_lock:
+                    if not self.cleared:
+                        self._merge_saved()
+                    save_cache(self.cache_file, pickle.dumps((self.cache, self.signatures, self.fingerprints)))
+                self.dropped = set()
+                self.cleared = False
             except Exception:
                 pass
 
+    def _merge_saved(self):
+        # 読み込み後に他のプロセスが保存した、このインスタンスの知らないファイルの項目を取り込む
+        raw = load_cache(self.cache_file)
+        if raw is None:
+            return
+        cache, signatures, fingerprints = _unpack_thumb_cache(raw)
+        known = set(self.signatures) | self.dropped
+        now = time.time()
+        for key, value in cache.items():
+            if key[0] in known or key in self.cache:
+                continue
+            self.cache[key] = value
+            self.access_times[key] = now
+            self.total_bytes += self._estimate_size(value)
+        for path, signature in signatures.items():
+            if path in known:
+                continue
+            self.signatures[path] = signature
+            fp = fingerprints.get(path)
+            if fp is not None:
+                self.fingerprints[path] = fp
+                self.by_fingerprint.setdefault(fp, path)
+        self._cleanup_if_needed()
+
+    def validate(self, paths=None):
+        """
+        キャッシュ済みファイルの署名をまとめて確認し（ディレクトリごとに1回のscandir）、
+        作成後に変更・置き換えされたファイルのサムネイルを破棄する。
+        存在しないファイル（移動・名前変更された可能性がある）は破棄せず、移動先で内容の指紋により再利用する。
+        戻り値: 破棄したファイル数
+        """
+        with self.lock:
+            if paths is None:
+                paths = set(k[0] for k in self.cache)
+            current = stat_signatures(paths)
+            stale = set(p for p, sig in current.items() if sig is not None and sig != self.signatures.get(p))
+            self._drop(stale)
+            self.checked.update(p for p, sig in current.items() if sig is not None and p not in stale)
+            return len(stale)
+
+    def compact(self, min_dead_ratio=0.0, save=True):
+        """
+        存在しない・作成後に変更されたファイルの項目と、サムネイルの無いファイルの署名・指紋を削除する。
+        署名はまとめて確認する（ディレクトリごとに1回のscandir）。
+        ボリュームごと読めないファイル（接続の切れた共有・取り外したドライブなど）の項目は残す
+        （削除・移動されたフォルダの項目は削除する）。
+        min_dead_ratio: 削除対象のファイルの割合がこれ未満なら何もしない（自動圧縮用）
+        save: Trueならキャッシュファイルを書き直す
+        戻り値: CompactResult（entries/removedはサムネイルの件数、bytes_reclaimedはsave=Trueの場合のみ）
+        """
+        with self.lock:
+            paths = set(k[0] for k in self.cache) | set(self.signatures)
+            unreachable = set()
+            current = stat_signatures(paths, unreachable)
+            dead = set(p for p, sig in current.items() if p not in unreachable and (sig is None or sig != self.signatures.get(p)))
+            if not dead or len(dead) < min_dead_ratio * len(paths):
+                return CompactResult(len(self.cache), 0, 0)
+            count = len(self.cache)
+            self._drop(dead)
+            # LRUで追い出されたサムネイルの署名・指紋も残さない
+            self._drop(set(self.signatures) - set(k[0] for k in self.cache))
+            self.checked.difference_update(dead)
+            removed = count - len(self.cache)
+        if not save:
+            return CompactResult(count, removed, 0)
+        before = file_bytes(self.cache_file)
+        self._write()
+        return CompactResult(count, removed, max(0, before - file_bytes(self.cache_file)))
+
+    def _drop(self, paths):
+        for key in [k for k in self.cache if k[0] in paths]:
+            self.total_bytes -= self._estimate_size(self.cache.pop(key))
+            self.access_times.pop(key, None)
+        self.dropped.update(paths)
+        for p in paths:
+            self.signatures.pop(p, None)
+            fp = self.fingerprints.pop(p, None)
+            if fp is not None and self.by_fingerprint.get(fp) == p:
+                del self.by_fingerprint[fp]
+
+    def _remember(self, path, signature, fingerprint):
+        self.signatures[path] = signature
+        self.checked.add(path)
+        if fingerprint is not None:
+            self.fingerprints[path] = fingerprint
+            self.by_fingerprint[fingerprint] = path
+
+    def _check(self, path, signature=None):
+        # 保存済みの署名が現在のファイルと一致するか確認し、一致しなければそのファイルのサムネイルを破棄する
+        # 戻り値: (一致したか, 現在の署名)
+        if path in self.checked and signature is None:
+            return True, self.signatures.get(path)
+        if signature is None:
+            signature = stat_signature(path)
+        if path in self.signatures and signature == self.signatures[path]:
+            self.checked.add(path)
+            return True, signature
+        if path in self.signatures and signature is not None:
+            self._drop({path})
+        return False, signature
+
+    def _adopt(self, path, signature):
+        # 同じ内容の指紋を持つ別のパス（移動・名前変更前）のサムネイルをこのパスに引き継ぐ
+        fingerprint = content_fingerprint(path)
+        old = self.by_fingerprint.get(fingerprint)
+        if old is None or old == path:
+            return False
+        for (p, size) in [k for k in self.cache if k[0] == old]:
+            self.cache[(path, size)] = self.cache[(p, size)]
+            self.access_times[(path, size)] = time.time()
+            self.total_bytes += self._estimate_size(self.cache[(path, size)])
+        self._remember(path, signature, fingerprint)
+        return True
+
     def get(self, key):
         with self.lock:
+            # まとめて確認していないファイルはここで1件だけ確認する
+            path = key[0] if isinstance(key, tuple) else key
+            valid, signature = self._check(path)
+            if not valid and (signature is None or not self._adopt(path, signature)):
+                return None
             v = self.cache.get(key)
             if v is not None:
                 self.access_times[key] = time.time()
             return v
 
-    def set(self, key, value):
+    def set(self, key, value, signature=None):
         with self.lock:
+            path = key[0]
+            valid, signature = self._check(path, signature)
+            if not valid:
+                # 変更されたファイルの別サイズのサムネイルも破棄済み。新しい署名・指紋で登録し直す
+                self._remember(path, signature, content_fingerprint(path) if signature is not None else None)
             if key not in self.cache:
                 self.total_bytes += self._estimate_size(value)
             else:
@@ -72,8 +239,13 @@ class ThumbnailCache:
     def clear(self):
         with self.lock:
             self.cache = {}
+            self.signatures = {}
+            self.fingerprints = {}
+            self.by_fingerprint = {}
+            self.checked = set()
             self.access_times = {}
             self.total_bytes = 0
+            self.cleared = True
 
     def _estimate_size(self, img):
         # PIL.Imageのバイトサイズ推定
@@ -253,3 +425,15 @@ def clear_thumbnail_cache(cache_or_folder=None):
         cache = ThumbnailCache(cache_or_folder)
     cache.clear()
     cache.save()
+
+def compact_thumbnail_cache(cache_or_folder=None):
+    """
+    サムネイルキャッシュから存在しない・変更されたファイルの項目を削除し、ファイルを書き直す。
+    cache_or_folder: ThumbnailCacheインスタンス または フォルダパス/None
+    戻り値: CompactResult
+    """
+    if isinstance(cache_or_folder, ThumbnailCache):
+        cache = cache_or_folder
+    else:
+        cache = ThumbnailCache(cache_or_folder)
+    return cache.compact()
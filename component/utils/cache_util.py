@@ -1,8 +1,15 @@
+import hashlib
 import os
 import time
 from cryptography.fernet import Fernet
 import tempfile
 import pickle
+from collections import namedtuple
+from filelock import FileLock
+
+# キャッシュの圧縮(compact)の結果
+# entries: 確認した項目数, removed: 削除した項目数, bytes_reclaimed: 減ったファイルサイズ（バイト）
+CompactResult = namedtuple("CompactResult", ["entries", "removed", "bytes_reclaimed"])
 
 def get_key(key_file):
     if not os.path.exists(key_file):
@@ -20,19 +27,71 @@ def get_key(key_file):
             key = f.read()
     return key
 
+# 保存形式: _CACHE_MAGIC + SHA-256(データ) + データ（マジックの無いファイルは旧形式としてそのまま読む）
+_CACHE_MAGIC = b"PHCACHE1"
+_DIGEST_SIZE = 32
+
+# プロセス間ロックを待つ最大時間（秒）。超えたらfilelock.Timeoutを送出する
+CACHE_LOCK_TIMEOUT = 120
+
+def cache_lock(cache_file, timeout=CACHE_LOCK_TIMEOUT):
+    """
+    キャッシュファイルのプロセス間ロック（cache_file + ".lock"）。書き込む側だけが取る。
+    読み込みはsave_cacheの置き換え（またはSQLiteのWAL）で常に完全なファイルが見えるので、ロックを取らない。
+    同じインスタンスは同じスレッド内で再入できる。
+    """
+    return FileLock(cache_file + ".lock", timeout=timeout)
+
 def save_cache(cache_file, data):
-    with open(cache_file, "wb") as f:
-        f.write(data)
+    """
+    同じディレクトリの一時ファイルに書いてからos.replaceで置き換える（書き込み途中で壊れたファイルを残さない）。
+    """
+    folder = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_CACHE_MAGIC + hashlib.sha256(data).digest() + data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, cache_file)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
 
 def load_cache(cache_file, key_file=None):
+    """
+    キャッシュのバイト列を返す。存在しない・チェックサムが合わない場合はNone。
+    """
     try:
         with open(cache_file, "rb") as f:
-            return f.read()
+            raw = f.read()
     except Exception:
         return None
+    if not raw.startswith(_CACHE_MAGIC):
+        return raw
+    head = len(_CACHE_MAGIC) + _DIGEST_SIZE
+    digest, data = raw[len(_CACHE_MAGIC):head], raw[head:]
+    if hashlib.sha256(data).digest() != digest:
+        return None
+    return data
 
 def delete_cache(cache_file):
     try:
         os.remove(cache_file)
     except Exception:
         pass
+
+def file_bytes(*paths):
+    """
+    存在するファイルのサイズの合計（SQLiteのWALファイルなど、無いことのあるファイルも含めて数える）。
+    """
+    total = 0
+    for p in paths:
+        try:
+            total += os.path.getsize(p)
+        except OSError:
+            pass
+    return total
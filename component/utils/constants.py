@@ -1,4 +1,20 @@
 # constants.py
 # 定数管理: 拡張子・パス・UIサイズ・色など
+import os
 
-# ...ここに定数や設定値を定義...
+# キャッシュ・インデックスの保存先ディレクトリ（環境変数 PYTHONHELLO_CACHE_DIR で変更可能）
+CACHE_DIR = os.environ.get("PYTHONHELLO_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".pythonhello", "cache")
+
+# ライブラリ全体インデックス（複数ルートフォルダのpHash・メタデータ）のファイル名
+LIBRARY_INDEX_FILE = "library_index.sqlite3"
+
+# 特徴量キャッシュ（pHash・動画シグネチャ・顔特徴量など）のファイル名
+FEATURE_STORE_FILE = "features.sqlite3"
+
+# キャッシュの自動圧縮: 存在しない・変更されたファイルの項目がこの割合を超えたら削除して書き直す
+CACHE_GC_DEAD_RATIO = 0.25
+# 特徴量ストアの自動圧縮を確認する間隔（秒）
+CACHE_GC_INTERVAL = 24 * 60 * 60
+
+# ライブラリ全体インデックスの列指向ファイル（component.hash_store）のファイル名
+HASH_STORE_FILE = "library_hashes.phcols"
@@ -0,0 +1,367 @@
+"""
+feature_store.py
+特徴量キャッシュ（pHash・複数ハッシュ署名・動画シグネチャ・顔特徴量など）のSQLiteストア。
+
+主な機能:
+- (パス, 特徴量の種類) を主キーにした1件単位の検索と、まとめての検索・登録
+- ファイルの署名 (size, mtime_ns, inode, dev) による検証（置き換え・上書きされたファイルの特徴量は使わない）
+- 内容の指紋（サイズ + 先頭・中央・末尾ブロックのハッシュ）による、移動・名前変更されたファイルの特徴量の再利用
+- 計算に失敗したファイルの記録（FeatureFailure。ファイルが変わるまで計算し直さない）
+- WALモードでの書き込み（読み込みを止めず、書き込みは1トランザクションでまとめる）
+- 複数プロセスでの共有（読み込みは並行、書き込みはファイルロックで1プロセスずつ）
+- 登録を一定件数・一定時間ごとにまとめて書き込むwrite-behind（終了時にも書き込む）
+- 存在しない・変更されたファイルの項目の削除とDBの書き直し（手動、またはスキャンしたフォルダを一定間隔で確認し割合を超えたら自動）
+- 保存先はconstants.CACHE_DIRの1ファイル（作業ディレクトリに隠しファイルを作らない）
+
+依存:
+- sqlite3, pickle, threading, atexit, filelock (component.utils.cache_util), component.utils.constants, component.utils.file_util
+"""
+
+import atexit
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from component.utils import constants
+from component.utils.cache_util import CACHE_LOCK_TIMEOUT, CompactResult, cache_lock, file_bytes
+from component.utils.file_util import content_fingerprints, normalize_path, stat_signature, stat_signatures
+
+# 種類を指定しない特徴量（従来キャッシュのキーがパスだけだったもの）
+DEFAULT_FEATURE = ""
+
+# 特徴量を計算できなかったことの記録。値の代わりに同じキー・署名で登録する
+# reason: 理由コード（呼び出し側で定義する。例: duplicate_finder.FAILURE_DECODE）
+FeatureFailure = namedtuple("FeatureFailure", ["reason"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS features (
+    path TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    dev INTEGER,
+    fingerprint TEXT,
+    PRIMARY KEY (path, feature)
+) WITHOUT ROWID;
+"""
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS features_fingerprint ON features(fingerprint, feature);
+"""
+
+# ストアの管理情報（最後に自動圧縮を確認した時刻など）
+_META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# 署名の列（署名の無い古い行はNULLで、現在のファイルとは一致しない）
+_SIGNATURE_COLUMNS = ("size", "mtime_ns", "inode", "dev")
+
+# 登録をまとめて書き込む件数と間隔（秒）
+FEATURE_FLUSH_COUNT = 500
+FEATURE_FLUSH_SECONDS = 5.0
+
+# SQLiteの1文で使えるパラメータ数の上限（古いSQLiteの既定値）
+_SQL_PARAMS_MAX = 999
+
+def get_feature_store_path():
+    return os.path.join(constants.CACHE_DIR, constants.FEATURE_STORE_FILE)
+
+def _store_path(path):
+    # 作業ディレクトリに依らないよう絶対パスで正規化する
+    return normalize_path(os.path.abspath(path))
+
+def _under(folder):
+    # folder配下のパスの範囲（主キーの範囲検索に使う）
+    prefix = os.path.join(_store_path(folder), "")
+    return prefix, prefix + "\U0010ffff"
+
+def _columns(signature):
+    # 署名を列の値に変換する（ファイルが無ければすべてNULL）
+    # inode/devは符号なし64bitになりうるため、SQLiteの符号付き64bit整数に収める
+    if signature is None:
+        return (None,) * len(_SIGNATURE_COLUMNS)
+    return tuple(v - (1 << 64) if v >= (1 << 63) else v for v in signature)
+
+class FeatureStore:
+    """
+    特徴量のSQLiteストア。値はpickleしてBLOBで保存する（FeatureFailureも値として返す）。
+    1つの接続をスレッド間で共有する（操作はロックで直列化する）。
+    登録はメモリ上に溜め（write-behind）、件数(flush_count)か経過時間(flush_seconds)を超えたら
+    1トランザクションでまとめて書き込む。溜めている間も検索結果には含める。
+    同じDBを複数プロセス（GUIと一括処理、ワーカープロセスなど）で共有できる。読み込みはWALで並行に行い、
+    書き込み（スキーマの作成・登録・削除・圧縮）はDBごとのファイルロック(write_lock)で1プロセスずつ行う。
+    行は (path, feature) 単位で置き換えるので、別々のプロセスが登録した特徴量は失われない。
+    """
+    def __init__(self, db_path=None, flush_count=FEATURE_FLUSH_COUNT, flush_seconds=FEATURE_FLUSH_SECONDS):
+        self.db_path = db_path or get_feature_store_path()
+        self.pid = os.getpid()
+        self.flush_count = flush_count
+        self.flush_seconds = flush_seconds
+        self.pending = {}  # key: (path, feature), value: 書き込む行
+        self.last_flush = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.write_lock = cache_lock(self.db_path)
+        # VACUUMなど他プロセスの排他操作中は、エラーにせず待つ
+        self.conn = sqlite3.connect(self.db_path, timeout=CACHE_LOCK_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.write_lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(_SCHEMA)
+            columns = set(r[1] for r in self.conn.execute("PRAGMA table_info(features)"))
+            for name in _SIGNATURE_COLUMNS:
+                if name not in columns:
+                    self.conn.execute(f"ALTER TABLE features ADD COLUMN {name} INTEGER")
+            if "fingerprint" not in columns:
+                self.conn.execute("ALTER TABLE features ADD COLUMN fingerprint TEXT")
+            self.conn.executescript(_INDEXES)
+            self.conn.executescript(_META_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            self._flush()
+            return self.conn.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def flush(self):
+        """
+        溜めている登録を書き込む。
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            with self.write_lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?)", list(self.pending.values()))
+            self.pending = {}
+        self.last_flush = time.monotonic()
+
+    def get(self, path, feature=DEFAULT_FEATURE, signature=None):
+        """
+        1件の特徴量を返す。未登録か、登録時からファイルが変わっていればNone。
+        signature: ファイルの署名（省略時はstatで取得する）
+        """
+        if signature is None:
+            signature = stat_signature(path)
+        key = _store_path(path)
+        with self.lock:
+            row = self.pending.get((key, feature))
+            if row is not None:
+                row = row[2:7]
+            else:
+                row = self.conn.execute(
+                    "SELECT value, size, mtime_ns, inode, dev FROM features WHERE path = ? AND feature = ?",
+                    (key, feature),
+                ).fetchone()
+        if row is None or tuple(row[1:]) != _columns(signature):
+            return None
+        return pickle.loads(row[0])
+
+    def get_many(self, paths, feature=DEFAULT_FEATURE, signatures=None):
+        """
+        複数の特徴量をまとめて返す。戻り値: {path: 値}（登録済みで、ファイルが変わっていないものだけ。キーは引数のパス）
+        signatures: {path: 署名}（省略時はstat_signaturesでまとめて取得する）
+        """
+        if signatures is None:
+            signatures = stat_signatures(paths)
+        keys = {}
+        for p in paths:
+            keys.setdefault(_store_path(p), []).append(p)
+        found = {}
+        with self.lock:
+            rows = [row for row in (self.pending.get((k, feature)) for k in keys) if row is not None]
+            stored = [k for k in keys if (k, feature) not in self.pending]
+            for i in range(0, len(stored), _SQL_PARAMS_MAX - 1):
+                chunk = stored[i:i + _SQL_PARAMS_MAX - 1]
+                rows += self.conn.execute(
+                    "SELECT path, feature, value, size, mtime_ns, inode, dev FROM features WHERE feature = ? AND path IN (%s)" % ",".join("?" * len(chunk)),
+                    [feature] + chunk,
+                ).fetchall()
+        for row in rows:
+            value = None
+            for p in keys[row[0]]:
+                if tuple(row[3:7]) != _columns(signatures.get(p)):
+                    continue
+                if value is None:
+                    value = pickle.loads(row[2])
+                found[p] = value
+        return found
+
+    def get_moved(self, paths, feature=DEFAULT_FEATURE, signatures=None, fingerprints=None):
+        """
+        パスでは見つからないファイルについて、内容の指紋が同じ登録（移動・名前変更前のパスや同一内容のコピー）を探し、
+        見つかった特徴量をそのパスでも登録する（デコードし直さずに再利用する）。
+        戻り値: {path: 値}
+        signatures / fingerprints: {path: 署名} / {path: 指紋}（省略時はまとめて取得する）
+        """
+        if fingerprints is None:
+            fingerprints = content_fingerprints(paths)
+        wanted = sorted(set(fp for fp in (fingerprints.get(p) for p in paths) if fp is not None))
+        blobs = {}
+        with self.lock:
+            self._flush()
+            for i in range(0, len(wanted), _SQL_PARAMS_MAX - 1):
+                chunk = wanted[i:i + _SQL_PARAMS_MAX - 1]
+                rows = self.conn.execute(
+                    "SELECT fingerprint, value FROM features WHERE feature = ? AND fingerprint IN (%s)" % ",".join("?" * len(chunk)),
+                    [feature] + chunk,
+                )
+                for fp, value in rows:
+                    blobs.setdefault(fp, value)
+        hits = [p for p in paths if fingerprints.get(p) in blobs]
+        if not hits:
+            return {}
+        if signatures is None:
+            signatures = stat_signatures(hits)
+        rows = [(_store_path(p), feature, blobs[fingerprints[p]]) + _columns(signatures.get(p)) + (fingerprints[p],) for p in hits]
+        self._queue(rows, feature)
+        return {p: pickle.loads(blobs[fingerprints[p]]) for p in hits}
+
+    def put(self, path, value, feature=DEFAULT_FEATURE, signature=None, fingerprint=None):
+        self.put_many([(path, value)], feature,
+                      None if signature is None else {path: signature},
+                      None if fingerprint is None else {path: fingerprint})
+
+    def put_many(self, items, feature=DEFAULT_FEATURE, signatures=None, fingerprints=None):
+        """
+        [(path, 値), ...] をファイルの署名・内容の指紋と一緒に登録する（同じキーは置き換える）。
+        書き込みはflush_count件かflush_seconds秒ごとにまとめて行う。
+        signatures / fingerprints: {path: 署名} / {path: 指紋}（省略時はまとめて取得する）
+        """
+        items = list(items)
+        if not items:
+            return
+        if signatures is None:
+            signatures = stat_signatures([p for p, _ in items])
+        if fingerprints is None:
+            fingerprints = content_fingerprints([p for p, _ in items])
+        rows = [(_store_path(p), feature, pickle.dumps(v)) + _columns(signatures.get(p)) + (fingerprints.get(p),) for p, v in items]
+        self._queue(rows, feature)
+
+    def _queue(self, rows, feature):
+        with self.lock:
+            self.pending.update(((row[0], feature), row) for row in rows)
+            if len(self.pending) >= self.flush_count or time.monotonic() - self.last_flush >= self.flush_seconds:
+                self._flush()
+
+    def delete(self, paths, feature=None):
+        """
+        パスの特徴量を削除する（feature=Noneなら全種類）。
+        """
+        with self.lock:
+            self._flush()
+            if feature is None:
+                rows = [(_store_path(p),) for p in paths]
+                sql = "DELETE FROM features WHERE path = ?"
+            else:
+                rows = [(_store_path(p), feature) for p in paths]
+                sql = "DELETE FROM features WHERE path = ? AND feature = ?"
+            with self.write_lock, self.conn:
+                self.conn.executemany(sql, rows)
+
+    def compact(self, min_dead_ratio=0.0, roots=None):
+        """
+        存在しない・登録時から変更されたファイルの項目を削除し、DBを書き直して(VACUUM)ファイルを縮める。
+        署名はstat_signaturesでまとめて取得する（ディレクトリごとに1回のscandir）。
+        ボリュームごと読めないファイル（接続の切れた共有・取り外したドライブなど）の項目は、
+        削除されたのか一時的に見えないだけなのか分からないので残す（削除・移動されたフォルダの項目は削除する）。
+        min_dead_ratio: 削除対象の割合がこれ未満なら何もしない（自動圧縮用）
+        roots: 指定時はこれらのフォルダ配下の項目だけを確認する（割合もその範囲で数える）
+        戻り値: CompactResult
+        """
+        with self.lock:
+            self._flush()
+            query = "SELECT path, feature, size, mtime_ns, inode, dev FROM features"
+            if roots is None:
+                rows = self.conn.execute(query).fetchall()
+            else:
+                rows = []
+                for root in sorted(set(roots)):
+                    rows += self.conn.execute(query + " WHERE path >= ? AND path < ?", _under(root)).fetchall()
+                # 入れ子のフォルダを指定しても同じ行を二重に数えない
+                rows = list(dict.fromkeys(rows))
+            unreachable = set()
+            current = stat_signatures(set(r[0] for r in rows), unreachable)
+            dead = [
+                r for r in rows
+                if r[0] not in unreachable and (current.get(r[0]) is None or tuple(r[2:]) != _columns(current[r[0]]))
+            ]
+            if not dead or len(dead) < min_dead_ratio * len(rows):
+                return CompactResult(len(rows), 0, 0)
+            files = (self.db_path, self.db_path + "-wal")
+            with self.write_lock:
+                before = file_bytes(*files)
+                with self.conn:
+                    # 確認後に他のプロセスが登録し直した行は消さない（署名が変わっていない行だけ削除する）
+                    self.conn.executemany(
+                        "DELETE FROM features WHERE path = ? AND feature = ? AND size IS ? AND mtime_ns IS ? AND inode IS ? AND dev IS ?",
+                        dead,
+                    )
+                self.conn.execute("VACUUM")
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                return CompactResult(len(rows), len(dead), max(0, before - file_bytes(*files)))
+
+    def auto_compact(self, roots, min_dead_ratio=None, interval=None):
+        """
+        rootsの各フォルダについて、前回の確認からinterval秒以上経っていれば、
+        そのフォルダ配下の削除対象がmin_dead_ratioを超えた場合だけ圧縮する（スキャンしたフォルダだけを見る）。
+        戻り値: CompactResult（確認したフォルダが無ければNone）
+        """
+        min_dead_ratio = constants.CACHE_GC_DEAD_RATIO if min_dead_ratio is None else min_dead_ratio
+        interval = constants.CACHE_GC_INTERVAL if interval is None else interval
+        now = time.time()
+        due = []
+        # 確認と時刻の記録を1プロセスずつ行い、同時に動く複数のプロセスで重ねて圧縮しない
+        with self.lock, self.write_lock:
+            for root in sorted(set(_store_path(r) for r in roots)):
+                row = self.conn.execute("SELECT value FROM meta WHERE key = ?", ("last_gc:" + root,)).fetchone()
+                if row is None or now - row[0] >= interval:
+                    due.append(root)
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [("last_gc:" + root, now) for root in due])
+        if not due:
+            return None
+        return self.compact(min_dead_ratio, due)
+
+# プロセスごとに共有するストア（ProcessPoolExecutorのfork先で親の接続を使わないようpidも見る）
+_shared_store = None
+
+def get_feature_store():
+    """
+    constants.CACHE_DIRのストアを返す（同じプロセスでは同じインスタンスを使い回す）。
+    """
+    global _shared_store
+    path = get_feature_store_path()
+    store = _shared_store
+    if store is None or store.db_path != path or store.pid != os.getpid():
+        if store is not None and store.pid == os.getpid():
+            store.close()
+        store = FeatureStore(path)
+        _shared_store = store
+    return store
+
+@atexit.register
+def _flush_shared_store():
+    # 終了時に溜めている登録を書き込む（fork先のプロセスでは親のストアに触らない）
+    store = _shared_store
+    if store is not None and store.pid == os.getpid():
+        store.flush()
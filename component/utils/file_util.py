@@ -1,5 +1,5 @@
 # file_util.py
-# ファイル操作: ファイル/ディレクトリ移動・削除・ゴミ箱移動
+# ファイル操作: ファイル/ディレクトリ移動・削除・ゴミ箱移動・変更検出用のstat署名・内容の指紋
 import os
 import shutil
 
@@ -62,3 +62,96 @@ def get_folder_state(folder):
             except Exception:
                 pass
     return total_files, total_bytes, last_modified
+
+def _signature(st, ino, dev):
+    return (st.st_size, st.st_mtime_ns, ino, dev)
+
+def stat_signature(path):
+    """
+    ファイルの変更検出用の署名 (size, mtime_ns, inode, dev) を返す。存在しない場合はNone。
+    devはディレクトリのもの（stat_signaturesのscandirで得られる値と揃えるため）。
+    """
+    try:
+        st = os.stat(path)
+        dev = os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+    except OSError:
+        return None
+    return _signature(st, st.st_ino, dev)
+
+def _volume_unreachable(folder, error):
+    # folderを読めなかった原因がボリューム（ドライブ・共有）ごと読めないことか。
+    # ディレクトリが無いだけなら、祖先が1つも存在しない（ドライブごと無い）場合に限る
+    if not isinstance(error, (FileNotFoundError, NotADirectoryError)):
+        return True
+    parent = os.path.dirname(folder)
+    while parent != folder:
+        if os.path.isdir(parent):
+            return False
+        folder, parent = parent, os.path.dirname(parent)
+    return True
+
+def stat_signatures(paths, unreachable=None):
+    """
+    複数ファイルの署名をディレクトリごとに1回のscandirでまとめて取得する（ファイルは開かない）。
+    戻り値: {path: 署名 or None}（キーは引数のパス）
+    unreachable: setを渡すと、ディレクトリを読めず確認できなかったパスを追加する
+                 （接続の切れたネットワーク共有・外されたドライブなど。削除されたとは限らない）。
+                 ディレクトリが無いだけで祖先が存在する場合（フォルダの削除・移動）は含めない
+    """
+    by_dir = {}
+    for p in paths:
+        full = os.path.abspath(p)
+        by_dir.setdefault(os.path.dirname(full), {}).setdefault(os.path.basename(full), []).append(p)
+    result = {}
+    for folder, names in by_dir.items():
+        try:
+            dev = os.stat(folder).st_dev
+            with os.scandir(folder) as it:
+                for entry in it:
+                    wanted = names.get(entry.name)
+                    if wanted is None:
+                        continue
+                    try:
+                        st = entry.stat()
+                        # Windowsのscandirはst_inoを持たないのでinode()で取得する
+                        sig = _signature(st, st.st_ino or entry.inode(), dev)
+                    except OSError:
+                        sig = None
+                    for p in wanted:
+                        result[p] = sig
+        except OSError as e:
+            if unreachable is not None and _volume_unreachable(folder, e):
+                unreachable.update(p for wanted in names.values() for p in wanted)
+        for wanted in names.values():
+            for p in wanted:
+                result.setdefault(p, None)
+    return result
+
+# 内容の指紋で読むブロックの大きさ（先頭・中央・末尾の3か所）
+FINGERPRINT_BLOCK = 64 * 1024
+
+def content_fingerprint(path, block=FINGERPRINT_BLOCK):
+    """
+    ファイル内容の指紋（サイズ + 先頭・中央・末尾ブロックのBLAKE2）。読めない場合はNone。
+    移動・名前変更されたファイルをパスに依らず同じファイルと判定するのに使う。
+    """
+    import hashlib
+    try:
+        size = os.path.getsize(path)
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            if size <= 3 * block:
+                h.update(f.read())
+            else:
+                for offset in (0, size // 2 - block // 2, size - block):
+                    f.seek(offset)
+                    h.update(f.read(block))
+    except OSError:
+        return None
+    return f"{size}-{h.hexdigest()}"
+
+def content_fingerprints(paths, block=FINGERPRINT_BLOCK):
+    """
+    戻り値: {path: 指紋 or None}
+    """
+    return {p: content_fingerprint(p, block) for p in paths}
@@ -0,0 +1,210 @@
+"""
+video_signature.py
+動画のフレームごとのpHash列（時間方向の署名）と部分一致（切り出し・トリミング）検出。
+
+主な機能:
+- 一定時間間隔でサンプリングしたフレームのpHash列(np.uint64)の計算・キャッシュ
+- 2本の動画の署名を対角線方向に整列し、重なり区間を検出
+- フレームハッシュのバンド転置インデックスによる候補ペアの絞り込み
+
+依存:
+- OpenCV, numpy, imagehash, component.duplicate_finder, component.utils.hash_util
+"""
+
+import os
+from collections import Counter, namedtuple
+import cv2
+import imagehash
+import numpy as np
+from PIL import Image
+from component.duplicate_finder import get_features_with_cache, read_frames_seek, read_frames_sequential, VIDEO_EXTS
+from component.utils.file_util import normalize_path
+from component.utils.hash_util import hash_to_int, hamming_matrix
+
+# 署名のサンプリング間隔（秒）と最大フレーム数
+SIGNATURE_INTERVAL = 2.0
+SIGNATURE_MAX_FRAMES = 3600
+
+# 候補ペア生成に使うバンド数（64bitを32bit x 2に分割）と、1バケットに入る動画数の上限
+# 16bitバンドでは数百万フレームで偶然の一致が爆発するため32bitにする。部分一致は多数のフレームに
+# またがるので、フレーム単位の取りこぼしがあっても複数フレームのどれかでバンドが一致すれば拾える。
+# （黒画面など多くの動画に共通するフレームはバケットが巨大になるため候補生成から除外する）
+SIGNATURE_BANDS = 2
+MAX_BUCKET_VIDEOS = 64
+
+# interval: サンプリング間隔(秒), hashes: フレームごとのpHash(np.uint64配列)
+VideoSignature = namedtuple("VideoSignature", ["interval", "hashes"])
+# offset: bの先頭に対するaの先頭の位置(秒), matched: 一致フレーム数, coverage: 短い方の動画に対する一致率
+SubclipMatch = namedtuple("SubclipMatch", ["offset", "matched", "coverage"])
+
+def calc_video_signature(path, interval=SIGNATURE_INTERVAL, max_frames=SIGNATURE_MAX_FRAMES):
+    """
+    interval秒ごとのフレームのpHash列を計算する。
+    k番目のサンプルは時刻k*intervalに最も近いフレーム（round(k*interval*fps)）にするので、
+    fpsに依らず間隔はintervalのままになる（29.97fpsと30fpsの動画も同じ時刻を比べる）。
+    長い動画はmax_frames以内に収まるようintervalを整数倍に広げる。
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if length <= 0:
+            return None
+        if not fps or fps <= 0 or np.isnan(fps):
+            fps = 30.0
+        duration = length / fps
+        interval *= max(1, int(np.ceil(duration / (interval * max_frames))))
+        count = min(max_frames, int(duration // interval) + 1)
+        indices = [min(length - 1, int(round(k * interval * fps))) for k in range(count)]
+        # 密なサンプリングなので、シークを繰り返すより1回の順次デコードの方が速い
+        if count > 1:
+            frames = read_frames_sequential(cap, indices)
+        else:
+            frames = read_frames_seek(cap, indices)
+    finally:
+        cap.release()
+    by_index = {}
+    for frame_no, frame in frames:
+        try:
+            pil_img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            by_index[frame_no] = hash_to_int(imagehash.phash(pil_img))
+        except Exception:
+            continue
+    # 同じフレームが複数の時刻に当たる（fpsがとても低い）場合も時刻ごとに1つずつ並べる
+    hashes = [by_index[i] for i in indices if i in by_index]
+    if not hashes:
+        return None
+    return VideoSignature(interval, np.array(hashes, dtype=np.uint64))
+
+def get_video_signature(filepath, folder=None, cache=None):
+    """
+    動画署名をキャッシュ経由で取得する（pHashと同じキャッシュファイルに保存）。
+    """
+    filepath = normalize_path(filepath)
+    if cache is not None:
+        if filepath not in cache:
+            cache[filepath] = calc_video_signature(filepath)
+        return cache[filepath]
+    return get_features_with_cache(filepath, calc_video_signature, folder, feature="signature")
+
+def _resample(sig, interval):
+    # 細かい間隔の署名を粗い間隔に間引く。k番目は時刻k*intervalに最も近いサンプル
+    # （整数比でなくても長い動画で時刻がずれない）
+    if interval <= sig.interval:
+        return sig.hashes
+    count = int((len(sig.hashes) - 1) * sig.interval / interval + 1e-9) + 1
+    indices = np.minimum(np.rint(np.arange(count) * (interval / sig.interval)).astype(np.int64), len(sig.hashes) - 1)
+    return sig.hashes[indices]
+
+def match_signatures(sig_a, sig_b, threshold=10, min_frames=3, min_coverage=0.5):
+    """
+    2つの署名の部分一致を調べる。
+    フレーム間のハミング距離行列を一括計算し、距離threshold未満の一致を対角線（時間オフセット）ごとに
+    集計して最も一致の多いオフセットを採用する。±1サンプルの揺れは同じオフセットとして数える。
+    戻り値: SubclipMatch または None
+    """
+    if sig_a is None or sig_b is None:
+        return None
+    interval = max(sig_a.interval, sig_b.interval)
+    a = _resample(sig_a, interval)
+    b = _resample(sig_b, interval)
+    m, n = len(a), len(b)
+    if m == 0 or n == 0:
+        return None
+    ii, jj = np.nonzero(hamming_matrix(a, b) < threshold)
+    if len(ii) == 0:
+        return None
+    # オフセット(j - i)ごとの一致数。aの同じフレームを重複して数えないよう(i, offset)で一意化
+    offsets = jj - ii + (m - 1)
+    shifted = np.concatenate([offsets - 1, offsets, offsets + 1])
+    rows = np.concatenate([ii, ii, ii])
+    valid = (shifted >= 0) & (shifted < m + n - 1)
+    keys = np.unique(rows[valid] * (m + n) + shifted[valid])
+    counts = np.bincount(keys % (m + n), minlength=m + n - 1)
+    # 同数の場合は揺れを含まない一致数が多いオフセットを優先
+    exact = np.bincount(offsets, minlength=len(counts))
+    best = int(np.lexsort((exact, counts))[-1])
+    matched = int(min(counts[best], min(m, n)))
+    coverage = matched / min(m, n)
+    if matched < min_frames or coverage < min_coverage:
+        return None
+    return SubclipMatch((best - (m - 1)) * interval, matched, coverage)
+
+def _band_keys(hashes, bands=SIGNATURE_BANDS):
+    bits = 64 // bands
+    mask = np.uint64((1 << bits) - 1)
+    # バンド番号を上位ビットに埋め込み、異なるバンドの同じ値を区別する
+    keys = [((hashes >> np.uint64(b * bits)) & mask) | np.uint64(b << bits) for b in range(bands)]
+    return np.concatenate(keys)
+
+def candidate_pairs(signatures, min_shared=2, bands=SIGNATURE_BANDS, max_bucket=MAX_BUCKET_VIDEOS):
+    """
+    フレームハッシュのバンド（64/bands bit区間）が完全一致するフレームを持つ動画ペアを列挙する。
+    signatures: [VideoSignature, ...]
+    戻り値: {(i, j): 共有バンド数}（min_shared以上のもののみ）
+    """
+    keys = []
+    vids = []
+    for vid, sig in enumerate(signatures):
+        if sig is None or len(sig.hashes) == 0:
+            continue
+        k = np.unique(_band_keys(sig.hashes, bands))
+        keys.append(k)
+        vids.append(np.full(len(k), vid, dtype=np.int64))
+    if not keys:
+        return {}
+    keys = np.concatenate(keys)
+    vids = np.concatenate(vids)
+    order = np.lexsort((vids, keys))
+    keys = keys[order]
+    vids = vids[order]
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(keys)]))
+    sizes = ends - starts
+    pair_counts = Counter()
+    for s, e in zip(starts[(sizes >= 2) & (sizes <= max_bucket)], ends[(sizes >= 2) & (sizes <= max_bucket)]):
+        members = vids[s:e]
+        for x in range(len(members)):
+            for y in range(x + 1, len(members)):
+                pair_counts[(int(members[x]), int(members[y]))] += 1
+    return {pair: c for pair, c in pair_counts.items() if c >= min_shared}
+
+def find_subclip_matches(file_signatures, threshold=10, min_frames=3, min_coverage=0.5):
+    """
+    署名リストから部分一致する動画ペアを検出する。
+    file_signatures: [(file, VideoSignature), ...]
+    戻り値: [(file_a, file_b, SubclipMatch), ...]
+    """
+    files = [f for f, _ in file_signatures]
+    sigs = [s for _, s in file_signatures]
+    matches = []
+    for (i, j) in sorted(candidate_pairs(sigs, min_shared=min(min_frames, 2))):
+        match = match_signatures(sigs[i], sigs[j], threshold, min_frames, min_coverage)
+        if match is not None:
+            matches.append((files[i], files[j], match))
+    return matches
+
+def find_subclip_groups(files, folder=None, threshold=10, min_frames=3, min_coverage=0.5):
+    """
+    動画ファイルリストから、切り出し・トリミングを含む部分一致グループを返す。
+    重複チェック（find_duplicates_in_folder）とは別に呼び出すライブラリ関数。
+    戻り値: [[file, ...], ...]
+    """
+    videos = [f for f in files if os.path.splitext(f)[1].lower() in VIDEO_EXTS]
+    file_signatures = [(f, get_video_signature(f, folder)) for f in videos]
+    parent = {}
+    def find(x):
+        while parent[x] != x:
+            x = parent[x]
+        return x
+    for f1, f2, _ in find_subclip_matches(file_signatures, threshold, min_frames, min_coverage):
+        parent.setdefault(f1, f1)
+        parent.setdefault(f2, f2)
+        r1, r2 = find(f1), find(f2)
+        if r1 != r2:
+            parent[max(r1, r2)] = min(r1, r2)
+    groups = {}
+    for f in parent:
+        groups.setdefault(find(f), []).append(f)
+    return [sorted(g) for g in groups.values() if len(g) > 1]
@@ -0,0 +1,7 @@
+import pytest
+from component.utils import constants
+
+@pytest.fixture(autouse=True)
+def _isolated_cache_dir(tmp_path, monkeypatch):
+    # 特徴量ストアなどをテストごとの一時ディレクトリに作る（利用者のキャッシュを汚さない）
+    monkeypatch.setattr(constants, "CACHE_DIR", str(tmp_path / "cache"))
@@ -17,3 +17,14 @@ def test_load_cache_not_exist():
         cache_file = os.path.join(tmpdir, "notfound.bin")
         loaded = load_cache(cache_file)
         assert loaded is None
+
+def test_save_cache_replaces_atomically_with_checksum(tmp_path):
+    cache_file = str(tmp_path / "cache.bin")
+    save_cache(cache_file, b"old")
+    save_cache(cache_file, b"new")
+    assert load_cache(cache_file) == b"new"
+    assert os.listdir(str(tmp_path)) == ["cache.bin"]
+    with open(cache_file, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"X")
+    assert load_cache(cache_file) is None
@@ -0,0 +1,332 @@
+import os
+import numpy as np
+from PIL import Image
+from component import duplicate_finder
+from component.duplicate_finder import extract_phashes, find_duplicates_in_folder
+
+def _make_images(folder, n=6):
+    paths = []
+    for i in range(n):
+        path = os.path.join(folder, f"img_{i}.png")
+        rng = np.random.default_rng(i)
+        arr = np.kron(rng.integers(0, 256, (8, 8, 3)), np.ones((8, 8, 1))).astype(np.uint8)
+        Image.fromarray(arr).save(path)
+        paths.append(path)
+    return paths
+
+def test_extract_phashes_keeps_order_and_progress(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path))
+    calls = []
+    result = extract_phashes(files, str(tmp_path), progress_callback=lambda d, t: calls.append((d, t)), max_workers=2)
+    assert [f for f, _ in result] == files
+    assert all(h == duplicate_finder.calc_image_phash(f) for f, h in result)
+    assert calls == [(i + 1, len(files)) for i in range(len(files))]
+
+def test_extract_phashes_uses_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 3)
+    first = extract_phashes(files, str(tmp_path), max_workers=1)
+    monkeypatch.setattr(duplicate_finder, "_calc_phash_task", lambda args: None)
+    second = extract_phashes(files, str(tmp_path), max_workers=1)
+    assert second == first
+
+def test_find_duplicates_in_folder_serial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 2)
+    Image.open(files[0]).save(os.path.join(str(tmp_path), "copy.png"))
+    with open(os.path.join(str(tmp_path), "broken.jpg"), "wb") as f:
+        f.write(b"not an image")
+    groups, _ = find_duplicates_in_folder(str(tmp_path), parallel=False)
+    assert sorted(os.path.basename(f) for f in groups[0]) == ["copy.png", "img_0.png"]
+    assert [os.path.basename(f) for f in groups[-1]] == ["broken.jpg"]
+
+def test_fast_decode_phash_close_to_full_decode(tmp_path):
+    rng = np.random.default_rng(0)
+    path = os.path.join(str(tmp_path), "large.jpg")
+    Image.fromarray(rng.integers(0, 256, (30, 40, 3)).astype(np.uint8)).resize((2400, 1800), Image.BILINEAR).save(path, quality=90)
+    [(f, full, fast, dist)] = duplicate_finder.compare_decode_modes([path])
+    assert full is not None and fast is not None
+    assert dist <= 6
+
+def test_video_samplers_return_same_hash(tmp_path):
+    import cv2
+    path = os.path.join(str(tmp_path), "clip.avi")
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'XVID'), 10.0, (64, 64))
+    rng = np.random.default_rng(1)
+    for _ in range(40):
+        out.write(cv2.resize(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8), (64, 64), interpolation=cv2.INTER_NEAREST))
+    out.release()
+    seek = duplicate_finder.calc_video_phash(path, 7, "seek")
+    sequential = duplicate_finder.calc_video_phash(path, 7, "sequential")
+    assert seek is not None
+    assert seek - sequential <= 2
+
+def test_multihash_signature_groups_copies(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 3)
+    Image.open(files[1]).resize((48, 48)).save(os.path.join(str(tmp_path), "small.png"))
+    sig = duplicate_finder.calc_image_multihash(files[0])
+    assert set(sig) == set(duplicate_finder.DEFAULT_HASH_TYPES)
+    assert sig["phash"] - duplicate_finder.calc_image_phash(files[0]) <= 4
+    groups, _ = find_duplicates_in_folder(str(tmp_path), parallel=False, hash_types=("phash", "dhash", "colorhash"))
+    assert [sorted(os.path.basename(f) for f in g) for g in groups] == [["img_1.png", "small.png"]]
+
+def test_phash_batch_matches_imagehash():
+    import imagehash
+    from component.utils.hash_util import hash_to_int
+    rng = np.random.default_rng(3)
+    imgs = [Image.fromarray(rng.integers(0, 256, (int(rng.integers(16, 200)), int(rng.integers(16, 200)), 3), dtype=np.uint8)) for _ in range(50)]
+    packed = duplicate_finder.phash_batch(np.stack([duplicate_finder.phash_input_array(img) for img in imgs]))
+    assert packed.dtype == np.uint64
+    assert [int(v) for v in packed] == [hash_to_int(imagehash.phash(img)) for img in imgs]
+
+def test_find_exact_duplicates(tmp_path):
+    def write(name, data):
+        path = os.path.join(str(tmp_path), name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+    big = os.urandom(300 * 1024)
+    a = write("a.bin", big)
+    b = write("b.bin", big)
+    # 先頭・末尾が同じで中央だけ異なる
+    c = write("c.bin", big[:150 * 1024] + b"x" + big[150 * 1024 + 1:])
+    d = write("d.bin", b"small")
+    e = write("e.bin", b"small")
+    f = write("f.bin", b"other")
+    assert duplicate_finder.find_exact_duplicates([a, b, c, d, e, f], block=64 * 1024) == [[a, b], [d, e]]
+
+def test_exact_duplicate_digests_are_cached(tmp_path, monkeypatch):
+    big = os.urandom(300 * 1024)
+    paths = []
+    for name in ("a.bin", "b.bin", "c.bin"):
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], "wb") as f:
+            f.write(big)
+    assert duplicate_finder.find_exact_duplicates(paths) == [paths]
+    # 変更されていないファイルは読み直さない
+    calls = []
+    real_partial, real_full = duplicate_finder.partial_file_hash, duplicate_finder.full_file_hash
+    monkeypatch.setattr(duplicate_finder, "partial_file_hash", lambda f, block: calls.append(f) or real_partial(f, block))
+    monkeypatch.setattr(duplicate_finder, "full_file_hash", lambda f: calls.append(f) or real_full(f))
+    assert duplicate_finder.find_exact_duplicates(paths) == [paths]
+    assert calls == []
+    # 同じサイズで中央だけ書き換えたファイルはハッシュし直す
+    with open(paths[2], "r+b") as f:
+        f.seek(150 * 1024)
+        f.write(b"x")
+    os.utime(paths[2], ns=(os.stat(paths[2]).st_atime_ns, os.stat(paths[2]).st_mtime_ns + 10 ** 9))
+    assert duplicate_finder.find_exact_duplicates(paths) == [paths[:2]]
+    assert calls == [paths[2], paths[2]]
+
+def test_exact_copies_skip_phash(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 2)
+    import shutil
+    shutil.copy(files[0], os.path.join(str(tmp_path), "img_0_copy.png"))
+    hashed = []
+    orig = duplicate_finder.extract_phashes
+    def spy(files, *args, **kwargs):
+        hashed.extend(files)
+        return orig(files, *args, **kwargs)
+    monkeypatch.setattr(duplicate_finder, "extract_phashes", spy)
+    reported = []
+    groups, _ = find_duplicates_in_folder(str(tmp_path), parallel=False, exact_callback=reported.append)
+    assert len(hashed) == 2
+    assert [sorted(os.path.basename(f) for f in g) for g in reported[0]] == [["img_0.png", "img_0_copy.png"]]
+    assert [sorted(os.path.basename(f) for f in g) for g in groups] == [["img_0.png", "img_0_copy.png"]]
+
+def _random_file_hashes(n=300, seed=4):
+    import imagehash
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2, (n // 3, 8, 8)).astype(bool)
+    file_hashes = []
+    for i in range(n):
+        bits = base[i % len(base)].copy()
+        flips = rng.integers(0, 64, int(rng.integers(0, 12)))
+        bits.flat[flips] = ~bits.flat[flips]
+        file_hashes.append((f"f{i}.jpg", imagehash.ImageHash(bits)))
+    return file_hashes
+
+def test_packed_grouping_matches_legacy():
+    from component.utils.hash_util import pack_file_hashes
+    file_hashes = _random_file_hashes()
+    packed = pack_file_hashes(file_hashes)
+    assert packed.hashes.dtype == np.uint64
+    assert duplicate_finder.group_by_phash(packed) == duplicate_finder.group_by_phash(file_hashes)
+    legacy = duplicate_finder.group_by_phash_parallel(file_hashes, max_workers=2)
+    parallel = duplicate_finder.group_by_phash_parallel(packed, max_workers=2)
+    assert sorted(sorted(g) for g in parallel) == sorted(sorted(g) for g in legacy)
+
+def test_parallel_grouping_of_frame_hash_lists_matches_serial():
+    # フレームごとのハッシュリストはuint64にできないため、ワーカーへ1回だけ渡す経路で比較する
+    frames = _random_file_hashes(60, seed=7)
+    file_hashes = [(f"v{i}.mp4", [frames[i][1], frames[(i + 1) % 60][1]]) for i in range(0, 60, 2)]
+    file_hashes += [(f"v{i}_copy.mp4", h) for i, (_, h) in enumerate(file_hashes[:5])]
+    serial = duplicate_finder.group_by_phash(file_hashes, threshold=4)
+    assert serial
+    assert duplicate_finder.group_by_phash_parallel(file_hashes, threshold=4, max_workers=2) == serial
+
+def test_find_duplicates_incremental_index(tmp_path, monkeypatch):
+    import shutil
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 3)
+    shutil.copy(files[0], os.path.join(str(tmp_path), "img_0_copy.png"))
+    Image.open(files[1]).save(os.path.join(str(tmp_path), "img_1_resave.png"))
+    groups, grouper = find_duplicates_in_folder(str(tmp_path), parallel=False, return_index=True)
+    names = [[os.path.basename(f) for f in g] for g in groups]
+    assert names == [["img_0.png", "img_0_copy.png"], ["img_1.png", "img_1_resave.png"]]
+    grouper.remove(os.path.join(str(tmp_path), "img_1.png"))
+    assert [[os.path.basename(f) for f in g] for g in grouper.groups()] == [["img_0.png", "img_0_copy.png"]]
+    grouper.add(files[1], duplicate_finder.calc_image_phash(files[1]))
+    assert grouper.groups() == groups
+
+def test_extract_phashes_reuses_moved_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 3)
+    first = extract_phashes(files, str(tmp_path), max_workers=1)
+    moved = [os.path.join(str(tmp_path), f"renamed_{i}.png") for i in range(len(files))]
+    for src, dst in zip(files, moved):
+        os.replace(src, dst)
+    monkeypatch.setattr(duplicate_finder, "_calc_phash_task", lambda args: None)
+    second = extract_phashes(moved, str(tmp_path), max_workers=1)
+    assert [h for _, h in second] == [h for _, h in first]
+
+def test_failed_files_are_skipped_until_changed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 2)
+    broken = str(tmp_path / "broken.png")
+    video = str(tmp_path / "broken.mp4")
+    for path in (broken, video):
+        with open(path, "wb") as f:
+            f.write(b"not an image")
+    files += [broken, video]
+    first = extract_phashes(files, str(tmp_path), max_workers=1, as_int=True)
+    assert [h is None for _, h in first] == [False, False, True, True]
+    assert duplicate_finder.get_feature_failures(files) == {
+        broken: duplicate_finder.FAILURE_DECODE, video: duplicate_finder.FAILURE_NO_FRAMES,
+    }
+    calls = []
+    real_task = duplicate_finder._calc_phash_task
+    def task(args):
+        calls.append(args[0])
+        return real_task(args)
+    monkeypatch.setattr(duplicate_finder, "_calc_phash_task", task)
+    assert extract_phashes(files, str(tmp_path), max_workers=1, as_int=True) == first
+    assert calls == []
+    # 変更されたファイルは計算し直す
+    Image.new("RGB", (16, 16), color="red").save(broken, format="PNG")
+    second = extract_phashes(files, str(tmp_path), max_workers=1, as_int=True)
+    assert calls == [[broken]]
+    assert second[2][1] is not None
+    assert duplicate_finder.get_feature_failures(files) == {video: duplicate_finder.FAILURE_NO_FRAMES}
+
+def test_fast_decode_hashes_are_cached_separately(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 2)
+    fast = extract_phashes(files, str(tmp_path), max_workers=1, fast_decode=True, as_int=True)
+    calls = []
+    real_task = duplicate_finder._calc_phash_task
+    def task(args):
+        calls.append(args[2])
+        return real_task(args)
+    monkeypatch.setattr(duplicate_finder, "_calc_phash_task", task)
+    full = extract_phashes(files, str(tmp_path), max_workers=1, as_int=True)
+    # フルデコードのスキャンは縮小デコードのハッシュを使わず計算し直す
+    assert calls == [False]
+    assert [h for _, h in full] == [duplicate_finder.hash_to_int(duplicate_finder.calc_image_phash(f)) for f in files]
+    assert extract_phashes(files, str(tmp_path), max_workers=1, fast_decode=True, as_int=True) == fast
+    assert calls == [False]
+    assert duplicate_finder.hash_feature(files[0], fast_decode=True) == "phash_fast"
+    assert duplicate_finder.hash_feature(files[0], ("phash",), fast_decode=True) == "multihash_fast"
+    assert duplicate_finder.hash_feature("a.mp4", fast_decode=True) == duplicate_finder.DEFAULT_FEATURE
+
+def test_metadata_is_cached_with_hashes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 3)
+    first = find_duplicates_in_folder(str(tmp_path), parallel=False)
+    calls = []
+    real = duplicate_finder.get_media_metadata
+    def spy(path):
+        calls.append(path)
+        return real(path)
+    monkeypatch.setattr(duplicate_finder, "get_media_metadata", spy)
+    metadata = {}
+    extract_phashes(files, str(tmp_path), max_workers=1, metadata=metadata)
+    # キャッシュ済みのファイルはヘッダを読み直さない
+    assert calls == []
+    assert metadata == {f: real(f) for f in files}
+    assert find_duplicates_in_folder(str(tmp_path), parallel=False) == first
+    assert calls == []
+    Image.new("RGB", (30, 20)).save(files[0])
+    metadata = {}
+    extract_phashes(files, str(tmp_path), max_workers=1, metadata=metadata)
+    assert calls == [files[0]]
+    assert (metadata[files[0]].width, metadata[files[0]].height) == (30, 20)
+
+def test_single_file_getters_record_failure_reason(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    broken = str(tmp_path / "broken.png")
+    video = str(tmp_path / "broken.mp4")
+    for path in (broken, video):
+        with open(path, "wb") as f:
+            f.write(b"not " + os.path.basename(path).encode())
+    assert duplicate_finder.get_image_phash(broken) is None
+    assert duplicate_finder.get_video_phash(video) is None
+    # 一括抽出と同じ理由コードが記録される
+    assert duplicate_finder.get_feature_failures([broken, video]) == {
+        broken: duplicate_finder.FAILURE_DECODE, video: duplicate_finder.FAILURE_NO_FRAMES,
+    }
+
+def test_group_by_multihash_is_order_independent():
+    import itertools
+    import imagehash
+    from component.utils.hash_util import int_to_hash
+    def bits(n):
+        return int_to_hash((1 << n) - 1)
+    colors = imagehash.ImageHash(np.zeros((14, 3), dtype=bool))
+    # a-bとb-cは近いがa-cは遠い。dだけはdHashのみaに近い
+    sigs = {
+        "a": {"phash": bits(0), "dhash": bits(0), "colorhash": colors},
+        "b": {"phash": bits(5), "dhash": bits(5), "colorhash": colors},
+        "c": {"phash": bits(10), "dhash": bits(10), "colorhash": colors},
+        "d": {"phash": int_to_hash(0xFFFF << 40), "dhash": bits(2), "colorhash": imagehash.ImageHash(np.ones((14, 3), dtype=bool))},
+    }
+    for order in itertools.permutations(sigs):
+        file_sigs = [(f, sigs[f]) for f in order]
+        assert duplicate_finder.group_by_multihash(file_sigs) == [["a", "b"]]
+        assert duplicate_finder.group_by_multihash(file_sigs, cluster_mode="connected") == [["a", "b", "c"]]
+        # "any"ではpHash・colorhashが遠くてもdHashの近いペアを見つける
+        assert duplicate_finder.group_by_multihash(file_sigs, mode="any") == [["a", "b", "c", "d"]]
+
+def test_rescan_with_only_deletions_compacts_store(tmp_path, monkeypatch):
+    from component.utils import constants
+    from component.utils.feature_store import get_feature_store
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 5)
+    extract_phashes(files, str(tmp_path), max_workers=1)
+    assert len(get_feature_store()) == 5
+    for f in files[1:]:
+        os.remove(f)
+    monkeypatch.setattr(constants, "CACHE_GC_INTERVAL", 0)
+    # 残ったファイルはすべてキャッシュにあるが、消えたファイルの項目は整理される
+    extract_phashes(files[:1], str(tmp_path), max_workers=1)
+    assert len(get_feature_store()) == 1
+
+def test_exact_copy_groups_do_not_depend_on_enumeration_order(tmp_path, monkeypatch):
+    import shutil
+    monkeypatch.chdir(tmp_path)
+    files = _make_images(str(tmp_path), 3)
+    shutil.copy(files[0], str(tmp_path / "a_copy.png"))
+    shutil.copy(files[2], str(tmp_path / "z_copy.png"))
+    Image.open(files[1]).resize((48, 48)).save(str(tmp_path / "small.png"))
+    listed = duplicate_finder.get_image_and_video_files(str(tmp_path))
+    results = []
+    for order in (sorted(listed), sorted(listed, reverse=True)):
+        monkeypatch.setattr(duplicate_finder, "get_image_and_video_files", lambda folder, *args, order=order: list(order))
+        for return_index in (False, True):
+            groups, _ = find_duplicates_in_folder(str(tmp_path), parallel=False, return_index=return_index)
+            results.append([[os.path.basename(f) for f in g] for g in groups])
+    assert results[0] == [["a_copy.png", "img_0.png"], ["img_1.png", "small.png"], ["img_2.png", "z_copy.png"]]
+    assert all(r == results[0] for r in results)
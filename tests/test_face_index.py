@@ -0,0 +1,62 @@
+import numpy as np
+from component.face_index import FaceIndex, group_face_encodings
+
+def _encodings(n=600, people=60, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.1, (people, 128))
+    return centres[rng.integers(0, people, n)] + rng.normal(0, 0.02, (n, 128))
+
+def _distances(x, metric):
+    if metric == "cosine":
+        u = x / np.linalg.norm(x, axis=1, keepdims=True)
+        return np.clip(1.0 - u @ u.T, 0.0, 2.0)
+    return np.linalg.norm(x[:, None, :] - x[None, :, :], axis=2)
+
+def _greedy_groups(x, threshold, metric):
+    # 従来の貪欲法（先頭から順に、未所属の近い顔を取り込む）
+    dist = _distances(x, metric)
+    used = set()
+    groups = []
+    for i in range(len(x)):
+        if i in used:
+            continue
+        group = [i] + [j for j in range(len(x)) if j != i and j not in used and dist[i, j] < threshold]
+        used.update(group)
+        if len(group) > 1:
+            groups.append(group)
+    return groups
+
+def test_exhaustive_probe_matches_bruteforce():
+    x = _encodings()
+    for metric, threshold in (("euclidean", 0.3), ("cosine", 0.05)):
+        index = FaceIndex(x, metric, nprobe=10**6)
+        ii, jj = index.radius_pairs(threshold)
+        expected = np.nonzero(np.triu(_distances(x, metric) < threshold, k=1))
+        assert list(zip(ii.tolist(), jj.tolist())) == list(zip(*(e.tolist() for e in expected)))
+
+def test_query_radius_batched():
+    x = _encodings(seed=1)
+    index = FaceIndex(x, nprobe=10**6)
+    dist = _distances(x, "euclidean")
+    hits = index.query_radius(x[:20], 0.3)
+    for k in range(20):
+        assert hits[k].tolist() == np.flatnonzero(dist[k] < 0.3).tolist()
+
+def test_default_probe_finds_clustered_pairs():
+    x = _encodings(seed=2)
+    ii, jj = FaceIndex(x).radius_pairs(0.3)
+    expected = set(zip(*(e.tolist() for e in np.nonzero(np.triu(_distances(x, "euclidean") < 0.3, k=1)))))
+    found = set(zip(ii.tolist(), jj.tolist()))
+    assert found <= expected
+    assert len(found) >= 0.95 * len(expected)
+
+def test_group_face_encodings_matches_greedy():
+    x = _encodings(200, 20, seed=3)
+    encodings = list(x)
+    encodings[5] = None
+    valid = [i for i, e in enumerate(encodings) if e is not None]
+    for metric, threshold in (("euclidean", 0.3), ("cosine", 0.05)):
+        expected = [[valid[k] for k in g] for g in _greedy_groups(x[valid], threshold, metric)]
+        assert group_face_encodings(encodings, threshold, metric, nprobe=10**6) == expected
+    groups = group_face_encodings(encodings, 0.3, singletons=True)
+    assert sorted(i for g in groups for i in g) == valid
@@ -0,0 +1,230 @@
+import errno
+import os
+import pickle
+import numpy as np
+from component import duplicate_finder
+from component.utils.feature_store import DEFAULT_FEATURE, FeatureFailure, FeatureStore, get_feature_store
+
+def test_put_and_get_many(tmp_path):
+    with FeatureStore(str(tmp_path / "f.sqlite3")) as store:
+        store.put_many([(str(tmp_path / f"f{i}.png"), i) for i in range(2000)])
+        store.put(str(tmp_path / "f0.png"), {"phash": 1}, "multihash")
+        assert store.get(str(tmp_path / "f5.png")) == 5
+        assert store.get(str(tmp_path / "missing.png")) is None
+        found = store.get_many([str(tmp_path / f"f{i}.png") for i in range(0, 3000, 7)])
+        assert found == {str(tmp_path / f"f{i}.png"): i for i in range(0, 2000, 7)}
+        assert store.get(str(tmp_path / "f0.png"), "multihash") == {"phash": 1}
+        store.delete([str(tmp_path / "f0.png")])
+        assert store.get(str(tmp_path / "f0.png")) is None
+        assert store.get(str(tmp_path / "f0.png"), "multihash") is None
+        assert len(store) == 1999
+
+def test_features_with_cache_computes_once(tmp_path):
+    calls = []
+    def calc(path):
+        calls.append(path)
+        return 42
+    path = str(tmp_path / "a.png")
+    assert duplicate_finder.get_features_with_cache(path, calc) == 42
+    assert duplicate_finder.get_features_with_cache(path, calc) == 42
+    assert duplicate_finder.get_features_with_cache(path, calc, feature="other") == 42
+    assert len(calls) == 2
+
+def test_import_legacy_feature_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "a.png")
+    open(path, "wb").close()
+    cache_file, _ = duplicate_finder.get_cache_files(str(tmp_path))
+    with open(cache_file, "wb") as f:
+        pickle.dump({path: 7, ("signature", path): [1, 2], str(tmp_path / "gone.png"): 1}, f)
+    assert duplicate_finder.import_legacy_feature_cache(str(tmp_path)) == 2
+    assert not os.path.exists(cache_file)
+    store = get_feature_store()
+    assert store.get(path, DEFAULT_FEATURE) == 7
+    assert store.get(path, "signature") == [1, 2]
+
+def test_modified_file_is_recomputed(tmp_path):
+    path = str(tmp_path / "a.png")
+    with open(path, "wb") as f:
+        f.write(b"one")
+    calls = []
+    def calc(p):
+        calls.append(p)
+        return len(calls)
+    assert duplicate_finder.get_features_with_cache(path, calc) == 1
+    assert duplicate_finder.get_features_with_cache(path, calc) == 1
+    with open(path, "wb") as f:
+        f.write(b"longer")
+    assert duplicate_finder.get_features_with_cache(path, calc) == 2
+    assert get_feature_store().get_many([path]) == {path: 2}
+
+def test_stat_signatures_match_single_stat(tmp_path):
+    from component.utils.file_util import stat_signature, stat_signatures
+    paths = [str(tmp_path / f"f{i}") for i in range(3)]
+    for p in paths[:2]:
+        open(p, "wb").close()
+    sigs = stat_signatures(paths)
+    assert sigs == {p: stat_signature(p) for p in paths}
+    assert sigs[paths[2]] is None
+
+def test_write_behind_flushes_in_batches(tmp_path):
+    db = str(tmp_path / "f.sqlite3")
+    paths = [str(tmp_path / f"f{i}.png") for i in range(5)]
+    with FeatureStore(db, flush_count=3, flush_seconds=3600) as store, FeatureStore(db) as reader:
+        store.put(paths[0], 0)
+        store.put(paths[1], 1)
+        assert store.get(paths[0]) == 0
+        assert store.get_many(paths) == {paths[0]: 0, paths[1]: 1}
+        assert reader.get(paths[0]) is None
+        store.put(paths[2], 2)
+        assert reader.get_many(paths) == {p: i for i, p in enumerate(paths[:3])}
+        store.put(paths[3], 3)
+        store.flush()
+        assert reader.get(paths[3]) == 3
+
+def test_renamed_file_reuses_features(tmp_path):
+    path = str(tmp_path / "a.png")
+    with open(path, "wb") as f:
+        f.write(b"content" * 100)
+    calls = []
+    def calc(p):
+        calls.append(p)
+        return len(calls)
+    assert duplicate_finder.get_features_with_cache(path, calc) == 1
+    moved = str(tmp_path / "sub" / "b.png")
+    os.makedirs(os.path.dirname(moved))
+    os.replace(path, moved)
+    assert duplicate_finder.get_features_with_cache(moved, calc) == 1
+    assert calls == [path]
+    # 移動先のパスでも登録される（次回はパスで見つかる）
+    assert get_feature_store().get(moved) == 1
+
+def test_content_fingerprint_samples_large_files(tmp_path):
+    from component.utils.file_util import content_fingerprint
+    a, b = str(tmp_path / "a"), str(tmp_path / "b")
+    data = bytearray(os.urandom(1000))
+    for p in (a, b):
+        with open(p, "wb") as f:
+            f.write(data)
+    assert content_fingerprint(a) == content_fingerprint(b)
+    data[500] ^= 1
+    with open(b, "wb") as f:
+        f.write(data)
+    assert content_fingerprint(a) != content_fingerprint(b)
+    assert content_fingerprint(str(tmp_path / "missing")) is None
+
+def test_compact_drops_dead_entries_and_shrinks(tmp_path):
+    db = str(tmp_path / "f.sqlite3")
+    paths = [str(tmp_path / f"f{i}.png") for i in range(200)]
+    for p in paths:
+        with open(p, "wb") as f:
+            f.write(p.encode())
+    with FeatureStore(db) as store:
+        store.put_many([(p, os.urandom(2000)) for p in paths])
+        store.flush()
+        # 削除対象が割合に届かなければ何もしない
+        for p in paths[:10]:
+            os.remove(p)
+        assert store.compact(min_dead_ratio=0.5).removed == 0
+        for p in paths[10:150]:
+            os.remove(p)
+        with open(paths[150], "wb") as f:
+            f.write(b"modified content")
+        result = store.compact(min_dead_ratio=0.5)
+        assert (result.entries, result.removed) == (200, 151)
+        assert result.bytes_reclaimed > 100 * 2000
+        assert len(store) == 49
+        assert store.get_many(paths[151:]).keys() == set(paths[151:])
+        # 自動圧縮は間隔ごとに1回だけ確認する
+        os.remove(paths[151])
+        assert store.auto_compact([str(tmp_path)], 0.0, interval=3600).removed == 1
+        os.remove(paths[152])
+        assert store.auto_compact([str(tmp_path)], 0.0, interval=3600) is None
+
+def _put_from_process(args):
+    db, paths, offset = args
+    with FeatureStore(db, flush_count=7) as store:
+        for i, p in enumerate(paths):
+            store.put(p, offset + i)
+            store.get_many(paths[:i + 1])
+    return len(paths)
+
+def test_processes_share_one_store(tmp_path):
+    import concurrent.futures
+    db = str(tmp_path / "f.sqlite3")
+    jobs = [(db, [str(tmp_path / f"w{w}_{i}.png") for i in range(60)], w * 1000) for w in range(4)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(_put_from_process, jobs)) == [60] * 4
+    with FeatureStore(db) as store:
+        assert len(store) == 240
+        for _, paths, offset in jobs:
+            assert store.get_many(paths) == {p: offset + i for i, p in enumerate(paths)}
+
+def test_failed_features_are_cached_until_changed(tmp_path):
+    path = str(tmp_path / "a.png")
+    with open(path, "wb") as f:
+        f.write(b"one")
+    calls = []
+    def calc(p):
+        calls.append(p)
+        return None
+    assert duplicate_finder.get_features_with_cache(path, calc, feature="face") is None
+    assert duplicate_finder.get_features_with_cache(path, calc, feature="face") is None
+    assert len(calls) == 1
+    assert get_feature_store().get(path, "face") == FeatureFailure(duplicate_finder.FAILURE_NO_RESULT)
+    with open(path, "wb") as f:
+        f.write(b"changed")
+    assert duplicate_finder.get_features_with_cache(path, calc, feature="face") is None
+    assert len(calls) == 2
+
+def test_compact_keeps_entries_of_unreachable_volumes_only(tmp_path, monkeypatch):
+    db = str(tmp_path / "f.sqlite3")
+    share, local, moved = tmp_path / "share", tmp_path / "local", tmp_path / "moved"
+    for d in (share, local, moved):
+        d.mkdir()
+    paths = ([str(share / f"s{i}.png") for i in range(10)] + [str(moved / f"m{i}.png") for i in range(3)]
+             + [str(local / f"l{i}.png") for i in range(2)])
+    for p in paths:
+        with open(p, "wb") as f:
+            f.write(p.encode())
+    real_scandir = os.scandir
+    def scandir(path):
+        # 接続の切れた共有フォルダ（ディレクトリごと読めない）
+        if os.path.abspath(path) == str(share):
+            raise OSError(errno.EIO, "Input/output error", path)
+        return real_scandir(path)
+    with FeatureStore(db) as store:
+        store.put_many([(p, i) for i, p in enumerate(paths)])
+        monkeypatch.setattr(os, "scandir", scandir)
+        # 移動したフォルダ（親は存在する）の項目は削除し、読めない共有フォルダの項目は残す
+        os.rename(str(moved), str(tmp_path / "renamed"))
+        os.remove(paths[-1])
+        result = store.compact(0.0)
+        assert (result.entries, result.removed) == (15, 4)
+        assert len(store) == 11
+        # 自動圧縮はスキャンしたフォルダ配下だけを確認する
+        os.remove(paths[-2])
+        assert store.auto_compact([str(share)], 0.0, interval=3600).removed == 0
+        assert store.auto_compact([str(local)], 0.0, interval=3600).removed == 1
+        assert len(store) == 10
+
+def test_missing_drive_is_unreachable(monkeypatch):
+    from component.utils import file_util
+    missing = FileNotFoundError(errno.ENOENT, "No such file or directory")
+    assert file_util._volume_unreachable("/mnt/share/photos", OSError(errno.EIO, "Input/output error"))
+    monkeypatch.setattr(os.path, "isdir", lambda p: False)
+    assert file_util._volume_unreachable(os.path.abspath("share/photos"), missing)
+    monkeypatch.setattr(os.path, "isdir", lambda p: p == os.path.dirname(os.path.abspath("share")))
+    assert not file_util._volume_unreachable(os.path.abspath("share/photos"), missing)
+
+def test_face_encodings_do_not_share_the_phash_entry(tmp_path, monkeypatch):
+    from PIL import Image
+    from component.ai import face_grouping
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "a.png")
+    Image.new("RGB", (32, 32), color="red").save(path)
+    encoding = face_grouping.get_face_encoding(path)
+    assert get_feature_store().get(path, "face") is not None
+    # 顔特徴量を先に登録しても、pHashは別の種類として計算・登録される
+    assert duplicate_finder.get_image_phash(path) == duplicate_finder.calc_image_phash(path)
+    assert np.array_equal(face_grouping.get_face_encoding(path), encoding)
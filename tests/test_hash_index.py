@@ -0,0 +1,131 @@
+import numpy as np
+from component.hash_index import BKTree, cluster_pairs, index_near_pairs
+from component.utils.hash_util import PackedHashes, hamming_matrix
+
+def _packed(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2**63, n // 5, dtype=np.uint64)
+    hashes = base[rng.integers(0, len(base), n)]
+    for i in range(n):
+        for b in rng.integers(0, 64, int(rng.integers(0, 8))):
+            hashes[i] ^= np.uint64(1) << np.uint64(int(b))
+    return PackedHashes([f"f{i}" for i in range(n)], hashes)
+
+def test_bktree_query_matches_bruteforce():
+    packed = _packed()
+    tree = BKTree.from_packed(packed)
+    dist = hamming_matrix(packed.hashes, packed.hashes)
+    for i in range(0, 500, 37):
+        expected = [(int(j), int(dist[i, j])) for j in np.flatnonzero(dist[i] <= 6)]
+        assert tree.query(packed.hashes[i], 6) == expected
+
+def _bruteforce_pairs(packed, threshold=8):
+    dist = hamming_matrix(packed.hashes, packed.hashes)
+    ii, jj = np.nonzero(np.triu(dist < threshold, k=1))
+    return list(zip(ii.tolist(), jj.tolist()))
+
+def test_index_near_pairs_match_bruteforce():
+    packed = _packed(seed=1)
+    ii, jj = index_near_pairs(packed, 8)
+    assert sorted(zip(ii.tolist(), jj.tolist())) == _bruteforce_pairs(packed)
+
+def test_bktree_search():
+    tree = BKTree([0b1111, 0b1110, 0xFF00], ["a", "b", "c"])
+    assert tree.search(0b1111, threshold=2) == [("a", 0), ("b", 1)]
+
+def test_mih_near_pairs_match_bruteforce():
+    from component.hash_index import mih_near_pairs
+    packed = _packed(seed=2)
+    ii, jj = mih_near_pairs(packed.hashes, 8)
+    assert sorted(zip(ii.tolist(), jj.tolist())) == _bruteforce_pairs(packed)
+
+def test_mih_band_radius_search_is_exact_for_any_band_count():
+    import pytest
+    from component.hash_index import mih_near_pairs
+    packed = _packed(seed=5)
+    for threshold in (1, 8, 12):
+        expected = _bruteforce_pairs(packed, threshold)
+        for bands in (None, 3, 4, threshold):
+            ii, jj = mih_near_pairs(packed.hashes, threshold, bands)
+            assert list(zip(ii.tolist(), jj.tolist())) == expected
+    with pytest.raises(ValueError):
+        mih_near_pairs(packed.hashes, 12, bands=1)
+
+def test_group_by_phash_parallel_mih_matches_scan():
+    from component.duplicate_finder import group_by_phash, group_by_phash_parallel
+    packed = _packed(seed=3)
+    assert group_by_phash(packed, 8, engine="mih") == group_by_phash(packed, 8, engine="scan")
+    assert group_by_phash_parallel(packed, 8, engine="mih") == group_by_phash_parallel(packed, 8, max_workers=2)
+
+def test_blocked_near_pairs_match_bruteforce():
+    from component.hash_index import blocked_near_pairs
+    packed = _packed(seed=4)
+    # タイル境界をまたぐよう小さなタイルで計算する
+    ii, jj = blocked_near_pairs(packed.hashes, 8, block_rows=37, block_cols=101)
+    assert sorted(zip(ii.tolist(), jj.tolist())) == _bruteforce_pairs(packed)
+
+def test_group_by_phash_tuple_input_uses_packed_engine():
+    from component.duplicate_finder import group_by_phash
+    from component.utils.hash_util import int_to_hash
+    packed = _packed(100, seed=5)
+    file_hashes = [(f, int_to_hash(int(h))) for f, h in zip(packed.paths, packed.hashes)]
+    file_hashes.insert(3, ("broken", None))
+    assert group_by_phash(file_hashes, 8) == group_by_phash(packed, 8, engine="scan")
+
+def test_cluster_pairs_star_and_connected():
+    # 0-1-2の鎖と3-4: 中心型では2は中心0の近傍ではないので別グループの中心になる
+    ii, jj = [1, 1, 3], [0, 2, 4]
+    assert cluster_pairs(6, ii, jj, mode="star") == [[0, 1], [3, 4]]
+    assert cluster_pairs(6, ii, jj, mode="connected") == [[0, 1, 2], [3, 4]]
+    # キーを与えると入力の並びに依らない
+    keys = ["c", "b", "a", "e", "d", "f"]
+    assert cluster_pairs(6, ii, jj, mode="star", keys=keys) == [[2, 1], [4, 3]]
+
+def test_grouping_is_order_independent_across_engines():
+    from component.duplicate_finder import group_by_phash, group_by_phash_parallel
+    packed = _packed(300, seed=6)
+    expected = group_by_phash(packed, 8)
+    perm = np.random.default_rng(0).permutation(300)
+    shuffled = PackedHashes([packed.paths[i] for i in perm], packed.hashes[perm])
+    for engine in ("scan", "blocked", "mih", "bktree"):
+        assert group_by_phash(shuffled, 8, engine=engine) == expected
+    assert group_by_phash_parallel(shuffled, 8, max_workers=2) == expected
+    connected = group_by_phash(packed, 8, mode="connected")
+    assert group_by_phash_parallel(shuffled, 8, engine="mih", mode="connected") == connected
+
+def test_incremental_grouper_matches_full_regroup():
+    from component.duplicate_finder import group_by_phash
+    from component.hash_index import IncrementalGrouper
+    packed = _packed(300, seed=7)
+    grouper = IncrementalGrouper(packed.paths[:250], packed.hashes[:250], threshold=8)
+    for path, h in zip(packed.paths[250:], packed.hashes[250:]):
+        grouper.add(path, h)
+    assert grouper.groups() == group_by_phash(packed, 8)
+    removed = set(packed.paths[::7])
+    for path in removed:
+        assert grouper.remove(path)
+    keep = [i for i, p in enumerate(packed.paths) if p not in removed]
+    rest = PackedHashes([packed.paths[i] for i in keep], packed.hashes[keep])
+    assert grouper.groups() == group_by_phash(rest, 8)
+    assert all(p not in removed for p, _ in grouper.search(packed.hashes[0], 8))
+
+def test_cross_near_pairs_match_bruteforce():
+    from component.hash_index import cross_near_pairs
+    packed = _packed(seed=8)
+    a, b = packed.hashes[:120], packed.hashes[100:]
+    ia, jb = cross_near_pairs(a, b, 8, block_rows=32, block_cols=50)
+    ii, jj = np.nonzero(hamming_matrix(a, b) < 8)
+    assert sorted(zip(ia.tolist(), jb.tolist())) == sorted(zip(ii.tolist(), jj.tolist()))
+
+def test_near_pairs_with_metadata_match_bruteforce_across_engines():
+    from component.duplicate_finder import near_pairs
+    from component.media_metadata import MediaMeta, metadata_compatible
+    packed = _packed(400, seed=8)
+    rng = np.random.default_rng(8)
+    sizes = [(1920, 1080), (1080, 1920), (1000, 1000)]
+    metas = [None if k == 0 else MediaMeta(*sizes[k % 3], None if k == 1 else float(rng.choice([5.0, 5.4, 60.0, 600.0])), 30.0)
+             for k in rng.integers(0, 6, len(packed.paths))]
+    expected = [(i, j) for i, j in _bruteforce_pairs(packed) if metadata_compatible(metas[i], metas[j])]
+    for engine in ("scan", "blocked", "mih", "bktree"):
+        ii, jj = near_pairs(packed, 8, engine, metas)
+        assert sorted(zip(ii.tolist(), jj.tolist())) == expected
@@ -0,0 +1,42 @@
+import numpy as np
+from component.duplicate_finder import group_by_phash
+from component.hash_store import HashStore, write_hash_store
+from component.media_metadata import MediaMeta
+from component.utils.hash_util import PackedHashes
+
+def _packed(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2**63, n // 3, dtype=np.uint64)
+    hashes = base[rng.integers(0, len(base), n)] ^ (np.uint64(1) << rng.integers(0, 64, n).astype(np.uint64))
+    paths = [f"/photos/{'日本' if i % 2 else 'x'}/{(i * 7919) % n:04d}.jpg" for i in range(n)]
+    metas = [None if i % 5 == 0 else MediaMeta(640, 480 if i % 3 else 360, None if i % 2 else 10.0 + i % 4, None) for i in range(n)]
+    return PackedHashes(paths, hashes), metas
+
+def test_round_trip_sorted_by_path(tmp_path):
+    packed, metas = _packed()
+    path = str(tmp_path / "lib.phcols")
+    write_hash_store(path, packed, metas)
+    with HashStore(path) as store:
+        assert len(store) == 300
+        assert list(store.paths) == sorted(packed.paths)
+        pos = {p: i for i, p in enumerate(packed.paths)}
+        for k, p in enumerate(store.paths):
+            assert store.hashes[k] == packed.hashes[pos[p]]
+            assert store.metas[k] == metas[pos[p]]
+        assert store.paths[-1] == sorted(packed.paths)[-1]
+
+def test_grouping_runs_on_mapped_arrays(tmp_path):
+    packed, metas = _packed(seed=1)
+    path = str(tmp_path / "lib.phcols")
+    write_hash_store(path, packed, metas)
+    store = HashStore(path)
+    assert isinstance(store.hashes, np.memmap)
+    expected = group_by_phash(packed, 8, metas)
+    for engine in ("scan", "blocked", "mih"):
+        assert group_by_phash(store.packed, 8, store.metas, engine=engine) == expected
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "empty.phcols")
+    write_hash_store(path, PackedHashes([], np.zeros(0, dtype=np.uint64)))
+    store = HashStore(path)
+    assert len(store) == 0 and list(store.paths) == [] and len(store.hashes) == 0
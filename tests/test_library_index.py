@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from PIL import Image
+from component import duplicate_finder
+from component.library_index import LibraryIndex
+
+def _make_image(path, seed):
+    rng = np.random.default_rng(seed)
+    arr = np.kron(rng.integers(0, 256, (8, 8, 3)), np.ones((8, 8, 1))).astype(np.uint8)
+    Image.fromarray(arr).save(path)
+    return path
+
+def _names(groups):
+    return [sorted(os.path.basename(f) for f in g) for g in groups]
+
+def test_library_index_finds_duplicates_across_roots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root_a = tmp_path / "a"
+    root_b = tmp_path / "b"
+    root_a.mkdir()
+    root_b.mkdir()
+    a0 = _make_image(str(root_a / "a0.png"), 0)
+    _make_image(str(root_a / "a1.png"), 1)
+    _make_image(str(root_b / "b2.png"), 2)
+    Image.open(a0).save(str(root_b / "b0_resave.png"))
+    with LibraryIndex(str(tmp_path / "lib.sqlite3")) as index:
+        scan, groups = index.scan_and_find(str(root_a), max_workers=1)
+        assert len(scan.added) == 2 and groups == []
+        hashed = []
+        orig = duplicate_finder.extract_phashes
+        def spy(files, *args, **kwargs):
+            hashed.extend(files)
+            return orig(files, *args, **kwargs)
+        monkeypatch.setattr(duplicate_finder, "extract_phashes", spy)
+        scan, groups = index.scan_and_find(str(root_b), max_workers=1)
+        # 2つ目のルートのファイルだけハッシュ計算し、1つ目のルートのファイルと照合する
+        assert sorted(os.path.basename(f) for f in hashed) == ["b0_resave.png", "b2.png"]
+        assert _names(groups) == [["a0.png", "b0_resave.png"]]
+        assert _names(index.find_duplicates()) == [["a0.png", "b0_resave.png"]]
+    # 再オープンしても残っており、消えたファイルは再スキャンで削除される
+    os.remove(str(root_b / "b0_resave.png"))
+    with LibraryIndex(str(tmp_path / "lib.sqlite3")) as index:
+        assert len(index) == 4
+        scan, groups = index.scan_and_find(str(root_b), max_workers=1)
+        assert scan.added == [] and len(scan.removed) == 1
+        assert groups == [] and len(index) == 3
+
+def test_library_index_exports_hash_store(tmp_path, monkeypatch):
+    from component.hash_store import HashStore
+    monkeypatch.chdir(tmp_path)
+    a0 = _make_image(str(tmp_path / "a0.png"), 0)
+    _make_image(str(tmp_path / "a1.png"), 1)
+    Image.open(a0).save(str(tmp_path / "a0_copy.png"))
+    with LibraryIndex(str(tmp_path / "lib.sqlite3")) as index:
+        index.scan_folder(str(tmp_path), max_workers=1)
+        store = HashStore(index.export_hash_store())
+        assert len(store) == 3
+        assert _names(duplicate_finder.group_by_phash(store.packed, metadata=store.metas)) == [["a0.png", "a0_copy.png"]]
+
+def test_scoped_find_duplicates_covers_whole_component(tmp_path):
+    from component.utils.hash_util import PackedHashes
+    paths = ["/x/b.jpg", "/x/c.jpg", "/x/far.jpg", "/y/q.jpg", "/y/other.jpg"]
+    hashes = np.array([0b11111, 0b1111111111, (1 << 64) - 1, 0, (1 << 40) - 1], dtype=np.uint64)
+    with LibraryIndex(str(tmp_path / "lib.sqlite3")) as index:
+        index.add("/x", PackedHashes(paths[:3], hashes[:3]))
+        index.add("/y", PackedHashes(paths[3:], hashes[3:]))
+        full = index.find_duplicates(threshold=8, metadata_filter=False)
+        assert [sorted(g) for g in full] == [["/x/b.jpg", "/x/c.jpg", "/y/q.jpg"]]
+        for query in (["/y/q.jpg"], ["/x/c.jpg"], ["/y/q.jpg", "/y/other.jpg"]):
+            scoped = index.find_duplicates(query, threshold=8, metadata_filter=False)
+            assert scoped == [g for g in full if set(g) & set(query)]
+
+def test_rescan_rehashes_files_replaced_in_place(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = _make_image(str(tmp_path / "a.png"), 0)
+    b = _make_image(str(tmp_path / "b.png"), 1)
+    with LibraryIndex(str(tmp_path / "lib.sqlite3")) as index:
+        assert index.scan_and_find(str(tmp_path), max_workers=1)[1] == []
+        # 登録済みのa.pngをb.pngと同じ画像で上書きする
+        Image.open(b).save(a)
+        os.utime(a, ns=(os.stat(a).st_atime_ns, os.stat(a).st_mtime_ns + 10 ** 9))
+        scan, groups = index.scan_and_find(str(tmp_path), max_workers=1)
+        assert scan.added == [] and scan.changed == [index.load()[0].paths[0]]
+        assert _names(groups) == [["a.png", "b.png"]]
+        # 変わっていなければ何も登録し直さない
+        scan = index.scan_folder(str(tmp_path), max_workers=1)
+        assert (scan.added, scan.changed, scan.removed) == ([], [], [])
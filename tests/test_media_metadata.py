@@ -0,0 +1,60 @@
+import os
+import cv2
+import numpy as np
+from PIL import Image
+from component.media_metadata import MediaMeta, MetadataFilter, get_media_metadata, metadata_blocks, metadata_compatible
+
+def test_get_media_metadata(tmp_path):
+    img_path = os.path.join(str(tmp_path), "a.png")
+    Image.new("RGB", (40, 30)).save(img_path)
+    assert get_media_metadata(img_path) == MediaMeta(40, 30, None, None)
+    video_path = os.path.join(str(tmp_path), "a.avi")
+    out = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'XVID'), 10.0, (32, 24))
+    for _ in range(20):
+        out.write(np.zeros((24, 32, 3), np.uint8))
+    out.release()
+    meta = get_media_metadata(video_path)
+    assert (meta.width, meta.height) == (32, 24)
+    assert abs(meta.duration - 2.0) < 0.2
+    assert get_media_metadata(os.path.join(str(tmp_path), "missing.mp4")) is None
+
+def test_metadata_compatible():
+    clip = MediaMeta(1920, 1080, 10.0, 30.0)
+    movie = MediaMeta(1920, 1080, 7200.0, 30.0)
+    small = MediaMeta(640, 360, 10.4, 25.0)
+    square = MediaMeta(1000, 1000, None, None)
+    assert not metadata_compatible(clip, movie)
+    assert metadata_compatible(clip, small)
+    assert not metadata_compatible(clip, small, {"aspect": 0.05, "duration": 0.1, "fps": 0.05})
+    assert not metadata_compatible(clip, square)
+    assert metadata_compatible(clip, None)
+
+def test_metadata_filter_candidates():
+    metas = [MediaMeta(16, 9, 10.0, 30.0), MediaMeta(16, 9, 7200.0, 30.0), MediaMeta(16, 9, 10.5, 30.0), MediaMeta(16, 9, None, None), None]
+    f = MetadataFilter(metas)
+    assert f.candidates(0) == [2, 3, 4]
+    assert f.candidates(3) == [0, 1, 2, 4]
+
+def test_metadata_blocks_cover_compatible_pairs_only():
+    rng = np.random.default_rng(0)
+    sizes = [(1920, 1080), (1080, 1920), (1000, 1000), (1440, 1080), (1280, 720), (0, 0)]
+    metas = []
+    for _ in range(400):
+        w, h = sizes[int(rng.integers(len(sizes)))]
+        kind = int(rng.choice(3, p=[0.02, 0.08, 0.9]))
+        if kind == 0:
+            metas.append(None)
+        elif kind == 1:
+            metas.append(MediaMeta(w, h, None, None))
+        else:
+            metas.append(MediaMeta(w, h, float(np.exp(rng.uniform(0, 9))), 30.0))
+    compared = set()
+    for a, b in metadata_blocks(metas):
+        if a is b:
+            compared.update((int(x), int(y)) for k, x in enumerate(a) for y in a[k + 1:])
+        else:
+            compared.update((int(min(x, y)), int(max(x, y))) for x in a for y in b)
+    compatible = set((i, j) for i in range(len(metas)) for j in range(i + 1, len(metas)) if metadata_compatible(metas[i], metas[j]))
+    assert compatible <= compared
+    # 互換になりえない組み合わせの大半は比較しない
+    assert len(compared) < 0.25 * len(metas) * (len(metas) - 1) / 2
@@ -1,3 +1,4 @@
+import errno
 import os
 import tempfile
 from component.thumbnail.thumbnail_util import ThumbnailCache
@@ -31,3 +32,90 @@ def test_thumbnail_cache_cleanup_if_needed():
         # 最大件数を超えたら古いものが消える
         count = sum(1 for v in cache.cache.values() if v is not None)
         assert count <= 3
+
+def test_thumbnail_cache_drops_modified_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "a.png")
+    Image.new("RGB", (10, 10), color="red").save(path)
+    cache = ThumbnailCache(folder=str(tmp_path))
+    cache.set((path, (120, 90)), Image.new("RGB", (120, 90)))
+    cache.set((path, (180, 180)), Image.new("RGB", (180, 180)))
+    cache.save()
+    assert ThumbnailCache(folder=str(tmp_path)).get((path, (120, 90))) is not None
+    Image.new("RGB", (20, 20), color="blue").save(path)
+    os.utime(path, ns=(0, 12345))
+    reloaded = ThumbnailCache(folder=str(tmp_path))
+    assert reloaded.get((path, (120, 90))) is None
+    assert reloaded.get((path, (180, 180))) is None
+
+def test_thumbnail_cache_reuses_renamed_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "a.png")
+    Image.new("RGB", (10, 10), color="red").save(path)
+    cache = ThumbnailCache(folder=str(tmp_path))
+    cache.set((path, (120, 90)), Image.new("RGB", (120, 90), color="green"))
+    cache.save()
+    moved = str(tmp_path / "b.png")
+    os.replace(path, moved)
+    reloaded = ThumbnailCache(folder=str(tmp_path))
+    img = reloaded.get((moved, (120, 90)))
+    assert img is not None and img.getpixel((0, 0)) == (0, 128, 0)
+    assert reloaded.get((path, (120, 90))) is None
+
+def test_thumbnail_cache_compact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    paths = [str(tmp_path / f"{i}.png") for i in range(4)]
+    cache = ThumbnailCache(folder=str(tmp_path))
+    for i, path in enumerate(paths):
+        Image.new("RGB", (10, 10)).save(path)
+        cache.set((path, (120, 90)), Image.effect_noise((120, 90), 50 + i))
+    cache.save()
+    os.remove(paths[0])
+    # 割合に届かなければ保存時には削除しない
+    cache.save(compact_ratio=0.5)
+    assert len(ThumbnailCache(folder=str(tmp_path)).cache) == 4
+    result = cache.compact()
+    assert (result.entries, result.removed) == (4, 1)
+    assert result.bytes_reclaimed > 0
+    assert sorted(k[0] for k in ThumbnailCache(folder=str(tmp_path)).cache) == paths[1:]
+
+def test_thumbnail_cache_saves_merge_other_processes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    paths = [str(tmp_path / f"{i}.png") for i in range(3)]
+    for path in paths:
+        Image.new("RGB", (10, 10)).save(path)
+    first = ThumbnailCache(folder=str(tmp_path))
+    second = ThumbnailCache(folder=str(tmp_path))
+    first.set((paths[0], (120, 90)), Image.new("RGB", (120, 90)))
+    second.set((paths[1], (120, 90)), Image.new("RGB", (120, 90)))
+    first.save()
+    second.save()
+    assert sorted(k[0] for k in ThumbnailCache(folder=str(tmp_path)).cache) == paths[:2]
+    # 破棄した項目は、他のインスタンスが保存した古い内容から復活させない
+    first.set((paths[2], (120, 90)), Image.new("RGB", (120, 90)))
+    first.save()
+    second.clear()
+    second.save()
+    assert ThumbnailCache(folder=str(tmp_path)).cache == {}
+
+def test_thumbnail_cache_compact_keeps_unreachable_volumes_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    share, moved = tmp_path / "share", tmp_path / "moved"
+    paths = []
+    for d in (share, moved):
+        d.mkdir()
+        paths.append(str(d / "a.png"))
+        Image.new("RGB", (10, 10)).save(paths[-1])
+    cache = ThumbnailCache(folder=str(tmp_path))
+    for path in paths:
+        cache.set((path, (120, 90)), Image.new("RGB", (120, 90)))
+    real_scandir = os.scandir
+    def scandir(path):
+        # 接続の切れた共有フォルダ（ディレクトリごと読めない）
+        if os.path.abspath(path) == str(share):
+            raise OSError(errno.EIO, "Input/output error", path)
+        return real_scandir(path)
+    monkeypatch.setattr(os, "scandir", scandir)
+    os.rename(str(moved), str(tmp_path / "renamed"))
+    assert cache.compact().removed == 1
+    assert list(cache.cache) == [(paths[0], (120, 90))]
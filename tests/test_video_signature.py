@@ -0,0 +1,76 @@
+import numpy as np
+from component.video_signature import VideoSignature, calc_video_signature, match_signatures, find_subclip_matches
+
+def _flip_bits(hashes, rng, nbits=3):
+    out = hashes.copy()
+    for i in range(len(out)):
+        for b in rng.choice(64, nbits, replace=False):
+            out[i] ^= np.uint64(1) << np.uint64(int(b))
+    return out
+
+def test_match_signatures_finds_trimmed_clip():
+    rng = np.random.default_rng(0)
+    full = rng.integers(0, 2**63, 120, dtype=np.uint64)
+    clip = _flip_bits(full[30:70], rng)
+    match = match_signatures(VideoSignature(2.0, full), VideoSignature(2.0, clip))
+    assert match is not None
+    assert match.offset == -60.0
+    assert match.coverage > 0.9
+
+def test_match_signatures_rejects_unrelated():
+    rng = np.random.default_rng(1)
+    a = VideoSignature(2.0, rng.integers(0, 2**63, 80, dtype=np.uint64))
+    b = VideoSignature(2.0, rng.integers(0, 2**63, 80, dtype=np.uint64))
+    assert match_signatures(a, b) is None
+
+def test_find_subclip_matches_with_different_intervals():
+    rng = np.random.default_rng(2)
+    full = rng.integers(0, 2**63, 200, dtype=np.uint64)
+    sigs = [
+        ("movie.mp4", VideoSignature(2.0, full)),
+        ("clip.mp4", VideoSignature(1.0, np.repeat(full[50:90], 2))),
+        ("other.mp4", VideoSignature(2.0, rng.integers(0, 2**63, 50, dtype=np.uint64))),
+    ]
+    matches = find_subclip_matches(sigs)
+    assert [(a, b) for a, b, _ in matches] == [("movie.mp4", "clip.mp4")]
+
+def _random_walk(n, rng):
+    # 0.5秒ごとに3bitずつ変わるハッシュ列（隣り合う時刻のフレームは似ている）
+    out = np.empty(n, dtype=np.uint64)
+    h = np.uint64(int(rng.integers(0, 2**63)))
+    for i in range(n):
+        for b in rng.choice(64, 3, replace=False):
+            h ^= np.uint64(1) << np.uint64(int(b))
+        out[i] = h
+    return out
+
+def test_match_signatures_with_non_integer_interval_ratio():
+    rng = np.random.default_rng(3)
+    timeline = _random_walk(2400, rng)
+    full = VideoSignature(2.0, timeline[::4])
+    # 100秒目から切り出し、1.5秒間隔でサンプリングした動画（長くても時刻がずれない）
+    clip = VideoSignature(1.5, timeline[200:1400:3])
+    match = match_signatures(full, clip)
+    assert match is not None
+    assert match.offset == -100.0
+    assert match.coverage > 0.9
+
+def test_match_signatures_threshold_is_exclusive():
+    rng = np.random.default_rng(4)
+    a = rng.integers(0, 2**63, 20, dtype=np.uint64)
+    b = a ^ np.uint64((1 << 10) - 1)
+    assert match_signatures(VideoSignature(2.0, a), VideoSignature(2.0, b), threshold=10) is None
+    assert match_signatures(VideoSignature(2.0, a), VideoSignature(2.0, b), threshold=11) is not None
+
+def test_signature_interval_does_not_depend_on_fps(tmp_path):
+    import cv2
+    rng = np.random.default_rng(5)
+    for fps in (29.97, 30.0):
+        path = str(tmp_path / f"clip_{fps}.avi")
+        out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'XVID'), fps, (32, 32))
+        for _ in range(300):
+            out.write(cv2.resize(rng.integers(0, 256, (4, 4, 3), dtype=np.uint8), (32, 32), interpolation=cv2.INTER_NEAREST))
+        out.release()
+        sig = calc_video_signature(path)
+        assert sig.interval == 2.0
+        assert len(sig.hashes) == 6
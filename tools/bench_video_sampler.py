@@ -0,0 +1,70 @@
+"""
+bench_video_sampler.py
+動画pHashのフレーム読み出し方式（シーク / 順次デコード）の速度比較ベンチマーク。
+
+使い方:
+    python -m tools.bench_video_sampler [動画ファイル ...]
+引数なしの場合は一時フォルダに長尺のテスト動画を生成して計測する。
+"""
+
+import os
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from component.duplicate_finder import calc_video_phash
+
+SAMPLERS = ("seek", "sequential")
+
+def make_test_video(path, frames=9000, size=(640, 360), fps=30.0):
+    # 長尺動画の代わりにノイズ動画を生成（フレームごとに内容が変わるので圧縮が効きにくい）
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(path, fourcc, fps, size)
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+    for i in range(frames):
+        frame = np.roll(base, i // 10, axis=1)
+        out.write(cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST))
+    out.release()
+    return path
+
+def bench(path, repeat=3, frame_count=7):
+    results = {}
+    for sampler in SAMPLERS:
+        best = None
+        h = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            h = calc_video_phash(path, frame_count, sampler)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[sampler] = (best, h)
+    return results
+
+def main(argv):
+    paths = argv[1:]
+    tmpdir = None
+    if not paths:
+        tmpdir = tempfile.mkdtemp()
+        print("テスト動画を生成中...")
+        paths = [make_test_video(os.path.join(tmpdir, "long.mp4"))]
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        results = bench(path)
+        print(f"{path} ({length} frames)")
+        for sampler, (elapsed, h) in results.items():
+            print(f"  {sampler:<10} {elapsed:8.3f}s  hash={h}")
+        seek_h = results["seek"][1]
+        seq_h = results["sequential"][1]
+        if seek_h is not None and seq_h is not None:
+            print(f"  hash distance: {seek_h - seq_h}")
+    if tmpdir is not None:
+        for f in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, f))
+        os.rmdir(tmpdir)
+
+if __name__ == "__main__":
+    main(sys.argv)